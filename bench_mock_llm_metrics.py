@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import resource
+except ImportError:  # not on Windows; RSS is then reported as "-"
+    resource = None  # type: ignore[assignment]
+
+from mock_llm_metrics_server import (
+    _MODE_PARAMS,
+    _SIM_HISTOGRAMS,
+    MqQueueConfig,
+    Registry,
+    RemoteWriteConfig,
+    RemoteWriter,
+    ShardedRegistry,
+    Simulator,
+    _HistogramState,
+    _MqQueue,
+    _parse_csv,
+    _snappy_decompress,
+    _synthetic_label_count,
+    _synthetic_label_sets,
+    np,
+)
+
+
+def _timeit(fn: Callable[[], object], repeat: int) -> List[float]:
+    samples: List[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return samples
+
+
+def _fill_registry(registry: Registry, series: int) -> None:
+    # Roughly the simulator mix: 2/3 counters, 1/3 gauges.
+    for i in range(series):
+        labels = {"service": f"svc-{i % 97}", "channel": f"ch-{i}"}
+        if i % 3:
+            registry.inc_counter("bench_counter", 1, labels=labels)
+        else:
+            registry.set_gauge("bench_gauge", i, labels=labels)
+
+
+def bench_render(args: argparse.Namespace) -> None:
+    print(f"{'series':>10} {'cold_ms':>10} {'clean_ms':>10} {'dirty1%_ms':>11} {'bytes':>12}")
+    for n in (int(v) for v in _parse_csv(args.series)):
+        registry = Registry()
+        _fill_registry(registry, n)
+
+        t0 = time.perf_counter()
+        payload = registry.render_bytes()
+        cold = time.perf_counter() - t0
+
+        clean = _timeit(registry.render_bytes, args.repeat)
+
+        touched = max(1, n // 100)
+
+        def dirty_scrape() -> None:
+            for i in range(0, n, max(1, n // touched)):
+                labels = {"service": f"svc-{i % 97}", "channel": f"ch-{i}"}
+                if i % 3:
+                    registry.inc_counter("bench_counter", 1, labels=labels)
+                else:
+                    registry.set_gauge("bench_gauge", -i, labels=labels)
+            registry.render_bytes()
+
+        dirty = _timeit(dirty_scrape, args.repeat)
+        print(
+            f"{n:>10} {cold * 1e3:>10.2f} {clean[len(clean) // 2] * 1e3:>10.3f} "
+            f"{dirty[len(dirty) // 2] * 1e3:>11.2f} {len(payload):>12}"
+        )
+
+
+def _hammer(registry: Registry, ops: int, worker: int) -> None:
+    labels = [{"service": f"svc-{worker}", "channel": f"ch-{i}", "status_code": "200"} for i in range(8)]
+    for i in range(ops):
+        lbl = labels[i & 7]
+        registry.inc_counter("bench_requests", 1, labels=lbl)
+        registry.set_gauge("bench_inflight", i, labels=lbl)
+        registry.observe_histogram("bench_latency", (i % 100) / 50.0, labels=lbl)
+
+
+def bench_threads(args: argparse.Namespace) -> None:
+    print(f"{'registry':>10} {'threads':>8} {'updates/s':>12} {'scrapes':>8}")
+    for threads in (int(v) for v in _parse_csv(args.threads)):
+        for registry_cls in (Registry, ShardedRegistry):
+            registry = registry_cls()
+            registry.define_histogram("bench_latency", [0.1, 0.5, 1, 2], help_text="Bench latency.")
+            stop = threading.Event()
+            scrapes = 0
+
+            def scraper() -> None:
+                nonlocal scrapes
+                while not stop.is_set():
+                    registry.render_bytes()
+                    scrapes += 1
+                    time.sleep(args.scrape_interval)
+
+            workers = [
+                threading.Thread(target=_hammer, args=(registry, args.ops, w)) for w in range(threads)
+            ]
+            scrape_thread = threading.Thread(target=scraper)
+            t0 = time.perf_counter()
+            scrape_thread.start()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.perf_counter() - t0
+            stop.set()
+            scrape_thread.join()
+
+            name = "sharded" if registry_cls is ShardedRegistry else "locked"
+            updates = 3 * args.ops * threads
+            print(f"{name:>10} {threads:>8} {updates / elapsed:>12.0f} {scrapes:>8}")
+
+
+def bench_engine(args: argparse.Namespace) -> None:
+    services = [f"svc-{i}" for i in range(args.services)]
+    channels = [f"ch-{i}" for i in range(args.channels)]
+    engines = [e for e in _parse_csv(args.engines) if e != "numpy" or np is not None]
+    print(f"{'engine':>8} {'qps/pair':>10} {'tick_ms':>10} {'sim_req/s':>12}")
+    for engine in engines:
+        for qps in (float(v) for v in _parse_csv(args.qps)):
+            registry = Registry()
+            sim = Simulator(
+                registry, services=services, channels=channels, base_qps=qps, mode=args.mode, engine=engine, seed=1
+            )
+            ticks = _timeit(lambda: sim.step(args.dt), args.repeat)
+            tick = ticks[len(ticks) // 2]
+            requests = qps * args.dt * len(services) * len(channels)
+            print(f"{engine:>8} {qps:>10.0f} {tick * 1e3:>10.2f} {requests / tick:>12.0f}")
+
+
+def bench_mq(args: argparse.Namespace) -> None:
+    print(f"{'mode':>7} {'arrivals/s':>11} {'events/s':>12} {'backlog':>8} {'errors':>8}")
+    for mode in _parse_csv(args.modes):
+        params = _MODE_PARAMS[mode]
+        for rate in (int(v) for v in _parse_csv(args.rates)):
+            queue = _MqQueue(
+                MqQueueConfig(consumers=args.consumers or None, service_time=args.service_time), random.Random(1)
+            )
+            events = errors = 0
+            t0 = time.perf_counter()
+            for tick in range(args.ticks):
+                durations, retries, tick_errors, _ = queue.advance(float(tick), 1.0, rate, params)
+                # completed writes and retries; arrivals a full buffer rejected did no work
+                events += len(durations) + retries
+                errors += tick_errors
+            events += queue.enqueued
+            elapsed = time.perf_counter() - t0
+            print(f"{mode:>7} {rate:>11} {events / elapsed:>12.0f} {queue.backlog:>8} {errors:>8}")
+
+
+_CARDINALITY_CHANNELS = ["openai", "anthropic", "azure", "cohere"]
+
+
+def bench_cardinality_point(args: argparse.Namespace) -> None:
+    # One measurement in a fresh process, so peak RSS belongs to this series count alone.
+    count = _synthetic_label_count(args.target, 1, len(_CARDINALITY_CHANNELS), False)
+    registry = Registry()
+    sim = Simulator(
+        registry,
+        services=["llm-api"],
+        channels=_CARDINALITY_CHANNELS,
+        base_qps=args.base_qps,
+        mode="normal",
+        engine=args.engine,
+        seed=1,
+        synthetic_labels=_synthetic_label_sets(count),
+    )
+    # One long tick first so (nearly) every status code and token bucket series exists.
+    sim.step(args.warmup)
+    registry.render_bytes()
+
+    ticks: List[float] = []
+    renders: List[float] = []
+    payload = b""
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        sim.step(1.0)
+        t1 = time.perf_counter()
+        payload = registry.render_bytes()
+        ticks.append(t1 - t0)
+        renders.append(time.perf_counter() - t1)
+    ticks.sort()
+    renders.sort()
+    result: Dict[str, object] = {
+        "target": args.target,
+        "series": sum(1 for line in payload.splitlines() if not line.startswith(b"#")),
+        "tick_ms": ticks[len(ticks) // 2] * 1e3,
+        "render_ms": renders[len(renders) // 2] * 1e3,
+        "bytes": len(payload),
+        # ru_maxrss is KiB on Linux.
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else None,
+    }
+    print(json.dumps(result))
+
+
+def bench_cardinality(args: argparse.Namespace) -> None:
+    engine = args.engine or ("numpy" if np is not None else "python")
+    print(f"{'target':>9} {'series':>9} {'tick_ms':>9} {'render_ms':>10} {'bytes':>12} {'rss_mb':>8}")
+    results = []
+    for target in (int(v) for v in _parse_csv(args.targets)):
+        out = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "cardinality-point",
+                "--target",
+                str(target),
+                "--engine",
+                engine,
+                "--base-qps",
+                str(args.base_qps),
+                "--warmup",
+                str(args.warmup),
+                "--repeat",
+                str(args.repeat),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        results.append(dict(result, engine=engine))
+        rss = f"{result['rss_mb']:>8.0f}" if result["rss_mb"] is not None else f"{'-':>8}"
+        print(
+            f"{target:>9} {result['series']:>9} {result['tick_ms']:>9.1f} {result['render_ms']:>10.1f} "
+            f"{result['bytes']:>12} {rss}"
+        )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+
+def _classic_quantile(state: _HistogramState, q: float) -> float:
+    # Linear interpolation inside the bucket, like histogram_quantile() on _bucket series.
+    rank = q * state.count
+    cumulative = 0
+    lower = 0.0
+    for bound, n in zip(state.buckets, state.raw_bucket_counts):
+        if n and cumulative + n >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / n
+        cumulative += n
+        lower = bound
+    return lower  # in +Inf: the highest finite bound
+
+
+def _native_quantile(state: _HistogramState, q: float) -> float:
+    # Positive buckets only (durations); bucket k covers (base^(k-1), base^k].
+    assert state.native is not None and state.positive is not None
+    base = 2.0 ** (2.0**-state.native.schema)
+    rank = q * state.count
+    cumulative = state.zero_count
+    for key in sorted(state.positive):
+        n = state.positive[key]
+        if cumulative + n >= rank:
+            lower, upper = base ** (key - 1), base**key
+            return lower + (upper - lower) * (rank - cumulative) / n
+        cumulative += n
+    return 0.0
+
+
+def bench_histograms(args: argparse.Namespace) -> None:
+    # The same observations through the classic llm_request_duration buckets and through
+    # native schemas: series Prometheus stores per label set, scrape bytes, quantile error.
+    classic_buckets = _SIM_HISTOGRAMS["llm_request_duration"][0]
+    rng = random.Random(1)
+    samples = [
+        [rng.lognormvariate(math.log(args.median), args.sigma) for _ in range(args.observations)]
+        for _ in range(args.label_sets)
+    ]
+    exact = sorted(samples[0])
+    print(
+        f"{'layout':>10} {'buckets/set':>11} {'series/set':>10} {'text_bytes':>11} {'proto_bytes':>11} "
+        f"{'p50_err%':>9} {'p99_err%':>9}"
+    )
+    layouts: List[Optional[int]] = [None] + [int(v) for v in _parse_csv(args.schemas)]
+    for schema in layouts:
+        registry = Registry()
+        registry.define_histogram(
+            "bench_duration", classic_buckets if schema is None else (), "Bench duration.", native_schema=schema
+        )
+        family = registry.histogram("bench_duration")
+        for i, values in enumerate(samples):
+            family.labels(service=f"svc-{i % 7}", channel=f"ch-{i}").observe_many(values)
+        text_bytes = len(registry.render_bytes())
+        proto_bytes = sum(len(chunk) for chunk in registry.iter_protobuf())
+        state = family.labels(service="svc-0", channel="ch-0")._series.value
+        if schema is None:
+            name = "classic"
+            buckets = len(classic_buckets) + 1
+            series = len(classic_buckets) + 3  # _bucket (incl. +Inf), _sum, _count
+            estimate = _classic_quantile
+            text = f"{text_bytes:>11}"
+        else:
+            name = f"native/{schema}"
+            buckets = sum(len(s.value.positive) for s in registry._histograms.values()) / len(samples)
+            series = 1
+            estimate = _native_quantile
+            text = f"{'-':>11}"
+        errors = []
+        for q in (0.5, 0.99):
+            truth = exact[min(len(exact) - 1, int(q * len(exact)))]
+            errors.append(abs(estimate(state, q) - truth) / truth * 100)
+        print(
+            f"{name:>10} {buckets:>11.1f} {series:>10} {text} {proto_bytes:>11} {errors[0]:>9.2f} {errors[1]:>9.2f}"
+        )
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server on port {port} did not come up")
+
+
+def _scrape_loop(port: int, deadline: float, latencies: List[float]) -> None:
+    # One keep-alive connection per client, like a Prometheus scraper.
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.monotonic() < deadline:
+        t0 = time.perf_counter()
+        conn.request("GET", "/metrics", headers={"Accept-Encoding": "identity"})
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - t0)
+    conn.close()
+
+
+def bench_server(args: argparse.Namespace) -> None:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_llm_metrics_server.py")
+    channels = ",".join(f"ch-{i}" for i in range(args.channels))
+    remote_write: List[str] = []
+    if args.remote_write_latency_ms > 0:
+        # A slow receiver and a small queue: every tick's push waits on backpressure.
+        receiver = _RemoteWriteReceiver(0.0, args.remote_write_latency_ms / 1e3)
+        threading.Thread(target=receiver.serve_forever, daemon=True).start()
+        remote_write = [
+            "--remote-write",
+            f"http://127.0.0.1:{receiver.server_address[1]}/api/v1/write",
+            "--remote-write-batch",
+            str(args.remote_write_capacity),
+            "--remote-write-capacity",
+            str(args.remote_write_capacity),
+        ]
+    print(f"{'server':>9} {'clients':>8} {'scrapes/s':>10} {'p50_ms':>8} {'p99_ms':>8} {'max_ms':>8}")
+    for server in _parse_csv(args.servers):
+        for clients in (int(v) for v in _parse_csv(args.clients)):
+            port = _free_port()
+            proc = subprocess.Popen(
+                [
+                    sys.executable,
+                    script,
+                    "--listen",
+                    "127.0.0.1",
+                    "--port",
+                    str(port),
+                    "--server",
+                    server,
+                    "--channels",
+                    channels,
+                    "--base-qps",
+                    str(args.base_qps),
+                    "--interval",
+                    str(args.interval),
+                    *remote_write,
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                _wait_for_port(port, timeout=30)
+                per_client: List[List[float]] = [[] for _ in range(clients)]
+                deadline = time.monotonic() + args.duration
+                threads = [
+                    threading.Thread(target=_scrape_loop, args=(port, deadline, per_client[i])) for i in range(clients)
+                ]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            finally:
+                proc.terminate()
+                proc.wait()
+            latencies = sorted(lat for client in per_client for lat in client)
+            if not latencies:
+                continue
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(
+                f"{server:>9} {clients:>8} {len(latencies) / args.duration:>10.1f} {p50 * 1e3:>8.2f}"
+                f" {p99 * 1e3:>8.2f} {latencies[-1] * 1e3:>8.2f}"
+            )
+
+
+def _pb_fields(data: bytes) -> Iterator[Tuple[int, object]]:
+    # (field number, varint int | 8-byte slice | length-delimited slice); just enough protobuf
+    # for the remote-write stand-in.
+    i = 0
+    while i < len(data):
+        key, i = _uvarint(data, i)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = _uvarint(data, i)
+            yield field, value
+        elif wire == 1:
+            yield field, data[i : i + 8]
+            i += 8
+        elif wire == 2:
+            n, i = _uvarint(data, i)
+            yield field, data[i : i + n]
+            i += n
+        else:
+            raise ValueError(f"unsupported wire type {wire}")
+
+
+def _uvarint(data: bytes, i: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, i
+
+
+class _RemoteWriteReceiver(ThreadingHTTPServer):
+    # Local remote-write stand-in: decompresses and decodes every WriteRequest, checks that
+    # each series has __name__ and sorted labels, and can inject 503s and latency.
+    daemon_threads = True
+
+    def __init__(self, fail_rate: float, latency: float) -> None:
+        super().__init__(("127.0.0.1", 0), _RemoteWriteHandler)
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.rng = random.Random(1)
+        self.lock = threading.Lock()
+        self.requests = self.rejected = self.series = self.samples = self.raw_bytes = self.wire_bytes = 0
+        self.invalid = 0
+
+
+class _RemoteWriteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _RemoteWriteReceiver
+
+    def do_POST(self) -> None:  # noqa: N802
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            fail = server.rng.random() < server.fail_rate
+        if fail or self.headers.get("Content-Encoding") != "snappy":
+            with server.lock:
+                server.rejected += 1
+            self._reply(503)
+            return
+        raw = _snappy_decompress(body)
+        series = samples = invalid = 0
+        for field, ts in _pb_fields(raw):
+            if field != 1:
+                continue
+            series += 1
+            names = []
+            for sub, value in _pb_fields(ts):  # type: ignore[arg-type]
+                if sub == 1:
+                    names.append(next(v for f, v in _pb_fields(value) if f == 1))  # type: ignore[arg-type]
+                elif sub == 2:
+                    samples += 1
+            invalid += b"__name__" not in names or names != sorted(names)
+        with server.lock:
+            server.requests += 1
+            server.series += series
+            server.samples += samples
+            server.invalid += invalid
+            server.raw_bytes += len(raw)
+            server.wire_bytes += len(body)
+        self._reply(204)
+
+    def _reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, fmt: str, *args: object) -> None:
+        return
+
+
+def bench_remote_write(args: argparse.Namespace) -> None:
+    receiver = _RemoteWriteReceiver(args.fail_rate, args.latency_ms / 1e3)
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    count = _synthetic_label_count(args.series, 1, len(_CARDINALITY_CHANNELS), False) if args.series else 0
+    registry = Registry()
+    sim = Simulator(
+        registry,
+        services=["llm-api"],
+        channels=_CARDINALITY_CHANNELS,
+        base_qps=args.base_qps,
+        mode="normal",
+        seed=1,
+        synthetic_labels=_synthetic_label_sets(count) if count else (),
+    )
+    config = RemoteWriteConfig(
+        shards=args.shards, batch_size=args.batch, capacity=max(args.batch, args.capacity), max_retries=args.retries
+    )
+    writer = RemoteWriter(
+        registry, f"http://127.0.0.1:{receiver.server_address[1]}/api/v1/write", config, clock=time.time
+    )
+    sim.step(60.0)
+    snapshots: List[float] = []
+    pushed = 0
+    t0 = time.perf_counter()
+    for _ in range(args.ticks):
+        sim.step(1.0)
+        t1 = time.perf_counter()
+        pushed += writer.snapshot()
+        snapshots.append(time.perf_counter() - t1)
+    deadline = time.monotonic() + args.drain_timeout
+    while writer.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    receiver.shutdown()
+    snapshots.sort()
+    self_metrics = [
+        line.split(" ")
+        for line in registry.render().splitlines()
+        if line.startswith("mock_exporter_remote_write_") and "_bucket{" not in line
+    ]
+    print(f"pushed samples      {pushed} in {args.ticks} ticks ({pushed / elapsed:.0f} samples/s incl. drain)")
+    print(f"received            {receiver.samples} samples in {receiver.requests} requests")
+    print(f"rejected (503)      {receiver.rejected}, invalid series {receiver.invalid}, pending {writer.pending()}")
+    print(f"snapshot p50        {snapshots[len(snapshots) // 2] * 1e3:.1f} ms")
+    if receiver.wire_bytes:
+        ratio = receiver.raw_bytes / receiver.wire_bytes
+        print(f"bytes raw/wire      {receiver.raw_bytes}/{receiver.wire_bytes} (snappy x{ratio:.1f})")
+    for name, value in self_metrics:
+        print(f"{name:<70} {value}")
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for mock_llm_metrics_server.")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("render", help="Scrape (render) latency against series count")
+    p.add_argument("--series", default="1000,10000,100000", help="Comma-separated series counts")
+    p.add_argument("--repeat", type=int, default=5, help="Repetitions per measurement (median reported)")
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("threads", help="Multi-threaded update throughput: locked vs sharded registry")
+    p.add_argument("--threads", default="1,2,4,8", help="Comma-separated writer thread counts")
+    p.add_argument("--ops", type=int, default=50000, help="Loop iterations per writer (3 updates each)")
+    p.add_argument("--scrape-interval", type=float, default=0.05, help="Seconds between concurrent scrapes")
+    p.set_defaults(func=bench_threads)
+
+    p = sub.add_parser("engine", help="Simulated requests per second of each Simulator engine")
+    p.add_argument("--engines", default="python,numpy", help="Comma-separated engines (numpy skipped if missing)")
+    p.add_argument("--qps", default="100,1000,10000", help="Comma-separated --base-qps values")
+    p.add_argument("--services", type=int, default=2, help="Number of services")
+    p.add_argument("--channels", type=int, default=4, help="Number of channels")
+    p.add_argument("--mode", choices=["normal", "stress"], default="normal")
+    p.add_argument("--dt", type=float, default=1.0, help="Tick length in simulated seconds")
+    p.add_argument("--repeat", type=int, default=3, help="Ticks per measurement (median reported)")
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser("mq", help="Discrete-event MQ queue model throughput (events/s)")
+    # Defaults keep the queue stable: a saturated buffer mostly measures rejections.
+    p.add_argument("--modes", default="normal", help="Comma-separated modes (parameter sets)")
+    p.add_argument("--rates", default="1000,5000,10000", help="Comma-separated arrivals per simulated second")
+    p.add_argument(
+        "--consumers", type=int, default=400, help="MQ consumers (0: mode default, which saturates at these rates)"
+    )
+    p.add_argument("--service-time", default="lognormal", help="Service time distribution")
+    p.add_argument("--ticks", type=int, default=5, help="Simulated seconds per measurement")
+    p.set_defaults(func=bench_mq)
+
+    p = sub.add_parser("server", help="Scrapes/s and p99 scrape latency: threaded vs asyncio server")
+    p.add_argument("--servers", default="threaded,asyncio", help="Comma-separated --server modes")
+    p.add_argument("--clients", default="1,8,32", help="Comma-separated concurrent keep-alive scrapers")
+    p.add_argument("--duration", type=float, default=5.0, help="Seconds per measurement")
+    p.add_argument("--channels", type=int, default=50, help="Channels (series count scales with it)")
+    p.add_argument("--base-qps", type=float, default=20.0, help="--base-qps passed to the server")
+    p.add_argument("--interval", type=float, default=1.0, help="--interval passed to the server")
+    p.add_argument(
+        "--remote-write-latency-ms",
+        type=float,
+        default=0.0,
+        help="Also push to a local receiver this slow (0: no remote write)",
+    )
+    p.add_argument(
+        "--remote-write-capacity", type=int, default=200, help="--remote-write-batch/-capacity passed to the server"
+    )
+    p.set_defaults(func=bench_server)
+
+    p = sub.add_parser("cardinality", help="Tick/render time, scrape bytes and RSS against --synthetic-cardinality")
+    p.add_argument("--targets", default="1000,10000,100000,1000000", help="Comma-separated target series counts")
+    p.add_argument("--engine", choices=["python", "numpy"], default=None, help="Default: numpy if installed")
+    p.add_argument("--base-qps", type=float, default=2.0, help="QPS per slot")
+    p.add_argument("--warmup", type=float, default=60.0, help="Simulated seconds of the first tick")
+    p.add_argument("--repeat", type=int, default=3, help="Tick+render rounds per target (median reported)")
+    p.add_argument("--json", default=None, help="Also write the results to this file (for regression diffs)")
+    p.set_defaults(func=bench_cardinality)
+
+    p = sub.add_parser("histograms", help="Classic vs native histogram schemas: series, bytes, quantile error")
+    p.add_argument("--schemas", default="0,3,5", help="Comma-separated native schemas to compare")
+    p.add_argument("--label-sets", type=int, default=200, help="Histogram label sets")
+    p.add_argument("--observations", type=int, default=2000, help="Observations per label set")
+    p.add_argument("--median", type=float, default=1.5, help="Median of the lognormal durations (seconds)")
+    p.add_argument("--sigma", type=float, default=1.0, help="Sigma of the lognormal durations")
+    p.set_defaults(func=bench_histograms)
+
+    p = sub.add_parser("remote-write", help="Push throughput, compression and retries against a local receiver")
+    p.add_argument("--series", type=int, default=10000, help="Approximate series count (0: simulator defaults)")
+    p.add_argument("--base-qps", type=float, default=2.0, help="QPS per slot")
+    p.add_argument("--ticks", type=int, default=10, help="Snapshots to push")
+    p.add_argument("--shards", type=int, default=4)
+    p.add_argument("--batch", type=int, default=2000, help="Max samples per request")
+    p.add_argument("--capacity", type=int, default=10000, help="Pending samples per shard")
+    p.add_argument("--retries", type=int, default=10)
+    p.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests the receiver answers 503")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="Receiver latency per request")
+    p.add_argument("--drain-timeout", type=float, default=60.0, help="Seconds to wait for the queues to empty")
+    p.set_defaults(func=bench_remote_write)
+
+    p = sub.add_parser("cardinality-point", help="One cardinality measurement (run by 'cardinality')")
+    p.add_argument("--target", type=int, required=True)
+    p.add_argument("--engine", choices=["python", "numpy"], default="python")
+    p.add_argument("--base-qps", type=float, default=2.0)
+    p.add_argument("--warmup", type=float, default=60.0)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_cardinality_point)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,682 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import http.client
+import itertools
+import math
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.parse
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from mock_llm_metrics_server import (
+    OPENMETRICS_CONTENT_TYPE,
+    TEXT_CONTENT_TYPE,
+    Aggregator,
+    Registry,
+    ShardedRegistry,
+    SimClock,
+    Simulator,
+    _backfill,
+    _parse_csv,
+    _parse_duration,
+    np,
+)
+
+# Streaming parser and validator for Prometheus text (0.0.4) and OpenMetrics 1.0 scrapes.
+# Sample roles: c=counter, g=gauge/untyped, b=_bucket, S/C=histogram _sum/_count,
+# q=quantile, s/n=summary _sum/_count, x=_created.
+_ROLES: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "counter": (("", "c"), ("_total", "c"), ("_created", "x")),
+    "gauge": (("", "g"),),
+    "untyped": (("", "g"),),
+    "unknown": (("", "g"),),
+    "histogram": (("_bucket", "b"), ("_sum", "S"), ("_count", "C"), ("_created", "x")),
+    "gaugehistogram": (("_bucket", "b"), ("_gsum", "g"), ("_gcount", "g")),
+    "summary": (("", "q"), ("_sum", "s"), ("_count", "n"), ("_created", "x")),
+    "info": (("_info", "g"),),
+    "stateset": (("", "g"),),
+}
+# Roles whose value may never decrease between scrapes, and those worth a delta at all.
+_MONOTONIC = frozenset("cbCn")
+_CUMULATIVE = frozenset("cbCnSs")
+
+_NAME_RE = re.compile(r"[a-zA-Z_:][a-zA-Z0-9_:]*")
+_LABEL_PAIR = r'[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\[\\"n])*"'
+_LABELS_RE = re.compile(rf"(?:{_LABEL_PAIR}(?:,{_LABEL_PAIR})*,?)?")
+_LABEL_NAME_RE = re.compile(r'(?:^|,)([a-zA-Z_][a-zA-Z0-9_]*)="')
+_UNESCAPED_QUOTE_RE = re.compile(r'(?<!\\)(?:\\\\)*"')  # OpenMetrics HELP must escape `"`
+
+
+class Family:
+    __slots__ = ("name", "type", "help", "roles", "has_samples", "closed")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.type: Optional[str] = None
+        self.help: Optional[str] = None
+        self.roles: Dict[str, str] = {}
+        self.has_samples = False
+        self.closed = False  # another family's samples followed this one's
+
+
+class Scrape:
+    # One parsed exposition. Series identity is (sample name, label text as written), which
+    # is stable for any one exporter; timestamped series (backfill output) keep their last
+    # point in `samples`. `problems` lists every violation found.
+    def __init__(self) -> None:
+        self.families: Dict[str, Family] = {}
+        self.samples: Dict[Tuple[str, str], float] = {}
+        self.owner: Dict[str, Family] = {}  # sample name -> family
+        self.problems: List[str] = []
+        self.bytes = 0
+        self.lines = 0
+        self.openmetrics = False
+
+    def role(self, name: str) -> str:
+        family = self.owner.get(name)
+        return family.roles.get(name, "g") if family is not None else "g"
+
+
+class SeriesDelta(NamedTuple):
+    name: str
+    labels: str
+    before: float
+    after: float
+    delta: float  # after - before, or after alone across a reset
+    rate: Optional[float]  # delta per second, if the interval is known
+
+
+class ScrapeDiff(NamedTuple):
+    deltas: List[SeriesDelta]  # cumulative samples present in both scrapes
+    added: List[Tuple[str, str]]
+    removed: List[Tuple[str, str]]
+    problems: List[str]
+
+
+class _Parser:
+    def __init__(self) -> None:
+        self.scrape = Scrape()
+        self.lineno = 0
+        self.family: Optional[Family] = None
+        self.roles: Dict[str, str] = {}
+        self.valid_labels: Set[str] = set()
+        self.eof = 0  # line of "# EOF"
+        self.last = 0  # last non-empty line
+        # Point identity below is (name, labels, timestamp or None).
+        # (histogram name, labels without le, ts) -> [(le, count, line)]
+        self.buckets: Dict[Tuple[str, str, Optional[float]], List[Tuple[float, float, int]]] = {}
+        self.hist_counts: List[Tuple[str, str, Optional[float]]] = []
+        self.quantile_groups: Set[Tuple[str, str, Optional[float]]] = set()
+        self.aggregates: Dict[Tuple[str, str, Optional[float]], float] = {}  # _sum/_count values
+        # Timestamped samples: last timestamp per series; current and finished metrics
+        # (family, labels without le/quantile), whose points must be contiguous.
+        self.timestamps: Dict[Tuple[str, str], float] = {}
+        self.metric: Optional[Tuple[str, str]] = None
+        self.metrics_done: Set[Tuple[str, str]] = set()
+        self.help_quotes: List[Tuple[int, str]] = []  # HELP lines with a bare `"`; OpenMetrics only
+
+    def problem(self, lineno: int, message: str) -> None:
+        self.scrape.problems.append(f"line {lineno}: {message}" if lineno else message)
+
+    def feed(self, lines: List[str]) -> None:
+        # The hot loop: one partition/find per line, label syntax checked once per distinct
+        # label text, everything else deferred to finish().
+        samples = self.scrape.samples
+        roles = self.roles
+        valid_labels = self.valid_labels
+        buckets = self.buckets
+        problem = self.problem
+        lineno = self.lineno
+        for line in lines:
+            lineno += 1
+            if not line:
+                continue
+            if line[0] == "#":
+                self.comment(line, lineno)
+                roles = self.roles
+                continue
+            brace = line.find("{")
+            if brace < 0:
+                name, _, rest = line.partition(" ")
+                labels = ""
+            else:
+                end = line.rfind("}")
+                if end < brace:
+                    problem(lineno, "unterminated label set")
+                    continue
+                name = line[:brace]
+                labels = line[brace + 1 : end]
+                rest = line[end + 1 :]
+            ts = None
+            try:
+                value = float(rest)
+            except ValueError:
+                parsed = _value_with_timestamp(rest)
+                if parsed is None:
+                    problem(lineno, f"expected '<sample> <value> [timestamp]', got {line!r}")
+                    continue
+                value, ts = parsed
+
+            role = roles.get(name)
+            if role is None:
+                role = self.switch(name, lineno)
+                roles = self.roles
+            group = labels
+            if role == "b":
+                if labels.startswith('le="'):
+                    quote = labels.find('"', 4)
+                    le_text, group = labels[4:quote], labels[quote + 2 :]
+                else:
+                    le_text, group = _pop_label(labels, "le")
+                try:
+                    le = float(le_text)
+                except (TypeError, ValueError):
+                    problem(lineno, f"{name}: missing or invalid le label")
+                    continue
+                if group and group not in valid_labels:
+                    self.check_labels(group, lineno)
+                if not value >= 0:
+                    problem(lineno, f"{_series(name, labels)}: negative or NaN bucket count {value}")
+                buckets.setdefault((name[: -len("_bucket")], group, ts), []).append((le, value, lineno))
+            elif labels and labels not in valid_labels:
+                self.check_labels(labels, lineno)
+            if role == "c" or role == "C" or role == "n":
+                if not value >= 0:
+                    problem(lineno, f"{_series(name, labels)}: negative or NaN counter value {value}")
+                if role == "C":
+                    self.hist_counts.append((name[: -len("_count")], labels, ts))
+            elif role == "q":
+                quantile, group = _pop_label(labels, "quantile")
+                try:
+                    if not 0 <= float(quantile) <= 1:  # type: ignore[arg-type]
+                        raise ValueError
+                except (TypeError, ValueError):
+                    problem(lineno, f"{_series(name, labels)}: missing or invalid quantile label")
+                self.quantile_groups.add((name, group, ts))
+            if role in "SCsn":
+                self.aggregates[(name, labels, ts)] = value
+
+            if ts is None:
+                if samples.setdefault((name, labels), value) is not value:
+                    problem(lineno, f"duplicate series {_series(name, labels)}")
+            else:
+                self.timed(name, labels, group, role, value, ts, lineno)
+        for i in range(len(lines) - 1, -1, -1):
+            if lines[i]:
+                self.last = self.lineno + i + 1
+                break
+        self.lineno = lineno
+
+    def timed(self, name: str, labels: str, group: str, role: str, value: float, ts: float, lineno: int) -> None:
+        # A timestamped point: its series' timestamps must increase (monotonic values must not
+        # decrease), and all points of one metric must be contiguous.
+        key = (name, labels)
+        previous_ts = self.timestamps.get(key)
+        if previous_ts is not None:
+            if not ts > previous_ts:
+                self.problem(lineno, f"{_series(name, labels)}: timestamp {ts:.3f} not after {previous_ts:.3f}")
+            elif role in _MONOTONIC and value < self.scrape.samples[key]:
+                self.problem(lineno, f"{_series(name, labels)}: decreased to {value:g} at {ts:.3f}")
+        elif key in self.scrape.samples:
+            self.problem(lineno, f"duplicate series {_series(name, labels)}")
+        self.timestamps[key] = ts
+        self.scrape.samples[key] = value
+        metric = (self.family.name if self.family is not None else name, group)
+        if metric != self.metric:
+            if metric in self.metrics_done:
+                self.problem(lineno, f"points of {_series(*metric)} are not contiguous")
+            if self.metric is not None:
+                self.metrics_done.add(self.metric)
+            self.metric = metric
+
+    def comment(self, line: str, lineno: int) -> None:
+        parts = line.split(None, 3)
+        keyword = parts[1] if len(parts) > 1 else ""
+        if keyword == "EOF":
+            self.eof = lineno
+            self.scrape.openmetrics = True
+            return
+        if keyword not in ("HELP", "TYPE", "UNIT"):
+            return  # plain comment
+        if len(parts) < 3:
+            self.problem(lineno, f"malformed {keyword} line")
+            return
+        name = parts[2]
+        text = parts[3] if len(parts) > 3 else ""
+        family = self.declare(name, lineno)
+        if family is None:
+            return
+        if keyword == "HELP":
+            if family.help is not None:
+                self.problem(lineno, f"duplicate HELP for {name}")
+            family.help = text
+            if '"' in text and _UNESCAPED_QUOTE_RE.search(text):
+                self.help_quotes.append((lineno, name))
+        elif keyword == "TYPE":
+            if family.type is not None:
+                self.problem(lineno, f"duplicate TYPE for {name}")
+            elif family.has_samples:
+                self.problem(lineno, f"TYPE for {name} after its samples")
+            elif text not in _ROLES:
+                self.problem(lineno, f"unknown type {text!r} for {name}")
+            else:
+                family.type = text
+                self.assign_roles(family)
+
+    def declare(self, name: str, lineno: int) -> Optional[Family]:
+        scrape = self.scrape
+        family = scrape.families.get(name)
+        if family is None:
+            if not _NAME_RE.fullmatch(name):
+                self.problem(lineno, f"invalid metric name {name!r}")
+                return None
+            family = scrape.families[name] = Family(name)
+            self.assign_roles(family)
+        elif family.closed:
+            self.problem(lineno, f"metadata for {name} after its samples")
+        return family
+
+    def assign_roles(self, family: Family) -> None:
+        owner = self.scrape.owner
+        for sample_name in family.roles:
+            if owner.get(sample_name) is family:
+                del owner[sample_name]
+        family.roles = {family.name + suffix: role for suffix, role in _ROLES[family.type or "untyped"]}
+        for sample_name in family.roles:
+            owner.setdefault(sample_name, family)
+        if family is self.family:
+            self.roles = family.roles
+
+    def switch(self, name: str, lineno: int) -> str:
+        # First sample of another family: resolve it, enforce contiguity, swap `roles`.
+        family = self.scrape.owner.get(name)
+        if family is None:
+            family = self.declare(name, lineno) if name not in self.scrape.families else self.scrape.families[name]
+            if family is None:
+                family = Family(name)
+                family.roles = {name: "g"}
+        if family is not self.family:
+            if family.closed:
+                self.problem(lineno, f"samples of {family.name} are not contiguous")
+                family.closed = False
+            if self.family is not None:
+                self.family.closed = True
+            self.family = family
+            self.roles = family.roles
+        family.has_samples = True
+        return family.roles[name]
+
+    def check_labels(self, labels: str, lineno: int) -> None:
+        if not _LABELS_RE.fullmatch(labels):
+            self.problem(lineno, f"malformed label set {{{labels}}}")
+            return
+        names = _LABEL_NAME_RE.findall(labels)
+        if len(set(names)) != len(names):
+            self.problem(lineno, f"duplicate label name in {{{labels}}}")
+            return
+        self.valid_labels.add(labels)
+
+    def finish(self) -> Scrape:
+        problem = self.problem
+        aggregates = self.aggregates
+        if self.eof and self.last != self.eof:
+            problem(self.eof, "content after # EOF")
+        if self.eof:
+            for lineno, name in self.help_quotes:
+                problem(lineno, f'unescaped " in HELP for {name}')
+        for (base, group, ts), series in self.buckets.items():
+            where = _point(base, group, ts)
+            previous_le, previous = -math.inf, 0.0
+            for le, count, lineno in series:
+                if not le > previous_le:
+                    problem(lineno, f"{where}: le {le:g} not increasing")
+                if count < previous:
+                    problem(lineno, f"{where}: bucket le={le:g} count {count:g} < previous {previous:g}")
+                previous_le, previous = le, count
+            count = aggregates.get((base + "_count", group, ts))
+            if previous_le != math.inf:
+                problem(0, f"{where}: no +Inf bucket")
+            elif count is None:
+                problem(0, f"{where}: buckets without _count")
+            elif count != previous:
+                problem(0, f"{where}: +Inf bucket {previous:g} != _count {count:g}")
+            if (base + "_sum", group, ts) not in aggregates:
+                problem(0, f"{where}: buckets without _sum")
+        for base, labels, ts in self.hist_counts:
+            if (base, labels, ts) not in self.buckets:
+                problem(0, f"{_point(base, labels, ts)}: _count without buckets")
+        for base, group, ts in self.quantile_groups:
+            if (base + "_count", group, ts) not in aggregates or (base + "_sum", group, ts) not in aggregates:
+                problem(0, f"{_point(base, group, ts)}: quantiles without _sum/_count")
+        return self.scrape
+
+
+def _series(name: str, labels: str) -> str:
+    return f"{name}{{{labels}}}" if labels else name
+
+
+def _point(name: str, labels: str, ts: Optional[float]) -> str:
+    return _series(name, labels) if ts is None else f"{_series(name, labels)} @{ts:.3f}"
+
+
+def _value_with_timestamp(rest: str) -> Optional[Tuple[float, float]]:
+    fields = rest.split()
+    if len(fields) != 2:
+        return None
+    try:
+        return float(fields[0]), float(fields[1])
+    except ValueError:
+        return None
+
+
+def _pop_label(labels: str, name: str) -> Tuple[Optional[str], str]:
+    # (value of label `name` or None, remaining label text); values with escapes are left as is.
+    prefix = name + '="'
+    start = 0
+    if not labels.startswith(prefix):
+        start = labels.find("," + prefix) + 1
+        if not start:
+            return None, labels
+    value_start = start + len(prefix)
+    quote = labels.find('"', value_start)
+    if quote < 0:
+        return None, labels
+    return labels[value_start:quote], (labels[:start] + labels[quote + 2 :]).rstrip(",")
+
+
+def parse_exposition(chunks: Iterable[bytes]) -> Scrape:
+    # Parses and validates a text or OpenMetrics exposition streamed as byte chunks of any size.
+    parser = _Parser()
+    tail = b""
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        data = tail + chunk if tail else chunk
+        cut = data.rfind(b"\n") + 1
+        tail = data[cut:]
+        if cut:
+            parser.feed(data[:cut].decode("utf-8", "replace").split("\n")[:-1])
+    if tail:
+        parser.feed([tail.decode("utf-8", "replace")])
+    scrape = parser.finish()
+    scrape.bytes = size
+    scrape.lines = parser.lineno
+    return scrape
+
+
+def diff_scrapes(before: Scrape, after: Scrape, seconds: Optional[float] = None) -> ScrapeDiff:
+    # Per-series deltas (and rates, given the interval) of every cumulative sample, plus
+    # counters that went backwards and families whose HELP/TYPE changed.
+    problems: List[str] = []
+    for name, family in after.families.items():
+        old = before.families.get(name)
+        if old is not None and (old.type, old.help) != (family.type, family.help):
+            problems.append(f"{name}: HELP/TYPE changed between scrapes")
+    deltas: List[SeriesDelta] = []
+    added: List[Tuple[str, str]] = []
+    old_samples = before.samples
+    for key, value in after.samples.items():
+        previous = old_samples.get(key)
+        if previous is None:
+            added.append(key)
+            continue
+        role = after.role(key[0])
+        if role not in _CUMULATIVE:
+            continue
+        delta = value - previous
+        if delta < 0 and role in _MONOTONIC:
+            problems.append(f"{_series(*key)}: decreased from {previous:g} to {value:g}")
+            delta = value
+        deltas.append(SeriesDelta(key[0], key[1], previous, value, delta, delta / seconds if seconds else None))
+    removed = [key for key in old_samples if key not in after.samples]
+    return ScrapeDiff(deltas, added, removed, problems)
+
+
+def _read_chunks(f: BinaryIO, size: int = 1 << 20) -> Iterator[bytes]:
+    return iter(lambda: f.read(size), b"")
+
+
+def _parse_file(path: str) -> Scrape:
+    if path == "-":
+        return parse_exposition(_read_chunks(sys.stdin.buffer))
+    with open(path, "rb") as f:
+        return parse_exposition(_read_chunks(f))
+
+
+def _report(label: str, scrape: Scrape, elapsed: float, max_problems: int) -> None:
+    samples = len(scrape.samples)
+    print(
+        f"{label}: {len(scrape.families)} families, {samples} samples, {scrape.bytes} bytes in "
+        f"{elapsed * 1e3:.1f}ms ({scrape.bytes / max(elapsed, 1e-9) / 1e6:.0f} MB/s), "
+        f"{len(scrape.problems)} problems"
+    )
+    _print_problems(scrape.problems, max_problems)
+
+
+def _print_problems(problems: List[str], max_problems: int) -> None:
+    for message in problems[: max_problems or None]:
+        print(f"  {message}")
+    if max_problems and len(problems) > max_problems:
+        print(f"  ... {len(problems) - max_problems} more")
+
+
+def _print_deltas(diff: ScrapeDiff, top: int) -> None:
+    deltas = sorted(diff.deltas, key=lambda d: abs(d.delta), reverse=True)
+    print(f"{len(diff.deltas)} cumulative series, {len(diff.added)} added, {len(diff.removed)} removed")
+    if deltas:
+        print(f"{'delta':>14} {'rate/s':>14}  series")
+    for d in deltas[: top or None]:
+        rate = f"{d.rate:14.4g}" if d.rate is not None else f"{'-':>14}"
+        print(f"{d.delta:14.6g} {rate}  {_series(d.name, d.labels)}")
+
+
+def check_validate(args: argparse.Namespace) -> int:
+    failed = False
+    for path in args.files:
+        t0 = time.perf_counter()
+        scrape = _parse_file(path)
+        _report(path, scrape, time.perf_counter() - t0, args.max_problems)
+        failed = failed or bool(scrape.problems)
+    return 1 if failed else 0
+
+
+def check_diff(args: argparse.Namespace) -> int:
+    scrapes = []
+    for path in (args.before, args.after):
+        t0 = time.perf_counter()
+        scrapes.append(_parse_file(path))
+        _report(path, scrapes[-1], time.perf_counter() - t0, args.max_problems)
+    diff = diff_scrapes(scrapes[0], scrapes[1], args.seconds)
+    _print_deltas(diff, args.top)
+    print(f"diff: {len(diff.problems)} problems")
+    _print_problems(diff.problems, args.max_problems)
+    return 1 if diff.problems or any(scrape.problems for scrape in scrapes) else 0
+
+
+def _scrape(url: str, openmetrics: bool, timeout: float) -> Iterator[bytes]:
+    parsed = urllib.parse.urlsplit(url)
+    conn_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    conn = conn_class(parsed.netloc, timeout=timeout)
+    try:
+        accept = OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE
+        path = parsed.path or "/metrics"
+        if parsed.query:
+            path += "?" + parsed.query
+        conn.request("GET", path, headers={"Accept": accept})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise RuntimeError(f"GET {url}: HTTP {resp.status}")
+        yield from iter(lambda: resp.read(1 << 16), b"")
+    finally:
+        conn.close()
+
+
+def check_scrape(args: argparse.Namespace) -> int:
+    # Two live scrapes `--interval` apart: validate both, diff with the measured interval.
+    scrapes: List[Scrape] = []
+    started: List[float] = []
+    for i in range(2):
+        if i:
+            time.sleep(max(0.0, started[0] + args.interval - time.monotonic()))
+        started.append(time.monotonic())
+        t0 = time.perf_counter()
+        scrapes.append(parse_exposition(_scrape(args.url, args.openmetrics, args.timeout)))
+        _report(f"scrape {i + 1}", scrapes[-1], time.perf_counter() - t0, args.max_problems)
+    diff = diff_scrapes(scrapes[0], scrapes[1], started[1] - started[0])
+    _print_deltas(diff, args.top)
+    print(f"diff: {len(diff.problems)} problems")
+    _print_problems(diff.problems, args.max_problems)
+    return 1 if diff.problems or any(scrape.problems for scrape in scrapes) else 0
+
+
+def check_harness(args: argparse.Namespace) -> int:
+    # Every registry x engine x latency type: two ticks, both formats validated, scrapes diffed,
+    # plus a --backfill --aggregate run (timestamped OpenMetrics) validated the same way and
+    # a series-limit check.
+    services = _parse_csv(args.services)
+    channels = _parse_csv(args.channels)
+    engines = [e for e in _parse_csv(args.engines) if e != "numpy" or np is not None]
+    registries = {"locked": Registry, "sharded": ShardedRegistry}
+    failed = False
+    print(f"{'registry':>8} {'engine':>7} {'latency':>9} {'samples':>8} {'problems':>8}")
+    for (registry_name, engine, latency_type) in itertools.product(
+        _parse_csv(args.registries), engines, _parse_csv(args.latency_types)
+    ):
+        registry = registries[registry_name]()
+        sim = Simulator(
+            registry,
+            services=services,
+            channels=channels,
+            base_qps=args.base_qps,
+            mode=args.mode,
+            engine=engine,
+            seed=args.seed,
+            latency_type=latency_type,
+        )
+        sim.step(args.dt)
+        before = parse_exposition([registry.render_bytes()])
+        sim.step(args.dt)
+        after = parse_exposition(registry.iter_exposition())
+        openmetrics = parse_exposition(registry.iter_exposition(openmetrics=True))
+        diff = diff_scrapes(before, after, args.dt)
+        problems = before.problems + after.problems + [f"openmetrics: {p}" for p in openmetrics.problems]
+        problems += diff.problems
+        if not openmetrics.openmetrics:
+            problems.append("openmetrics: missing # EOF")
+        if args.backfill > 0:
+            problems += [f"backfill: {p}" for p in _harness_backfill(registry_name, engine, latency_type, args)]
+        problems += [f"limits: {p}" for p in _harness_limits(registries[registry_name])]
+        print(f"{registry_name:>8} {engine:>7} {latency_type:>9} {len(after.samples):>8} {len(problems):>8}")
+        _print_problems(problems, args.max_problems)
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+def _harness_backfill(registry_name: str, engine: str, latency_type: str, args: argparse.Namespace) -> List[str]:
+    # Low traffic: this checks the file's shape (ordering, timestamps), not the simulator.
+    registry = ShardedRegistry() if registry_name == "sharded" else Registry()
+    clock = SimClock(1_700_000_000.0)
+    sim = Simulator(
+        registry,
+        services=_parse_csv(args.services),
+        channels=_parse_csv(args.channels),
+        base_qps=1.0,
+        mode=args.mode,
+        engine=engine,
+        seed=args.seed,
+        clock=clock,
+        latency_type=latency_type,
+    )
+    aggregator = Aggregator(registry, windows=(60.0,), resolution=args.dt, clock=clock)
+    fd, path = tempfile.mkstemp(suffix=".om")
+    os.close(fd)
+    try:
+        _backfill(registry, sim, clock, clock.now, clock.now + args.backfill, args.dt, path, aggregator)
+        scrape = _parse_file(path)
+    finally:
+        os.unlink(path)
+    problems = scrape.problems
+    if not scrape.openmetrics:
+        problems.append("missing # EOF")
+    return problems
+
+
+def _harness_limits(registry_cls: type) -> List[str]:
+    # on_limit="reject" with a ttl: a handle rejected while the family is full is admitted
+    # by its next write once the ttl has evicted the series holding the room.
+    now = [0.0]
+    registry = registry_cls()
+    registry.limit_series("limited_total", ttl=10.0, max_series=1, on_limit="reject", clock=lambda: now[0])
+    first = registry.counter("limited_total").labels(k="a")
+    second = registry.counter("limited_total").labels(k="b")
+    first.inc()
+    second.inc()
+    registry.render_bytes()
+    now[0] = 20.0
+    registry.render_bytes()
+    second.inc(5)
+    scrape = parse_exposition([registry.render_bytes()])
+    expected = {
+        ("limited_total", 'k="b"'): 5.0,
+        ("mock_exporter_series_evicted_total", 'metric="limited_total",reason="ttl"'): 1.0,
+        ("mock_exporter_series_rejected_total", 'metric="limited_total"'): 1.0,
+    }
+    problems = list(scrape.problems)
+    for (name, labels), value in expected.items():
+        if scrape.samples.get((name, labels)) != value:
+            problems.append(f"{_series(name, labels)}: expected {value}, got {scrape.samples.get((name, labels))}")
+    if ("limited_total", 'k="a"') in scrape.samples:
+        problems.append('limited_total{k="a"}: exposed after its ttl')
+    return problems
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Validate and diff mock_llm_metrics_server expositions.")
+    parser.add_argument("--max-problems", type=int, default=20, help="Problems printed per scrape, 0 = all")
+    sub = parser.add_subparsers(dest="check", required=True)
+
+    p = sub.add_parser("validate", help="Parse and validate exposition files, e.g. --dump output ('-' = stdin)")
+    p.add_argument("files", nargs="+")
+    p.set_defaults(func=check_validate)
+
+    p = sub.add_parser("diff", help="Validate two consecutive scrapes and print per-series deltas and rates")
+    p.add_argument("before")
+    p.add_argument("after")
+    p.add_argument("--seconds", type=float, default=None, help="Interval between the scrapes (enables rates)")
+    p.add_argument("--top", type=int, default=20, help="Deltas printed, largest first, 0 = all")
+    p.set_defaults(func=check_diff)
+
+    p = sub.add_parser("scrape", help="Scrape a live endpoint twice, validate and diff")
+    p.add_argument("url", nargs="?", default="http://localhost:18080/metrics")
+    p.add_argument("--interval", type=float, default=5.0, help="Seconds between the two scrapes")
+    p.add_argument("--openmetrics", action="store_true", help="Negotiate OpenMetrics instead of text 0.0.4")
+    p.add_argument("--timeout", type=float, default=10.0)
+    p.add_argument("--top", type=int, default=20, help="Deltas printed, largest first, 0 = all")
+    p.set_defaults(func=check_scrape)
+
+    p = sub.add_parser("harness", help="Validate every registry x engine x latency type in-process")
+    p.add_argument("--registries", default="locked,sharded")
+    p.add_argument("--engines", default="python,numpy", help="numpy skipped if missing")
+    p.add_argument("--latency-types", default="histogram,summary")
+    p.add_argument("--services", default="llm-api,llm-batch")
+    p.add_argument("--channels", default="default,openai,azure")
+    p.add_argument("--base-qps", type=float, default=20.0)
+    p.add_argument("--mode", choices=["normal", "stress"], default="stress")
+    p.add_argument("--dt", type=float, default=5.0, help="Simulated seconds per tick")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument(
+        "--backfill", type=_parse_duration, default=300.0, help="Simulated span of the backfill check, 0 = skip"
+    )
+    p.set_defaults(func=check_harness)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,13 +2,62 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import bisect
+import collections
+import datetime
+import fnmatch
+import functools
+import heapq
+import http.client
+import itertools
+import json
 import math
+import mmap
+import multiprocessing
+import os
+import queue
 import random
+import re
+import shutil
+import signal
+import struct
+import sys
+import tempfile
 import threading
 import time
-from dataclasses import dataclass
+import urllib.parse
+import zlib
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Dict, Iterable, List, Mapping, MutableMapping, Optional, Sequence, Tuple
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+try:
+    import numpy as np
+except ImportError:  # optional: only batch/vectorized paths use it
+    np = None  # type: ignore[assignment]
+
+try:
+    import yaml
+except ImportError:  # optional: only YAML --scenario files need it
+    yaml = None  # type: ignore[assignment]
 
 
 Labels = Tuple[Tuple[str, str], ...]
@@ -35,57 +84,486 @@ def _escape_label_value(value: str) -> str:
     return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
 
 
-def _poisson(lam: float) -> int:
+def _escape_help(text: str) -> str:
+    # Text format 0.0.4 HELP; OpenMetrics HELP escapes like a label value (also `"`).
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _poisson(lam: float, rng: random.Random) -> int:
     if lam <= 0:
         return 0
+    if lam >= 10:
+        return _poisson_ptrs(lam, rng)
     # Knuth algorithm; fine for small lam (our default).
     L = math.exp(-lam)
     k = 0
     p = 1.0
     while p > L:
         k += 1
-        p *= random.random()
+        p *= rng.random()
     return k - 1
 
 
+def _poisson_ptrs(lam: float, rng: random.Random) -> int:
+    # Hormann's transformed rejection (PTRS), O(1) expected per draw for lam >= 10.
+    slam = math.sqrt(lam)
+    loglam = math.log(lam)
+    b = 0.931 + 2.53 * slam
+    a = -0.059 + 0.02483 * b
+    invalpha = 1.1239 + 1.1328 / (b - 3.4)
+    vr = 0.9277 - 3.6224 / (b - 2)
+    while True:
+        u = rng.random() - 0.5
+        v = rng.random()
+        us = 0.5 - abs(u)
+        k = math.floor((2 * a / us + b) * u + lam + 0.43)
+        if us >= 0.07 and v <= vr:
+            return k
+        if k < 0 or (us < 0.013 and v > us):
+            continue
+        if math.log(v) + math.log(invalpha) - math.log(a / (us * us) + b) <= -lam + k * loglam - math.lgamma(k + 1):
+            return k
+
+
+# Native (sparse exponential) histograms: with schema s, bucket i covers (base^(i-1), base^i]
+# where base = 2^(2^-s); only non-empty buckets are stored. Exposed via protobuf only.
+NATIVE_SCHEMAS = range(-4, 9)
+_NATIVE_ZERO_THRESHOLD = 2.0**-128  # client_golang default
+
+
+class _NativeLayout(NamedTuple):
+    schema: int
+    zero_threshold: float
+    bounds: Tuple[float, ...]  # frexp() mantissa boundaries, schema > 0 only
+
+
+def _native_layout(schema: int, zero_threshold: float = _NATIVE_ZERO_THRESHOLD) -> _NativeLayout:
+    if schema not in NATIVE_SCHEMAS:
+        raise ValueError(
+            f"native histogram schema must be in [{NATIVE_SCHEMAS[0]}, {NATIVE_SCHEMAS[-1]}], got {schema}"
+        )
+    n = 1 << schema if schema > 0 else 0
+    return _NativeLayout(schema, zero_threshold, tuple(math.ldexp(2.0 ** (i / n), -1) for i in range(n)))
+
+
+def _native_key(layout: _NativeLayout, v: float) -> int:
+    # Index of the bucket holding v > 0 (same arithmetic as client_golang).
+    frac, exp = math.frexp(v)
+    if layout.schema > 0:
+        return bisect.bisect_left(layout.bounds, frac) + (exp - 1) * len(layout.bounds)
+    key = exp - 1 if frac == 0.5 else exp
+    shift = -layout.schema
+    return (key + (1 << shift) - 1) >> shift
+
+
+class _Series:
+    # One exposed label set. `prefixes` holds the pre-encoded "name{labels} " heads of
+    # every exposition line of the series, `line` the last encoded block and `pb` the
+    # protobuf Metric message (None: stale, re-encoded by the next protobuf scrape);
+    # `rw` caches the remote-write label sets of its samples once pushed; `seen` is when
+    # a write was last noticed (families under Registry.limit_series only).
+    __slots__ = ("key", "prefixes", "value", "line", "pb", "rw", "seen", "cells")
+
+    def __init__(self, key: Tuple[str, Labels], prefixes: Tuple[bytes, ...], value: object) -> None:
+        self.key = key
+        self.prefixes = prefixes
+        self.value = value
+        self.line = b""
+        self.pb: Optional[bytes] = None
+        self.rw: Optional[Tuple[bytes, ...]] = None
+        self.seen = 0.0
+        self.cells: Optional[List["_Cell"]] = None
+
+
+def _scalar_prefixes(name: str, labels: Labels) -> Tuple[bytes, ...]:
+    return (f"{name}{_format_labels(labels)} ".encode("utf-8"),)
+
+
+def _histogram_prefixes(name: str, labels: Labels, buckets: Sequence[float]) -> Tuple[bytes, ...]:
+    heads = [f'{name}_bucket{_format_labels((("le", f"{le}"),) + labels)} ' for le in buckets]
+    heads.append(f'{name}_bucket{_format_labels((("le", "+Inf"),) + labels)} ')
+    heads.append(f"{name}_sum{_format_labels(labels)} ")
+    heads.append(f"{name}_count{_format_labels(labels)} ")
+    return tuple(h.encode("utf-8") for h in heads)
+
+
+def _encode_scalar(series: _Series) -> bytes:
+    return series.prefixes[0] + f"{series.value}\n".encode("ascii")
+
+
+def _encode_histogram(series: _Series) -> bytes:
+    state: _HistogramState = series.value  # type: ignore[assignment]
+    prefixes = series.prefixes
+    parts: List[bytes] = []
+    cumulative = 0
+    for idx, count in enumerate(state.raw_bucket_counts):
+        cumulative += count
+        parts.append(prefixes[idx] + f"{cumulative}\n".encode("ascii"))
+    parts.append(prefixes[-2] + f"{state.sum}\n".encode("ascii"))
+    parts.append(prefixes[-1] + f"{state.count}\n".encode("ascii"))
+    return b"".join(parts)
+
+
+def _summary_prefixes(name: str, labels: Labels, quantiles: Sequence[float]) -> Tuple[bytes, ...]:
+    heads = [f'{name}{_format_labels(labels + (("quantile", f"{q}"),))} ' for q in quantiles]
+    heads.append(f"{name}_sum{_format_labels(labels)} ")
+    heads.append(f"{name}_count{_format_labels(labels)} ")
+    return tuple(h.encode("utf-8") for h in heads)
+
+
+def _encode_summary(series: _Series) -> bytes:
+    state: _SummaryState = series.value  # type: ignore[assignment]
+    prefixes = series.prefixes
+    parts = [
+        prefixes[idx] + (b"NaN\n" if v != v else f"{v}\n".encode("ascii"))
+        for idx, v in enumerate(state.quantiles())
+    ]
+    parts.append(prefixes[-2] + f"{state.sum}\n".encode("ascii"))
+    parts.append(prefixes[-1] + f"{state.count}\n".encode("ascii"))
+    return b"".join(parts)
+
+
+class CounterChild:
+    # Pre-bound handle to one series: no label normalization or key hashing per call.
+    __slots__ = ("_series", "_lock", "_dirty")
+
+    def __init__(self, registry: "Registry", series: _Series) -> None:
+        self._series = series
+        self._lock = registry._lock
+        self._dirty = registry._dirty_scalars
+
+    def inc(self, value: float = 1.0) -> None:
+        with self._lock:
+            self._series.value += value
+            self._dirty.add(self._series)
+
+
+class GaugeChild:
+    __slots__ = ("_series", "_lock", "_dirty")
+
+    def __init__(self, registry: "Registry", series: _Series) -> None:
+        self._series = series
+        self._lock = registry._lock
+        self._dirty = registry._dirty_scalars
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._series.value = float(value)
+            self._dirty.add(self._series)
+
+
+class HistogramChild:
+    __slots__ = ("_series", "_lock", "_dirty")
+
+    def __init__(self, registry: "Registry", series: _Series) -> None:
+        self._series = series
+        self._lock = registry._lock
+        self._dirty = registry._dirty_histograms
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._series.value.observe(value)
+            self._dirty.add(self._series)
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        with self._lock:
+            self._series.value.observe_many(values)
+            self._dirty.add(self._series)
+
+
+class SummaryChild:
+    __slots__ = ("_series", "_lock", "_dirty")
+
+    def __init__(self, registry: "Registry", series: _Series) -> None:
+        self._series = series
+        self._lock = registry._lock
+        self._dirty = registry._dirty_summaries
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._series.value.observe(value)
+            self._dirty.add(self._series)
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        with self._lock:
+            self._series.value.observe_many(values)
+            self._dirty.add(self._series)
+
+
+class _RejectedChild:
+    # Handle to a series a "reject" series limit turned away. Every write retries admission
+    # (a dropped write is counted); once there is room it binds a real child and forwards.
+    __slots__ = ("_registry", "_kind", "_key", "_child")
+
+    def __init__(self, registry: "Registry", kind: str, key: Tuple[str, Labels]) -> None:
+        self._registry = registry
+        self._kind = kind
+        self._key = key
+        self._child: Optional[Any] = None
+
+    def inc(self, value: float = 1.0) -> None:
+        child = self._child or self._registry._readmit(self)
+        if child is not None:
+            child.inc(value)
+
+    def set(self, value: float) -> None:
+        child = self._child or self._registry._readmit(self)
+        if child is not None:
+            child.set(value)
+
+    def observe(self, value: float) -> None:
+        child = self._child or self._registry._readmit(self)
+        if child is not None:
+            child.observe(value)
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        child = self._child or self._registry._readmit(self, len(values))
+        if child is not None:
+            child.observe_many(values)
+
+
+_C = TypeVar("_C")
+
+
+class MetricFamily(Generic[_C]):
+    __slots__ = ("_make_child", "_children")
+
+    def __init__(self, make_child: Callable[[Labels], _C]) -> None:
+        self._make_child = make_child
+        self._children: Dict[Labels, _C] = {}
+
+    def labels(self, **labels: str) -> _C:
+        key = _normalize_labels(labels)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._make_child(key))
+        return child
+
+
+SERIES_LIMIT_POLICIES = ("evict", "reject")
+_SERIES_KINDS = ("counter", "gauge", "histogram", "summary")
+_SINK_LABELS: Labels = (("", ""),)  # not a valid label name, so never a real series key
+
+
+class _SeriesLimit:
+    # Per-family state of a Registry.limit_series rule. `order` is LRU order (least recently
+    # written first) of the admitted series; `sink` absorbs by-name writes to rejected series,
+    # and `stray` is set once the families may hold _RejectedChild handles.
+    __slots__ = ("ttl", "max_series", "on_limit", "clock", "order", "table", "sink", "stray")
+
+    def __init__(self, ttl: Optional[float], max_series: Optional[int], on_limit: str, clock: Callable[[], float]):
+        self.ttl = ttl
+        self.max_series = max_series
+        self.on_limit = on_limit
+        self.clock = clock
+        self.order: "collections.OrderedDict[Labels, _Series]" = collections.OrderedDict()
+        self.table: Optional[Dict[Tuple[str, Labels], _Series]] = None
+        self.sink: Optional[_Series] = None
+        self.stray = False
+
+
 class Registry:
     def __init__(self) -> None:
         self._lock = threading.RLock()
         self._help: Dict[str, str] = {}
         self._type: Dict[str, str] = {}
 
-        self._counters: Dict[Tuple[str, Labels], float] = {}
-        self._gauges: Dict[Tuple[str, Labels], float] = {}
-        self._histograms: Dict[Tuple[str, Labels], "_HistogramState"] = {}
-        self._histogram_buckets: Dict[str, List[float]] = {}
+        self._counters: Dict[Tuple[str, Labels], _Series] = {}
+        self._gauges: Dict[Tuple[str, Labels], _Series] = {}
+        self._histograms: Dict[Tuple[str, Labels], _Series] = {}
+        self._histogram_buckets: Dict[str, Tuple[float, ...]] = {}
+        self._histogram_native: Dict[str, _NativeLayout] = {}
+        self._summaries: Dict[Tuple[str, Labels], _Series] = {}
+        self._summary_configs: Dict[str, _SummaryConfig] = {}
+        self._summary_epochs: Dict[str, int] = {}
+        self._families: Dict[Tuple[str, str], MetricFamily] = {}
+        # (pattern, ttl, max_series, on_limit, clock) rules, and the resolved state per name.
+        self._limits: List[Tuple[str, Optional[float], Optional[int], str, Callable[[], float]]] = []
+        self._limit_states: Dict[str, Optional[_SeriesLimit]] = {}
+
+        # Exposition cache: only series touched since the last scrape are re-encoded,
+        # the full payload is re-joined only when something changed.
+        self._dirty_scalars: Set[_Series] = set()
+        self._dirty_histograms: Set[_Series] = set()
+        self._dirty_summaries: Set[_Series] = set()
+        self._layout: Optional[List[_FamilyLayout]] = None
+        self._payload: Optional[bytes] = None
 
     def set_help(self, name: str, text: str) -> None:
         with self._lock:
             self._help[name] = text
+            self._layout = None
 
     def set_type(self, name: str, metric_type: str) -> None:
         with self._lock:
             self._type[name] = metric_type
+            self._layout = None
 
-    def define_histogram(self, name: str, buckets: Sequence[float], help_text: str) -> None:
+    def define_histogram(
+        self,
+        name: str,
+        buckets: Sequence[float],
+        help_text: str,
+        native_schema: Optional[int] = None,
+        zero_threshold: float = _NATIVE_ZERO_THRESHOLD,
+    ) -> None:
+        # `native_schema` adds sparse exponential buckets (protobuf exposition only);
+        # `buckets` may then be empty for a native-only histogram.
+        native = _native_layout(native_schema, zero_threshold) if native_schema is not None else None
         with self._lock:
-            self._histogram_buckets[name] = list(buckets)
+            self._histogram_buckets[name] = tuple(sorted(buckets))
+            if native is not None:
+                self._histogram_native[name] = native
+            else:
+                self._histogram_native.pop(name, None)
             self._help[name] = help_text
             self._type[name] = "histogram"
+            self._layout = None
+
+    def define_summary(
+        self,
+        name: str,
+        help_text: str,
+        *,
+        quantiles: Sequence[float] = (0.5, 0.9, 0.99),
+        max_age: float = 600.0,
+        age_buckets: int = 5,
+        relative_accuracy: float = 0.01,
+        max_bins: int = 2048,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        # Sketch-backed summary: quantiles over the last `max_age` seconds of `clock`, each
+        # within `relative_accuracy` of a real observation (while under `max_bins` buckets).
+        config = _summary_config(quantiles, max_age, age_buckets, relative_accuracy, max_bins, clock)
+        with self._lock:
+            self._summary_configs[name] = config
+            self._summary_epochs[name] = config.epoch()
+            self._help[name] = help_text
+            self._type[name] = "summary"
+            self._layout = None
+
+    def limit_series(
+        self,
+        pattern: str,
+        *,
+        ttl: Optional[float] = None,
+        max_series: Optional[int] = None,
+        on_limit: str = "evict",
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        # Bounds every family whose name matches `pattern` (fnmatch; the first matching rule
+        # wins, mock_exporter_* is exempt): series not written for `ttl` seconds of `clock` are
+        # dropped at the next refresh, and a new series beyond `max_series` either evicts the
+        # least recently written one ("evict") or has its writes dropped ("reject").
+        if on_limit not in SERIES_LIMIT_POLICIES:
+            raise ValueError(f"unknown on_limit '{on_limit}'")
+        if ttl is None and max_series is None:
+            raise ValueError("limit_series needs ttl and/or max_series")
+        if (ttl is not None and not ttl > 0) or (max_series is not None and max_series < 1):
+            raise ValueError("ttl must be > 0 and max_series >= 1")
+        with self._lock:
+            self._limits.append((pattern, ttl, max_series, on_limit, clock))
+            self._help.setdefault("mock_exporter_series_evicted_total", "Series dropped by a series limit.")
+            self._type.setdefault("mock_exporter_series_evicted_total", "counter")
+            self._help.setdefault(
+                "mock_exporter_series_rejected_total", "Writes dropped because their series was over a series limit."
+            )
+            self._type.setdefault("mock_exporter_series_rejected_total", "counter")
+            self._layout = None
+            # Re-resolve every family; series that already exist are admitted oldest first.
+            self._limit_states = {}
+            for table in (self._counters, self._gauges, self._histograms, self._summaries):
+                for key, series in list(table.items()):
+                    limit = self._series_limit(key[0])
+                    if limit is None:
+                        continue
+                    limit.table = table
+                    limit.order[key[1]] = series
+                    series.seen = limit.clock()
+                    if limit.max_series is not None and len(limit.order) > limit.max_series:
+                        self._evict(limit, next(iter(limit.order.values())), "lru")
+
+    def _series_limit(self, name: str) -> Optional[_SeriesLimit]:
+        if name in self._limit_states:
+            return self._limit_states[name]
+        limit = None
+        if not name.startswith("mock_exporter_"):
+            for pattern, ttl, max_series, on_limit, clock in self._limits:
+                if fnmatch.fnmatchcase(name, pattern):
+                    limit = _SeriesLimit(ttl, max_series, on_limit, clock)
+                    break
+        self._limit_states[name] = limit
+        return limit
+
+    def counter(self, name: str) -> MetricFamily[CounterChild]:
+        return self._family(name, "counter")
+
+    def gauge(self, name: str) -> MetricFamily[GaugeChild]:
+        return self._family(name, "gauge")
+
+    def histogram(self, name: str) -> MetricFamily[HistogramChild]:
+        return self._family(name, "histogram")
+
+    def summary(self, name: str) -> MetricFamily[SummaryChild]:
+        return self._family(name, "summary")
+
+    def _family(self, name: str, kind: str) -> MetricFamily:
+        with self._lock:
+            family = self._families.get((name, kind))
+            if family is None:
+                family = MetricFamily(functools.partial(self._child, name, kind))
+                self._families[(name, kind)] = family
+            return family
+
+    def _child(self, name: str, kind: str, labels: Labels) -> object:
+        with self._lock:
+            series = self._get_series((name, labels), kind, write=False)
+            if series.key[1] is _SINK_LABELS:
+                return _RejectedChild(self, kind, (name, labels))
+            return self._new_child(kind, series)
+
+    def _new_child(self, kind: str, series: _Series) -> object:
+        if kind == "counter":
+            return CounterChild(self, series)
+        if kind == "gauge":
+            return GaugeChild(self, series)
+        if kind == "summary":
+            return SummaryChild(self, series)
+        return HistogramChild(self, series)
+
+    def _readmit(self, handle: _RejectedChild, writes: int = 1) -> Optional[object]:
+        # A write through a rejected handle: the series is admitted if its limit now has room.
+        with self._lock:
+            series = self._get_series(handle._key, handle._kind)
+            if series.key[1] is _SINK_LABELS:
+                if writes > 1:
+                    self._reject(handle._key[0], writes - 1)
+                return None
+            handle._child = self._new_child(handle._kind, series)
+            return handle._child
+
+    def _get_series(self, key: Tuple[str, Labels], kind: str, write: bool = True) -> _Series:
+        # `write`: the caller writes the series now, so a rejection counts as a dropped write.
+        if kind == "histogram":
+            return self._histograms.get(key) or self._new_histogram(key, write)
+        if kind == "summary":
+            return self._summaries.get(key) or self._new_summary(key, write)
+        table = self._counters if kind == "counter" else self._gauges
+        return table.get(key) or self._new_scalar(table, key, kind, write)
 
     def inc_counter(self, name: str, value: float = 1.0, labels: Mapping[str, str] | None = None) -> None:
         key = (name, _normalize_labels(labels))
         with self._lock:
-            self._help.setdefault(name, name)
-            self._type.setdefault(name, "counter")
-            self._counters[key] = self._counters.get(key, 0.0) + float(value)
+            series = self._counters.get(key) or self._new_scalar(self._counters, key, "counter")
+            series.value += float(value)
+            self._dirty_scalars.add(series)
 
     def set_gauge(self, name: str, value: float, labels: Mapping[str, str] | None = None) -> None:
         key = (name, _normalize_labels(labels))
         with self._lock:
-            self._help.setdefault(name, name)
-            self._type.setdefault(name, "gauge")
-            self._gauges[key] = float(value)
+            series = self._gauges.get(key) or self._new_scalar(self._gauges, key, "gauge")
+            series.value = float(value)
+            self._dirty_scalars.add(series)
 
     def observe_histogram(
         self,
@@ -95,390 +573,3434 @@ class Registry:
     ) -> None:
         key = (name, _normalize_labels(labels))
         with self._lock:
-            buckets = self._histogram_buckets.get(name)
-            if buckets is None:
-                raise KeyError(f"Histogram '{name}' not defined")
-            state = self._histograms.get(key)
-            if state is None:
-                state = _HistogramState.from_buckets(buckets)
-                self._histograms[key] = state
-            state.observe(value)
+            series = self._histograms.get(key) or self._new_histogram(key)
+            series.value.observe(value)
+            self._dirty_histograms.add(series)
 
-    def render(self) -> str:
+    def observe_summary(
+        self,
+        name: str,
+        value: float,
+        labels: Mapping[str, str] | None = None,
+    ) -> None:
+        key = (name, _normalize_labels(labels))
         with self._lock:
-            lines: List[str] = []
-
-            # HELP/TYPE (stable-ish order).
-            all_names = sorted(set(self._help) | set(self._type))
-            for name in all_names:
-                help_text = self._help.get(name)
-                if help_text:
-                    lines.append(f"# HELP {name} {help_text}")
-                metric_type = self._type.get(name)
-                if metric_type:
-                    lines.append(f"# TYPE {name} {metric_type}")
-
-            # Counters.
-            for (name, labels), value in sorted(self._counters.items()):
-                lines.append(f"{name}{_format_labels(labels)} {value}")
-
-            # Gauges.
-            for (name, labels), value in sorted(self._gauges.items()):
-                lines.append(f"{name}{_format_labels(labels)} {value}")
-
-            # Histograms.
-            for (name, labels), state in sorted(self._histograms.items()):
-                buckets = self._histogram_buckets[name]
-                cumulative = 0
-                for idx, le in enumerate(buckets):
-                    cumulative += state.raw_bucket_counts[idx]
-                    lines.append(
-                        f'{name}_bucket{_format_labels((("le", f"{le}"),) + labels)} {cumulative}'
-                    )
-                cumulative += state.raw_bucket_counts[len(buckets)]
-                lines.append(f'{name}_bucket{_format_labels((("le", "+Inf"),) + labels)} {cumulative}')
-                lines.append(f"{name}_sum{_format_labels(labels)} {state.sum}")
-                lines.append(f"{name}_count{_format_labels(labels)} {state.count}")
-
-            return "\n".join(lines) + "\n"
+            series = self._summaries.get(key) or self._new_summary(key)
+            series.value.observe(value)
+            self._dirty_summaries.add(series)
 
+    def _counter_values(self, names: Set[str]) -> Dict[Tuple[str, Labels], float]:
+        # Current value of every counter series of the `names` families.
+        with self._lock:
+            self._collect()
+            return {key: series.value for key, series in self._counters.items() if key[0] in names}
 
-@dataclass
-class _HistogramState:
-    buckets: List[float]
-    raw_bucket_counts: List[int]
-    sum: float = 0.0
-    count: int = 0
+    def _publish_gauges(
+        self,
+        name: str,
+        help_text: str,
+        values: Mapping[Labels, float],
+        previous: Set[Labels],
+    ) -> Set[Labels]:
+        # Makes gauge family `name` hold exactly `values`: label sets in `previous` but not
+        # in `values` are removed. Writes the base tables directly, so sharded and
+        # multi-process registries (whose _collect never touches these series) work too.
+        with self._lock:
+            if self._help.get(name) != help_text or self._type.get(name) != "gauge":
+                self._help[name] = help_text
+                self._type[name] = "gauge"
+                self._layout = None
+            for labels, value in values.items():
+                key = (name, labels)
+                series = self._gauges.get(key) or self._new_scalar(self._gauges, key, "gauge")
+                # Dirty even if unchanged: a series limit's ttl counts from the last write.
+                series.value = value
+                self._dirty_scalars.add(series)
+            stale = previous.difference(values)
+            limit = self._series_limit(name) if self._limits else None
+            for labels in stale:
+                series = self._gauges.pop((name, labels), None)
+                if series is not None:
+                    self._dirty_scalars.discard(series)
+                    if limit is not None and limit.order.get(labels) is series:
+                        del limit.order[labels]
+            if stale:
+                self._layout = None
+        return set(values)
 
-    @classmethod
-    def from_buckets(cls, buckets: Sequence[float]) -> "_HistogramState":
-        return cls(buckets=list(buckets), raw_bucket_counts=[0] * (len(buckets) + 1))
+    def _new_scalar(
+        self,
+        table: Dict[Tuple[str, Labels], _Series],
+        key: Tuple[str, Labels],
+        metric_type: str,
+        write: bool = True,
+    ) -> _Series:
+        name = key[0]
+        if name not in self._help or name not in self._type:
+            self._help.setdefault(name, name)
+            self._type.setdefault(name, metric_type)
+            self._layout = None
+        return self._insert(table, _Series(key, _scalar_prefixes(name, key[1]), 0.0), self._dirty_scalars, write)
 
-    def observe(self, value: float) -> None:
-        v = float(value)
-        idx = len(self.buckets)
-        for i, le in enumerate(self.buckets):
-            if v <= le:
-                idx = i
-                break
-        self.raw_bucket_counts[idx] += 1
-        self.sum += v
-        self.count += 1
+    def _new_histogram(self, key: Tuple[str, Labels], write: bool = True) -> _Series:
+        name = key[0]
+        buckets = self._histogram_buckets.get(name)
+        if buckets is None:
+            raise KeyError(f"Histogram '{name}' not defined")
+        series = _Series(
+            key,
+            _histogram_prefixes(name, key[1], buckets),
+            _HistogramState.from_buckets(buckets, self._histogram_native.get(name)),
+        )
+        return self._insert(self._histograms, series, self._dirty_histograms, write)
 
+    def _new_summary(self, key: Tuple[str, Labels], write: bool = True) -> _Series:
+        name = key[0]
+        config = self._summary_configs.get(name)
+        if config is None:
+            raise KeyError(f"Summary '{name}' not defined")
+        series = _Series(key, _summary_prefixes(name, key[1], config.quantiles), _SummaryState(config))
+        return self._insert(self._summaries, series, self._dirty_summaries, write)
 
-class Simulator:
-    def __init__(
+    def _insert(
         self,
-        registry: Registry,
-        *,
-        services: Sequence[str],
-        channels: Sequence[str],
-        base_qps: float,
-        mode: str,
-    ) -> None:
-        self._r = registry
-        self._services = list(services)
-        self._channels = list(channels)
-        self._base_qps = float(base_qps)
-        self._mode = mode
+        table: Dict[Tuple[str, Labels], _Series],
+        series: _Series,
+        dirty: Set[_Series],
+        write: bool = True,
+    ) -> _Series:
+        limit = self._series_limit(series.key[0]) if self._limits else None
+        if limit is not None and not self._admit(limit, table, series):
+            # Rejected: the caller gets the family's sink, which is never exposed.
+            if write:
+                self._count_limit("mock_exporter_series_rejected_total", (("metric", series.key[0]),))
+            if limit.sink is None:
+                series.key = (series.key[0], _SINK_LABELS)
+                limit.sink = series
+            limit.stray = True
+            return limit.sink
+        table[series.key] = series
+        dirty.add(series)
+        self._layout = None
+        return series
 
-        self._lock = threading.RLock()
-        self._inflight_by_service: Dict[str, List[float]] = {s: [] for s in self._services}
-        self._mq_waiting = 0.0
+    def _admit(self, limit: _SeriesLimit, table: Dict[Tuple[str, Labels], _Series], series: _Series) -> bool:
+        # Must hold self._lock. Tracks `series` under `limit`, making room if the policy allows.
+        name, labels = series.key
+        if limit.max_series is not None and len(limit.order) >= limit.max_series:
+            if limit.on_limit == "reject":
+                return False
+            self._evict(limit, next(iter(limit.order.values())), "lru")
+        limit.table = table
+        limit.order[labels] = series
+        series.seen = limit.clock()
+        return True
 
-        # Histogram definitions (buckets can be adjusted to your实际分布).
-        self._r.define_histogram(
-            "llm_record_mq_write_duration_seconds",
-            buckets=[0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2],
-            help_text="Gateway MQ write duration (seconds).",
-        )
-        self._r.define_histogram(
-            "llm_request_duration",
-            buckets=[0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, 120],
-            help_text="End-to-end request duration (seconds).",
-        )
-        self._r.define_histogram(
-            "llm_ttft",
-            buckets=[0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10],
-            help_text="Time to first token (seconds).",
-        )
-        self._r.define_histogram(
-            "llm_otps",
-            buckets=[5, 10, 20, 30, 50, 80, 120, 200, 400, 800],
-            help_text="Output tokens per second (tokens/s).",
-        )
-        self._r.define_histogram(
-            "llm_tpot",
-            buckets=[0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1],
-            help_text="Time per output token (seconds/token).",
-        )
+    def _evict(self, limit: _SeriesLimit, series: _Series, reason: str) -> None:
+        # Must hold self._lock. Children still bound to `series` keep writing it; such a write
+        # re-admits it at the next refresh (see _apply_limits).
+        name, labels = series.key
+        del limit.order[labels]
+        if limit.table is not None and limit.table.get(series.key) is series:
+            del limit.table[series.key]
+        self._dirty_scalars.discard(series)
+        self._dirty_histograms.discard(series)
+        self._dirty_summaries.discard(series)
+        for kind in _SERIES_KINDS:
+            family = self._families.get((name, kind))
+            if family is not None and getattr(family._children.get(labels), "_series", None) is series:
+                del family._children[labels]
+        self._forget(series)
+        self._layout = None
+        self._count_limit("mock_exporter_series_evicted_total", (("metric", name), ("reason", reason)))
 
-        # Help/type for other metrics.
-        self._r.set_help("llm_request_count", "Total requests.")
-        self._r.set_type("llm_request_count", "counter")
-        self._r.set_help("channel_llm_request_count", "Total requests by channel.")
-        self._r.set_type("channel_llm_request_count", "counter")
+    def _forget(self, series: _Series) -> None:
+        # Hook for registries caching series outside the tables and families.
+        return
 
-        self._r.set_help("llm_request_count_by_token_bucket", "Requests bucketed by token length.")
-        self._r.set_type("llm_request_count_by_token_bucket", "counter")
-        self._r.set_help(
-            "channel_llm_request_count_by_token_bucket", "Requests bucketed by token length (channel)."
-        )
-        self._r.set_type("channel_llm_request_count_by_token_bucket", "counter")
+    def _count_limit(self, name: str, labels: Labels, value: float = 1.0) -> None:
+        # Written to the base table directly, like _publish_gauges.
+        key = (name, labels)
+        series = self._counters.get(key) or self._new_scalar(self._counters, key, "counter")
+        series.value += value
+        self._dirty_scalars.add(series)
 
-        self._r.set_help("llm_total_tokens", "Total tokens consumed.")
-        self._r.set_type("llm_total_tokens", "counter")
-        self._r.set_help("llm_input_tokens", "Input tokens consumed.")
-        self._r.set_type("llm_input_tokens", "counter")
-        self._r.set_help("llm_output_tokens", "Output tokens produced.")
-        self._r.set_type("llm_output_tokens", "counter")
-        self._r.set_help("llm_total_tokens_by_token_bucket", "Total tokens bucketed by token length.")
-        self._r.set_type("llm_total_tokens_by_token_bucket", "counter")
+    def _reject(self, name: str, writes: int = 1) -> None:
+        with self._lock:
+            self._count_limit("mock_exporter_series_rejected_total", (("metric", name),), writes)
 
-        self._r.set_help("llm_chat_handler_active_count", "In-flight request count.")
-        self._r.set_type("llm_chat_handler_active_count", "gauge")
+    def _apply_limits(self) -> None:
+        # Must hold self._lock; runs after _collect, before dirty series are re-encoded. A dirty
+        # series counts as written now: tracked ones move to the LRU tail, evicted ones that
+        # were written again are re-admitted (value kept) if their key is still free.
+        if not self._limits:
+            return
+        for dirty in (self._dirty_scalars, self._dirty_histograms, self._dirty_summaries):
+            for series in list(dirty):
+                limit = self._series_limit(series.key[0])
+                if limit is None or series is limit.sink:
+                    continue
+                labels = series.key[1]
+                if limit.order.get(labels) is series:
+                    limit.order.move_to_end(labels)
+                    series.seen = limit.clock()
+                elif limit.table is not None and series.key not in limit.table:
+                    if self._admit(limit, limit.table, series):
+                        limit.table[series.key] = series
+                        self._layout = None
+                    else:
+                        # The writes since the last refresh are not told apart: they count as one.
+                        dirty.discard(series)
+                        self._count_limit("mock_exporter_series_rejected_total", (("metric", series.key[0]),))
+                else:
+                    dirty.discard(series)
+        for limit in list(self._limit_states.values()):
+            if limit is None:
+                continue
+            if limit.stray:
+                limit.stray = False
+                for kind in _SERIES_KINDS:
+                    family = self._families.get((limit.sink.key[0], kind))
+                    if family is not None:
+                        for labels, child in list(family._children.items()):
+                            if isinstance(child, _RejectedChild):
+                                del family._children[labels]
+            if limit.ttl is not None and limit.order:
+                deadline = limit.clock() - limit.ttl
+                while limit.order:
+                    series = next(iter(limit.order.values()))
+                    if series.seen > deadline:
+                        break
+                    self._evict(limit, series, "ttl")
 
-        self._r.set_help("llm_record_mq_write_waiting", "Waiting MQ write backlog.")
-        self._r.set_type("llm_record_mq_write_waiting", "gauge")
-        self._r.set_help("llm_record_mq_write_error_count", "MQ write errors (counter).")
-        self._r.set_type("llm_record_mq_write_error_count", "counter")
-        self._r.set_help("llm_record_temp_store_write_error_count", "Temp store write errors (counter).")
-        self._r.set_type("llm_record_temp_store_write_error_count", "counter")
-        self._r.set_help("llm_record_mq_write_retry_count", "MQ write retries (counter).")
-        self._r.set_type("llm_record_mq_write_retry_count", "counter")
+    def _collect(self) -> None:
+        # Hook for registries that accumulate outside `_counters`/`_gauges`/`_histograms`.
+        return
 
-    def step(self, dt_seconds: float) -> None:
-        now = _now()
-
-        # Mode knobs: use --mode stress to快速触发告警阈值。
-        if self._mode == "stress":
-            error_prob = 0.10
-            client_cancel_prob = 0.08  # 客户端取消请求概率（499）
-            mq_error_prob = 0.05
-            temp_store_error_prob = 0.30
-            retry_prob = 0.30
-            avg_ttft = 1.2
-            avg_otps = 12.0
-            mq_capacity_per_sec = 2.0
-            mq_write_scale = 0.8
-        else:
-            error_prob = 0.01
-            client_cancel_prob = 0.03  # 客户端取消请求概率（499）
-            mq_error_prob = 0.002
-            temp_store_error_prob = 0.05
-            retry_prob = 0.05
-            avg_ttft = 0.15
-            avg_otps = 60.0
-            mq_capacity_per_sec = 200.0
-            mq_write_scale = 0.02
-
-        produced_total = 0
-
-        for service in self._services:
-            for channel in self._channels:
-                req_n = _poisson(self._base_qps * dt_seconds)
-                produced_total += req_n
-                for _ in range(req_n):
-                    self._emit_one_request(
-                        now=now,
-                        service=service,
-                        channel=channel,
-                        error_prob=error_prob,
-                        client_cancel_prob=client_cancel_prob,
-                        avg_ttft=avg_ttft,
-                        avg_otps=avg_otps,
-                        mq_error_prob=mq_error_prob,
-                        temp_store_error_prob=temp_store_error_prob,
-                        retry_prob=retry_prob,
-                        mq_write_scale=mq_write_scale,
-                    )
+    def render(self) -> str:
+        return self.render_bytes().decode("utf-8")
 
-        # MQ backlog gauge (simple queue model).
+    def render_bytes(self) -> bytes:
         with self._lock:
-            self._mq_waiting += produced_total
-            consumed = min(self._mq_waiting, mq_capacity_per_sec * dt_seconds)
-            self._mq_waiting -= consumed
-            self._r.set_gauge("llm_record_mq_write_waiting", self._mq_waiting)
+            layout = self._refresh()
+            if self._payload is None:
+                self._payload = b"".join(
+                    family.header + b"".join(series.line for series in family.series) for family in layout
+                )
+            return self._payload
 
-        # Active in-flight gauge by service.
+    def iter_exposition(self, *, openmetrics: bool = False, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        # Streams the cached per-series lines in ~chunk_size pieces without joining the
+        # whole payload. Only the layout is read under the lock: it is rebuilt, never
+        # mutated in place, and each `series.line` is an immutable bytes object.
         with self._lock:
-            for service, end_times in self._inflight_by_service.items():
-                # prune
-                i = 0
-                while i < len(end_times):
-                    if end_times[i] <= now:
-                        end_times.pop(i)
-                    else:
-                        i += 1
-                self._r.set_gauge("llm_chat_handler_active_count", len(end_times), labels={"service": service})
+            layout = self._refresh()
+        parts: List[bytes] = []
+        size = 0
+        for family in layout:
+            header = family.om_header if openmetrics else family.header
+            parts.append(header)
+            size += len(header)
+            for series in family.series:
+                line = series.line
+                parts.append(line)
+                size += len(line)
+                if size >= chunk_size:
+                    yield b"".join(parts)
+                    parts = []
+                    size = 0
+        if openmetrics:
+            parts.append(b"# EOF\n")
+        if parts:
+            yield b"".join(parts)
 
-    def _emit_one_request(
-        self,
-        *,
-        now: float,
-        service: str,
-        channel: str,
-        error_prob: float,
-        client_cancel_prob: float,
-        avg_ttft: float,
-        avg_otps: float,
-        mq_error_prob: float,
-        temp_store_error_prob: float,
-        retry_prob: float,
-        mq_write_scale: float,
-    ) -> None:
-        # 状态码生成逻辑：先判断客户端取消，再判断服务器错误
-        r = random.random()
-        if r < client_cancel_prob:
-            status_code = "499"  # 客户端取消请求
-        elif r < client_cancel_prob + error_prob:
-            status_code = "500"  # 服务器错误
-        else:
-            status_code = "200"  # 正常响应
+    def iter_protobuf(self, *, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        # Length-delimited io.prometheus.client.MetricFamily messages. Series touched since
+        # the last protobuf scrape are re-encoded under the lock (values may be mutated in
+        # place); framing and chunking happen outside it.
+        with self._lock:
+            layout = self._refresh()
+            families: List[Tuple[bytes, List[bytes]]] = []
+            for family in layout:
+                if not family.series:
+                    continue
+                metrics = []
+                for series in family.series:
+                    if series.pb is None:
+                        series.pb = _pb_metric(series, family.pb_type)
+                    metrics.append(series.pb)
+                families.append((family.pb_header, metrics))
+        parts: List[bytes] = []
+        size = 0
+        for header, metrics in families:
+            message = header + b"".join(metrics)
+            parts.append(_pb_varint(len(message)))
+            parts.append(message)
+            size += len(message)
+            if size >= chunk_size:
+                yield b"".join(parts)
+                parts = []
+                size = 0
+        if parts:
+            yield b"".join(parts)
 
-        input_tokens, output_tokens = self._sample_tokens()
-        total_tokens = input_tokens + output_tokens
-        token_bucket = self._token_bucket(total_tokens)
+    def _samples(self) -> List[Tuple[Tuple[bytes, ...], List[float]]]:
+        # (remote-write label sets, values) of every series, values read under the lock.
+        with self._lock:
+            layout = self._refresh()
+            out = []
+            for family in layout:
+                for series in family.series:
+                    if series.rw is None:
+                        series.rw = _rw_label_sets(series)
+                    out.append((series.rw, _sample_values(series.value)))
+            return out
 
-        # QPS counters.
-        self._r.inc_counter("llm_request_count", 1, labels={"service": service, "status_code": status_code})
-        self._r.inc_counter(
-            "channel_llm_request_count",
-            1,
-            labels={"service": service, "channel": channel, "status_code": status_code},
-        )
+    def _refresh(self) -> List["_FamilyLayout"]:
+        # Must hold self._lock. Re-encodes dirty series and rebuilds the family layout
+        # if metadata or the series set changed.
+        self._collect()
+        self._apply_limits()
+        if self._dirty_scalars:
+            for series in self._dirty_scalars:
+                series.line = _encode_scalar(series)
+                series.pb = None
+            self._dirty_scalars.clear()
+            self._payload = None
+        if self._dirty_histograms:
+            for series in self._dirty_histograms:
+                series.line = _encode_histogram(series)
+                series.pb = None
+            self._dirty_histograms.clear()
+            self._payload = None
+        if self._summary_configs:
+            # Window rotation changes quantiles without any observation.
+            rotated = {
+                name for name, config in self._summary_configs.items() if config.epoch() != self._summary_epochs[name]
+            }
+            if rotated:
+                for name in rotated:
+                    self._summary_epochs[name] = self._summary_configs[name].epoch()
+                self._dirty_summaries.update(s for key, s in self._summaries.items() if key[0] in rotated)
+        if self._dirty_summaries:
+            for series in self._dirty_summaries:
+                series.line = _encode_summary(series)
+                series.pb = None
+            self._dirty_summaries.clear()
+            self._payload = None
 
-        self._r.inc_counter(
-            "llm_request_count_by_token_bucket",
-            1,
-            labels={"service": service, "token_bucket": token_bucket},
-        )
-        self._r.inc_counter(
-            "channel_llm_request_count_by_token_bucket",
-            1,
-            labels={"service": service, "channel": channel, "token_bucket": token_bucket},
-        )
+        if self._layout is None:
+            by_name: Dict[str, List[_Series]] = {}
+            for table in (self._counters, self._gauges, self._histograms, self._summaries):
+                for key, series in table.items():
+                    by_name.setdefault(key[0], []).append(series)
+            layout: List[_FamilyLayout] = []
+            for name in sorted(set(self._help) | set(self._type) | set(by_name)):
+                series_list = sorted(by_name.get(name, ()), key=lambda series: series.key)
+                layout.append(_family_layout(name, self._help.get(name), self._type.get(name), series_list))
+            self._layout = layout
+            self._payload = None
+        return self._layout
 
-        # Token counters.
-        self._r.inc_counter("llm_input_tokens", input_tokens, labels={"service": service, "channel": channel})
-        self._r.inc_counter("llm_output_tokens", output_tokens, labels={"service": service, "channel": channel})
-        self._r.inc_counter("llm_total_tokens", total_tokens, labels={"service": service, "channel": channel})
-        self._r.inc_counter(
-            "llm_total_tokens_by_token_bucket",
-            total_tokens,
-            labels={"service": service, "channel": channel, "token_bucket": token_bucket},
-        )
 
-        # Latency / UX histograms.
-        ttft = max(0.01, random.expovariate(1.0 / avg_ttft))
-        otps = max(1.0, random.lognormvariate(math.log(avg_otps), 0.35))
-        tpot = 1.0 / otps
-        gen_time = output_tokens * tpot
-        overhead = random.uniform(0.01, 0.08)
-        total_duration = ttft + gen_time + overhead
+class _FamilyLayout(NamedTuple):
+    name: str
+    header: bytes  # HELP/TYPE lines, Prometheus text format 0.0.4
+    om_header: bytes  # TYPE/HELP lines, OpenMetrics 1.0
+    series: List[_Series]
+    pb_header: bytes  # MetricFamily name/help/type fields
+    pb_type: int
 
-        self._r.observe_histogram("llm_ttft", ttft, labels={"service": service, "channel": channel})
-        self._r.observe_histogram("llm_otps", otps, labels={"service": service, "channel": channel})
-        self._r.observe_histogram("llm_tpot", tpot, labels={"service": service, "channel": channel})
-        self._r.observe_histogram("llm_request_duration", total_duration, labels={"service": service, "channel": channel})
 
-        # In-flight (very rough): keep an end_time record.
-        with self._lock:
-            self._inflight_by_service[service].append(now + total_duration)
+def _family_layout(
+    name: str,
+    help_text: Optional[str],
+    metric_type: Optional[str],
+    series: List[_Series],
+) -> _FamilyLayout:
+    header = ""
+    if help_text:
+        header += f"# HELP {name} {_escape_help(help_text)}\n"
+    if metric_type:
+        header += f"# TYPE {name} {metric_type}\n"
 
-        # Gateway MQ write side.
-        mq_write_duration = max(0.0005, random.lognormvariate(math.log(mq_write_scale), 0.6))
-        self._r.observe_histogram("llm_record_mq_write_duration_seconds", mq_write_duration)
+    # OpenMetrics counters must expose `<family>_total` samples. Counters not already named
+    # that way are declared `unknown` so Prometheus stores the exact same series names
+    # (and dashboards keep working) whichever format it negotiates.
+    om_name = name
+    om_type = metric_type or "unknown"
+    if om_type == "counter":
+        if name.endswith("_total"):
+            om_name = name[: -len("_total")]
+        else:
+            om_type = "unknown"
+    om_header = f"# TYPE {om_name} {om_type}\n"
+    if help_text:
+        om_header += f"# HELP {om_name} {_escape_label_value(help_text)}\n"
 
-        # Retries/errors.
-        if random.random() < retry_prob:
-            retries = random.choice([1, 1, 2, 3])
-            self._r.inc_counter("llm_record_mq_write_retry_count", retries)
+    pb_type = _PB_TYPES.get(metric_type or "", _PB_UNTYPED)
+    pb_header = _pb_string(1, name) + (_pb_string(2, help_text) if help_text else b"") + _pb_uint(3, pb_type)
+    return _FamilyLayout(
+        name, header.encode("utf-8"), om_header.encode("utf-8"), series, pb_header, pb_type
+    )
 
-        if random.random() < mq_error_prob:
-            self._r.inc_counter("llm_record_mq_write_error_count", 1)
-            # Fallback temp-store may still fail.
-            if random.random() < temp_store_error_prob:
-                self._r.inc_counter("llm_record_temp_store_write_error_count", 1)
 
-    def _sample_tokens(self) -> Tuple[int, int]:
-        # A simple distribution: mostly small, sometimes large.
-        r = random.random()
-        if self._mode == "stress":
-            # More long-context requests.
-            weights = [
-                (0.30, (20, 400)),
-                (0.40, (400, 1500)),
-                (0.25, (1500, 4000)),
-                (0.05, (4000, 8000)),
-            ]
-        else:
-            weights = [
-                (0.55, (20, 400)),
-                (0.35, (400, 1500)),
-                (0.09, (1500, 4000)),
-                (0.01, (4000, 8000)),
-            ]
+# Protobuf exposition (io.prometheus.client metrics.proto), hand-encoded.
+_PB_TYPES = {"counter": 0, "gauge": 1, "summary": 2, "untyped": 3, "histogram": 4}
+_PB_UNTYPED = 3
+_PB_DOUBLE = struct.Struct("<d")
 
-        acc = 0.0
-        low, high = 20, 400
-        for p, (a, b) in weights:
-            acc += p
-            if r <= acc:
-                low, high = a, b
-                break
-        input_tokens = random.randint(low, high)
-        output_tokens = max(1, int(random.lognormvariate(math.log(120), 0.7)))
-        return input_tokens, output_tokens
 
-    @staticmethod
-    def _token_bucket(total_tokens: int) -> str:
-        if total_tokens <= 512:
-            return "0-512"
-        if total_tokens <= 1024:
-            return "512-1k"
-        if total_tokens <= 2048:
-            return "1k-2k"
-        if total_tokens <= 4096:
-            return "2k-4k"
-        if total_tokens <= 8192:
-            return "4k-8k"
-        return "8k+"
+def _pb_varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
 
 
-class MetricsHandler(BaseHTTPRequestHandler):
-    registry: Registry
+def _pb_zigzag(n: int) -> int:
+    return n << 1 if n >= 0 else (-n << 1) - 1
 
-    def do_GET(self) -> None:  # noqa: N802
-        if self.path not in ("/metrics", "/metrics/"):
-            self.send_response(404)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(b"not found\n")
-            return
 
-        payload = self.registry.render().encode("utf-8")
-        self.send_response(200)
-        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
-        self.send_header("Content-Length", str(len(payload)))
-        self.end_headers()
-        self.wfile.write(payload)
+def _pb_uint(field: int, n: int) -> bytes:
+    return _pb_varint(field << 3) + _pb_varint(n)
 
-    def log_message(self, fmt: str, *args: object) -> None:
-        # Reduce noise.
-        return
 
+def _pb_sint(field: int, n: int) -> bytes:
+    return _pb_varint(field << 3) + _pb_varint(_pb_zigzag(n))
 
-def _parse_csv(value: str) -> List[str]:
-    return [v.strip() for v in value.split(",") if v.strip()]
 
+def _pb_double(field: int, v: float) -> bytes:
+    return _pb_varint(field << 3 | 1) + _PB_DOUBLE.pack(v)
 
-def main(argv: Optional[Sequence[str]] = None) -> int:
-    parser = argparse.ArgumentParser(
-        description="Expose mock LLM business metrics in Prometheus /metrics format.",
-    )
-    parser.add_argument("--listen", default="0.0.0.0", help="Listen address (default: 0.0.0.0)")
-    parser.add_argument("--port", type=int, default=18080, help="Listen port (default: 18080)")
+
+def _pb_message(field: int, data: bytes) -> bytes:
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(data)) + data
+
+
+def _pb_string(field: int, text: str) -> bytes:
+    return _pb_message(field, text.encode("utf-8"))
+
+
+def _pb_spans(buckets: Dict[int, int], span_field: int, delta_field: int) -> bytes:
+    # BucketSpans (first offset absolute, then gaps) plus delta-encoded counts. metrics.proto
+    # is proto2, so the deltas are written unpacked like the Go client does.
+    spans: List[List[int]] = []
+    deltas: List[bytes] = []
+    prev_key: Optional[int] = None
+    prev_count = 0
+    for key in sorted(buckets):
+        if prev_key is not None and key == prev_key + 1:
+            spans[-1][1] += 1
+        else:
+            spans.append([key if prev_key is None else key - prev_key - 1, 1])
+        count = buckets[key]
+        deltas.append(_pb_sint(delta_field, count - prev_count))
+        prev_key, prev_count = key, count
+    out = b"".join(_pb_message(span_field, _pb_sint(1, offset) + _pb_uint(2, length)) for offset, length in spans)
+    return out + b"".join(deltas)
+
+
+def _pb_histogram(state: _HistogramState) -> bytes:
+    parts = [_pb_uint(1, state.count), _pb_double(2, state.sum)]
+    cumulative = 0
+    # Classic buckets; +Inf is implied by sample_count.
+    for bound, n in zip(state.buckets, state.raw_bucket_counts):
+        cumulative += n
+        parts.append(_pb_message(3, _pb_uint(1, cumulative) + _pb_double(2, float(bound))))
+    native = state.native
+    if native is not None and state.positive is not None and state.negative is not None:
+        parts.append(_pb_sint(5, native.schema))
+        parts.append(_pb_double(6, native.zero_threshold))
+        parts.append(_pb_uint(7, state.zero_count))
+        parts.append(_pb_spans(state.negative, 9, 10))
+        parts.append(_pb_spans(state.positive, 12, 13))
+        if not (state.positive or state.negative or state.zero_count):
+            # An empty span marks the histogram as native even before any observation.
+            parts.append(_pb_message(12, b""))
+    return b"".join(parts)
+
+
+def _pb_metric(series: _Series, pb_type: int) -> bytes:
+    # The series as a MetricFamily.metric (field 4) entry.
+    labels = b"".join(_pb_message(1, _pb_string(1, k) + _pb_string(2, v)) for k, v in series.key[1])
+    value = series.value
+    if isinstance(value, _HistogramState):
+        return _pb_message(4, labels + _pb_message(7, _pb_histogram(value)))
+    if isinstance(value, _SummaryState):
+        summary = _pb_uint(1, value.count) + _pb_double(2, value.sum)
+        for q, v in zip(value.config.quantiles, value.quantiles()):
+            summary += _pb_message(3, _pb_double(1, q) + _pb_double(2, v))
+        return _pb_message(4, labels + _pb_message(4, summary))
+    # Gauge, Counter and Untyped all carry `double value = 1`.
+    field = {0: 3, 1: 2}.get(pb_type, 5)
+    return _pb_message(4, labels + _pb_message(field, _pb_double(1, float(value))))  # type: ignore[arg-type]
+
+
+class _Cell:
+    # Per-thread accumulator of one series in ShardedRegistry; `pending` is the owning
+    # shard's dirty set for the series kind.
+    __slots__ = ("series", "value", "seq", "pending")
+
+    def __init__(self, series: _Series, value: object, pending: Set[_Series]) -> None:
+        self.series = series
+        self.value = value
+        self.seq = 0
+        self.pending = pending
+
+
+class _Shard:
+    __slots__ = ("thread", "cells", "counters", "gauges", "histograms", "summaries")
+
+    def __init__(self) -> None:
+        self.thread = threading.current_thread()
+        self.cells: Dict[Tuple[str, Labels], _Cell] = {}
+        # Series written since the last scrape, per kind.
+        self.counters: Set[_Series] = set()
+        self.gauges: Set[_Series] = set()
+        self.histograms: Set[_Series] = set()
+        self.summaries: Set[_Series] = set()
+
+
+def _drain(pending: Set[_Series]) -> List[_Series]:
+    # Safe against concurrent `add`: writers update the cell before marking the series,
+    # and anything marked after the snapshot stays in the set for the next scrape.
+    items = list(pending)
+    pending.difference_update(items)
+    return items
+
+
+# Writers only touch thread-local shards; render() merges them. Counters sum across
+# shards, gauges keep the most recent set_gauge, histograms add up bucket counts. The
+# global lock is only taken the first time a thread writes a given series, and at scrape.
+class ShardedRegistry(Registry):
+    def __init__(self) -> None:
+        super().__init__()
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._seq = itertools.count(1)
+        # Per series, the folded values of shards whose threads have exited.
+        self._retired: Dict[_Series, _Cell] = {}
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def _cell(self, shard: _Shard, key: Tuple[str, Labels], kind: str, series: Optional[_Series] = None) -> _Cell:
+        with self._lock:
+            if series is None:
+                series = self._get_series(key, kind)
+            cached = shard.cells.get(series.key)
+            if cached is not None:
+                return cached  # `key` was rejected: its family's sink, already celled here
+            if kind == "histogram":
+                state = _HistogramState.from_buckets(
+                    self._histogram_buckets[key[0]], self._histogram_native.get(key[0])
+                )
+                cell = _Cell(series, state, shard.histograms)
+            elif kind == "summary":
+                cell = _Cell(series, _SummaryState(self._summary_configs[key[0]]), shard.summaries)
+            else:
+                cell = _Cell(series, 0.0, shard.counters if kind == "counter" else shard.gauges)
+            if series.cells is None:
+                series.cells = []
+            series.cells.append(cell)
+        shard.cells[series.key] = cell
+        return cell
+
+    def _forget(self, series: _Series) -> None:
+        # Drop the shards' cache entries and unmerged writes (not the cells: bound children
+        # may still write them).
+        for shard in self._shards:
+            cell = shard.cells.get(series.key)
+            if cell is not None and cell.series is series:
+                shard.cells.pop(series.key, None)
+            for pending in (shard.counters, shard.gauges, shard.histograms, shard.summaries):
+                pending.discard(series)
+        self._retired.pop(series, None)
+
+    def inc_counter(self, name: str, value: float = 1.0, labels: Mapping[str, str] | None = None) -> None:
+        key = (name, _normalize_labels(labels))
+        shard = self._shard()
+        cell = shard.cells.get(key) or self._cell(shard, key, "counter")
+        cell.value += float(value)
+        cell.pending.add(cell.series)
+
+    def set_gauge(self, name: str, value: float, labels: Mapping[str, str] | None = None) -> None:
+        key = (name, _normalize_labels(labels))
+        shard = self._shard()
+        cell = shard.cells.get(key) or self._cell(shard, key, "gauge")
+        cell.value = float(value)
+        cell.seq = next(self._seq)
+        cell.pending.add(cell.series)
+
+    def observe_histogram(
+        self,
+        name: str,
+        value: float,
+        labels: Mapping[str, str] | None = None,
+    ) -> None:
+        key = (name, _normalize_labels(labels))
+        shard = self._shard()
+        cell = shard.cells.get(key) or self._cell(shard, key, "histogram")
+        cell.value.observe(value)
+        cell.pending.add(cell.series)
+
+    def observe_summary(
+        self,
+        name: str,
+        value: float,
+        labels: Mapping[str, str] | None = None,
+    ) -> None:
+        key = (name, _normalize_labels(labels))
+        shard = self._shard()
+        cell = shard.cells.get(key) or self._cell(shard, key, "summary")
+        cell.value.observe(value)
+        cell.pending.add(cell.series)
+
+    def _new_child(self, kind: str, series: _Series) -> object:
+        if kind == "counter":
+            return _ShardedCounterChild(self, series)
+        if kind == "gauge":
+            return _ShardedGaugeChild(self, series)
+        if kind == "summary":
+            return _ShardedSummaryChild(self, series)
+        return _ShardedHistogramChild(self, series)
+
+    def _bind(self, local: threading.local, series: _Series, kind: str) -> _Cell:
+        shard = self._shard()
+        cell = shard.cells.get(series.key) or self._cell(shard, series.key, kind, series)
+        local.cell = cell
+        return cell
+
+    def _collect(self) -> None:
+        counters: Set[_Series] = set()
+        gauges: Set[_Series] = set()
+        histograms: Set[_Series] = set()
+        summaries: Set[_Series] = set()
+        for shard in self._shards:
+            counters.update(_drain(shard.counters))
+            gauges.update(_drain(shard.gauges))
+            histograms.update(_drain(shard.histograms))
+            summaries.update(_drain(shard.summaries))
+        dead = [shard for shard in self._shards if not shard.thread.is_alive()]
+        if dead:
+            for shard in dead:
+                self._retire(shard)
+            self._shards = [shard for shard in self._shards if shard.thread.is_alive()]
+
+        for series in counters:
+            series.value = sum(cell.value for cell in series.cells)
+        for series in gauges:
+            series.value = max(series.cells, key=lambda cell: cell.seq).value
+        for series in itertools.chain(histograms, summaries):
+            merged = series.value.empty_like()
+            for cell in series.cells:
+                merged.merge(cell.value)
+            series.value = merged
+        self._dirty_scalars.update(counters)
+        self._dirty_scalars.update(gauges)
+        self._dirty_histograms.update(histograms)
+        self._dirty_summaries.update(summaries)
+
+    def _retire(self, shard: _Shard) -> None:
+        # Must hold self._lock. Folds an exited thread's cells into one registry-owned cell
+        # per series (nothing writes it), so short-lived writer threads cost nothing once gone.
+        for cell in shard.cells.values():
+            series = cell.series
+            retired = self._retired.get(series)
+            if retired is None:
+                empty = cell.value.empty_like() if isinstance(cell.value, (_HistogramState, _SummaryState)) else 0.0
+                retired = self._retired[series] = _Cell(series, empty, set())
+                series.cells.append(retired)
+            if cell.pending is shard.gauges:
+                if cell.seq > retired.seq:
+                    retired.value, retired.seq = cell.value, cell.seq
+            elif cell.pending is shard.counters:
+                retired.value += cell.value
+            else:
+                retired.value.merge(cell.value)
+            series.cells.remove(cell)
+
+
+class _ShardedCounterChild(CounterChild):
+    # Resolves the calling thread's cell once, then writes it without the global lock.
+    __slots__ = ("_registry", "_local")
+
+    def __init__(self, registry: ShardedRegistry, series: _Series) -> None:
+        super().__init__(registry, series)
+        self._registry = registry
+        self._local = threading.local()
+
+    def inc(self, value: float = 1.0) -> None:
+        cell = getattr(self._local, "cell", None) or self._registry._bind(self._local, self._series, "counter")
+        cell.value += value
+        cell.pending.add(cell.series)
+
+
+class _ShardedGaugeChild(GaugeChild):
+    __slots__ = ("_registry", "_local")
+
+    def __init__(self, registry: ShardedRegistry, series: _Series) -> None:
+        super().__init__(registry, series)
+        self._registry = registry
+        self._local = threading.local()
+
+    def set(self, value: float) -> None:
+        cell = getattr(self._local, "cell", None) or self._registry._bind(self._local, self._series, "gauge")
+        cell.value = float(value)
+        cell.seq = next(self._registry._seq)
+        cell.pending.add(cell.series)
+
+
+class _ShardedHistogramChild(HistogramChild):
+    __slots__ = ("_registry", "_local")
+
+    def __init__(self, registry: ShardedRegistry, series: _Series) -> None:
+        super().__init__(registry, series)
+        self._registry = registry
+        self._local = threading.local()
+
+    def observe(self, value: float) -> None:
+        cell = getattr(self._local, "cell", None) or self._registry._bind(self._local, self._series, "histogram")
+        cell.value.observe(value)
+        cell.pending.add(cell.series)
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        cell = getattr(self._local, "cell", None) or self._registry._bind(self._local, self._series, "histogram")
+        cell.value.observe_many(values)
+        cell.pending.add(cell.series)
+
+
+class _ShardedSummaryChild(SummaryChild):
+    __slots__ = ("_registry", "_local")
+
+    def __init__(self, registry: ShardedRegistry, series: _Series) -> None:
+        super().__init__(registry, series)
+        self._registry = registry
+        self._local = threading.local()
+
+    def observe(self, value: float) -> None:
+        cell = getattr(self._local, "cell", None) or self._registry._bind(self._local, self._series, "summary")
+        cell.value.observe(value)
+        cell.pending.add(cell.series)
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        cell = getattr(self._local, "cell", None) or self._registry._bind(self._local, self._series, "summary")
+        cell.value.observe_many(values)
+        cell.pending.add(cell.series)
+
+
+# --- Multi-process mode -------------------------------------------------------------------
+#
+# Each worker process owns one append-only, fixed-layout mmap file:
+#
+#   [u64 used bytes] then entries of [u32 key_len][u32 n_values][key, padded to 8][n_values x f64]
+#
+# Keys are JSON: ["series", kind, name, labels], or metadata ["help"|"type"|"buckets", name, x].
+# A worker appends an entry the first time it sees a series and afterwards only overwrites
+# its doubles in place, so updates involve no IPC; `used` is bumped after the entry is
+# complete. The serving process maps every worker file read-only and aggregates at scrape.
+
+_MMAP_HEADER = struct.Struct("<Q")
+_MMAP_ENTRY = struct.Struct("<II")
+GAUGE_AGGREGATIONS = ("sum", "max", "min", "latest")
+
+
+class _MmapCounterChild:
+    __slots__ = ("_values", "_idx")
+
+    def __init__(self, values: memoryview, idx: int) -> None:
+        self._values = values
+        self._idx = idx
+
+    def inc(self, value: float = 1.0) -> None:
+        self._values[self._idx] += value
+
+
+class _MmapGaugeChild(_MmapCounterChild):
+    # Two slots: value, wall-clock time of the last set (for "latest" aggregation).
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self._values[self._idx] = float(value)
+        self._values[self._idx + 1] = time.time()
+
+
+class _MmapHistogramChild:
+    # Slots: raw bucket counts (+Inf last), sum, count.
+    __slots__ = ("_values", "_idx", "_buckets")
+
+    def __init__(self, values: memoryview, idx: int, buckets: Tuple[float, ...]) -> None:
+        self._values = values
+        self._idx = idx
+        self._buckets = buckets
+
+    def observe(self, value: float) -> None:
+        v = float(value)
+        values = self._values
+        idx = self._idx
+        n = len(self._buckets)
+        values[idx + bisect.bisect_left(self._buckets, v)] += 1
+        values[idx + n + 1] += v
+        values[idx + n + 2] += 1
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        scratch = _HistogramState.from_buckets(self._buckets)
+        scratch.observe_many(values)
+        if not scratch.count:
+            return
+        slots = self._values
+        idx = self._idx
+        for i, n in enumerate(scratch.raw_bucket_counts):
+            if n:
+                slots[idx + i] += n
+        slots[idx + len(scratch.raw_bucket_counts)] += scratch.sum
+        slots[idx + len(scratch.raw_bucket_counts) + 1] += scratch.count
+
+
+class MmapShardRegistry(Registry):
+    # Worker-side registry: series live in this process's mmap file. Single writer thread.
+
+    def __init__(self, path: str, capacity: int) -> None:
+        super().__init__()
+        self._capacity = capacity
+        with open(path, "w+b") as f:
+            f.truncate(capacity)
+            self._mm = mmap.mmap(f.fileno(), capacity)
+        self._values = memoryview(self._mm).cast("d")
+        self._used = _MMAP_HEADER.size
+
+    def _append(self, key: object, n_values: int) -> int:
+        raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+        padded = (len(raw) + 7) & ~7
+        offset = self._used
+        end = offset + _MMAP_ENTRY.size + padded + 8 * n_values
+        if end > self._capacity:
+            raise RuntimeError(f"shared registry file full ({self._capacity} bytes); raise --shm-bytes")
+        _MMAP_ENTRY.pack_into(self._mm, offset, len(raw), n_values)
+        self._mm[offset + _MMAP_ENTRY.size : offset + _MMAP_ENTRY.size + len(raw)] = raw
+        self._used = end
+        _MMAP_HEADER.pack_into(self._mm, 0, end)
+        return (offset + _MMAP_ENTRY.size + padded) // 8
+
+    def set_help(self, name: str, text: str) -> None:
+        super().set_help(name, text)
+        with self._lock:
+            self._append(["help", name, text], 0)
+
+    def set_type(self, name: str, metric_type: str) -> None:
+        super().set_type(name, metric_type)
+        with self._lock:
+            self._append(["type", name, metric_type], 0)
+
+    def define_histogram(
+        self,
+        name: str,
+        buckets: Sequence[float],
+        help_text: str,
+        native_schema: Optional[int] = None,
+        zero_threshold: float = _NATIVE_ZERO_THRESHOLD,
+    ) -> None:
+        if native_schema is not None:
+            raise ValueError("native histograms are not supported by the shared-memory registry")
+        super().define_histogram(name, buckets, help_text)
+        with self._lock:
+            self._append(["buckets", name, list(self._histogram_buckets[name])], 0)
+            self._append(["help", name, help_text], 0)
+            self._append(["type", name, "histogram"], 0)
+
+    def define_summary(self, name: str, help_text: str, **kwargs: object) -> None:
+        raise ValueError("summaries are not supported by the shared-memory registry")
+
+    def _child(self, name: str, kind: str, labels: Labels) -> object:
+        with self._lock:
+            series_key = ["series", kind, name, [list(pair) for pair in labels]]
+            if kind == "counter":
+                return _MmapCounterChild(self._values, self._append(series_key, 1))
+            if kind == "gauge":
+                return _MmapGaugeChild(self._values, self._append(series_key, 2))
+            buckets = self._histogram_buckets.get(name)
+            if buckets is None:
+                raise KeyError(f"Histogram '{name}' not defined")
+            return _MmapHistogramChild(self._values, self._append(series_key, len(buckets) + 3), buckets)
+
+    def inc_counter(self, name: str, value: float = 1.0, labels: Mapping[str, str] | None = None) -> None:
+        self.counter(name).labels(**dict(labels or {})).inc(value)
+
+    def set_gauge(self, name: str, value: float, labels: Mapping[str, str] | None = None) -> None:
+        self.gauge(name).labels(**dict(labels or {})).set(value)
+
+    def observe_histogram(
+        self,
+        name: str,
+        value: float,
+        labels: Mapping[str, str] | None = None,
+    ) -> None:
+        self.histogram(name).labels(**dict(labels or {})).observe(value)
+
+
+class _MmapSource:
+    # Read side of one worker file.
+    __slots__ = ("path", "mm", "values", "offset")
+
+    def __init__(self, path: str, mm: mmap.mmap) -> None:
+        self.path = path
+        self.mm = mm
+        self.values = memoryview(mm).cast("d")
+        self.offset = _MMAP_HEADER.size
+
+
+class MultiProcessRegistry(Registry):
+    # Serving-side registry aggregating every worker file in `directory` at scrape time:
+    # counters sum, histograms merge buckets, gauges use `gauge_aggregation`.
+
+    def __init__(self, directory: str, *, gauge_aggregation: str = "sum") -> None:
+        super().__init__()
+        if gauge_aggregation not in GAUGE_AGGREGATIONS:
+            raise ValueError(f"unknown gauge aggregation '{gauge_aggregation}'")
+        self._directory = directory
+        self._gauge_aggregation = gauge_aggregation
+        self._sources: Dict[str, _MmapSource] = {}
+        # (series, kind, [(values view, first slot index), ...])
+        self._merged: Dict[Tuple[str, Labels], Tuple[_Series, str, List[Tuple[memoryview, int]]]] = {}
+
+    def _open_sources(self) -> None:
+        for entry in sorted(os.listdir(self._directory)):
+            if not entry.endswith(".db") or entry in self._sources:
+                continue
+            path = os.path.join(self._directory, entry)
+            size = os.path.getsize(path)
+            if size < _MMAP_HEADER.size or size % 8:
+                continue  # worker still creating it
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._sources[entry] = _MmapSource(path, mm)
+
+    def _scan(self, source: _MmapSource) -> None:
+        mm = source.mm
+        (used,) = _MMAP_HEADER.unpack_from(mm, 0)
+        while source.offset < used:
+            key_len, n_values = _MMAP_ENTRY.unpack_from(mm, source.offset)
+            start = source.offset + _MMAP_ENTRY.size
+            key = json.loads(mm[start : start + key_len].decode("utf-8"))
+            padded = (key_len + 7) & ~7
+            idx = (start + padded) // 8
+            source.offset = start + padded + 8 * n_values
+
+            tag = key[0]
+            if tag == "help":
+                self._help[key[1]] = key[2]
+                self._layout = None
+            elif tag == "type":
+                self._type[key[1]] = key[2]
+                self._layout = None
+            elif tag == "buckets":
+                self._histogram_buckets[key[1]] = tuple(key[2])
+            else:
+                _, kind, name, labels = key
+                series_key = (name, tuple((str(k), str(v)) for k, v in labels))
+                merged = self._merged.get(series_key)
+                if merged is None:
+                    # Worker writes are not seen one by one: a rejected series counts once, here.
+                    merged = (self._get_series(series_key, kind), kind, [])
+                    self._merged[series_key] = merged
+                merged[2].append((source.values, idx))
+
+    def _collect(self) -> None:
+        self._open_sources()
+        for source in self._sources.values():
+            self._scan(source)
+
+        aggregate = self._gauge_aggregation
+        for series, kind, slots in self._merged.values():
+            if kind == "counter":
+                value = sum(values[idx] for values, idx in slots)
+                if value != series.value:
+                    series.value = value
+                    self._dirty_scalars.add(series)
+            elif kind == "gauge":
+                if aggregate == "sum":
+                    value = sum(values[idx] for values, idx in slots)
+                elif aggregate == "max":
+                    value = max(values[idx] for values, idx in slots)
+                elif aggregate == "min":
+                    value = min(values[idx] for values, idx in slots)
+                else:
+                    values, idx = max(slots, key=lambda slot: slot[0][slot[1] + 1])
+                    value = values[idx]
+                if value != series.value:
+                    series.value = value
+                    self._dirty_scalars.add(series)
+            else:
+                state: _HistogramState = series.value
+                n = len(state.raw_bucket_counts)
+                raw = [int(sum(values[idx + i] for values, idx in slots)) for i in range(n)]
+                if raw != state.raw_bucket_counts:
+                    merged_state = _HistogramState(state.buckets, raw)
+                    merged_state.sum = sum(values[idx + n] for values, idx in slots)
+                    # Derived from the buckets so +Inf always equals _count.
+                    merged_state.count = sum(raw)
+                    series.value = merged_state
+                    self._dirty_histograms.add(series)
+
+
+def _worker_main(
+    path: str,
+    capacity: int,
+    pairs: List[Tuple[str, str]],
+    sim_options: Dict[str, object],
+    interval: float,
+    speed: Optional[float],
+    warmup_only: bool,
+) -> None:
+    registry = MmapShardRegistry(path, capacity)
+    clock = SimClock(_now()) if speed is not None else None
+    sim = Simulator(
+        registry,
+        services=[service for service, _ in pairs],
+        channels=[channel for _, channel in pairs],
+        pairs=pairs,
+        clock=clock or _now,
+        **sim_options,  # type: ignore[arg-type]
+    )
+    ticker = _Ticker(sim, interval, clock, speed or 1.0)
+    ticker.warmup()
+    if warmup_only:
+        return
+    parent = os.getppid()
+    while os.getppid() == parent:  # exit with an orphaned serving process
+        time.sleep(interval)
+        ticker.tick()
+
+
+class _HistogramState:
+    # `buckets` is the (sorted, immutable) upper-bound tuple shared by every series of the
+    # histogram; `raw_bucket_counts` has one extra slot for +Inf. With a native layout the
+    # sparse exponential buckets are kept as well (`positive`/`negative`: index -> count).
+    __slots__ = ("buckets", "raw_bucket_counts", "sum", "count", "native", "zero_count", "positive", "negative")
+
+    def __init__(
+        self,
+        buckets: Tuple[float, ...],
+        raw_bucket_counts: List[int],
+        native: Optional[_NativeLayout] = None,
+    ) -> None:
+        self.buckets = buckets
+        self.raw_bucket_counts = raw_bucket_counts
+        self.sum = 0.0
+        self.count = 0
+        self.native = native
+        self.zero_count = 0
+        self.positive: Optional[Dict[int, int]] = {} if native is not None else None
+        self.negative: Optional[Dict[int, int]] = {} if native is not None else None
+
+    @classmethod
+    def from_buckets(cls, buckets: Sequence[float], native: Optional[_NativeLayout] = None) -> "_HistogramState":
+        shared = buckets if isinstance(buckets, tuple) else tuple(buckets)
+        return cls(shared, [0] * (len(shared) + 1), native)
+
+    def empty_like(self) -> "_HistogramState":
+        return _HistogramState(self.buckets, [0] * len(self.raw_bucket_counts), self.native)
+
+    def observe(self, value: float) -> None:
+        v = float(value)
+        self.raw_bucket_counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+        if self.native is not None:
+            self._observe_native(v)
+
+    def _observe_native(self, v: float) -> None:
+        native = self.native
+        assert native is not None and self.positive is not None and self.negative is not None
+        if abs(v) <= native.zero_threshold or v != v:
+            self.zero_count += 1
+        elif v > 0:
+            key = _native_key(native, v)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        else:
+            key = _native_key(native, -v)
+            self.negative[key] = self.negative.get(key, 0) + 1
+
+    def _observe_native_many(self, values: "np.ndarray") -> None:
+        native = self.native
+        assert native is not None and self.positive is not None and self.negative is not None
+        magnitude = np.abs(values)
+        nonzero = magnitude > native.zero_threshold
+        self.zero_count += int(values.size - np.count_nonzero(nonzero))
+        for buckets, selected in ((self.positive, values > 0), (self.negative, values < 0)):
+            selected &= nonzero
+            if not selected.any():
+                continue
+            frac, exp = np.frexp(magnitude[selected])
+            if native.schema > 0:
+                keys = np.searchsorted(native.bounds, frac, side="left") + (exp - 1) * len(native.bounds)
+            else:
+                shift = -native.schema
+                keys = (exp - (frac == 0.5) + (1 << shift) - 1) >> shift
+            uniq, counts = np.unique(keys, return_counts=True)
+            for key, n in zip(uniq.tolist(), counts.tolist()):
+                buckets[key] = buckets.get(key, 0) + n
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        # Bins a whole batch in one call: vectorized for NumPy arrays, bisect otherwise.
+        if np is not None and isinstance(values, np.ndarray):
+            if not values.size:
+                return
+            idx = np.searchsorted(self.buckets, values, side="left")
+            binned = np.bincount(idx, minlength=len(self.raw_bucket_counts)).tolist()
+            raw = self.raw_bucket_counts
+            for i, n in enumerate(binned):
+                if n:
+                    raw[i] += n
+            self.sum += float(values.sum())
+            self.count += int(values.size)
+            if self.native is not None:
+                self._observe_native_many(values)
+            return
+        raw = self.raw_bucket_counts
+        buckets = self.buckets
+        native = self.native
+        total = 0.0
+        n = 0
+        for value in values:
+            v = float(value)
+            raw[bisect.bisect_left(buckets, v)] += 1
+            total += v
+            n += 1
+            if native is not None:
+                self._observe_native(v)
+        self.sum += total
+        self.count += n
+
+    def merge(self, other: "_HistogramState") -> None:
+        # `other` may be written concurrently: derive count from the copied buckets so the
+        # merged +Inf bucket always equals _count. Native buckets are copied first (observe()
+        # updates them last), so they never hold more observations than the count.
+        if self.native is not None and other.positive is not None and other.negative is not None:
+            self.zero_count += other.zero_count
+            for mine, theirs in ((self.positive, other.positive.copy()), (self.negative, other.negative.copy())):
+                assert mine is not None
+                for key, n in theirs.items():
+                    mine[key] = mine.get(key, 0) + n
+        raw = list(other.raw_bucket_counts)
+        for idx, n in enumerate(raw):
+            self.raw_bucket_counts[idx] += n
+        self.sum += other.sum
+        self.count += sum(raw)
+
+
+class _DDSketch:
+    # DDSketch (Masson et al., VLDB 2019): bucket k holds values in (gamma^(k-1), gamma^k],
+    # so every quantile estimate is within `relative_accuracy` of a true sample value.
+    __slots__ = ("bins", "zero_count")
+
+    def __init__(self) -> None:
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0  # values <= _SKETCH_MIN_VALUE
+
+
+_SKETCH_MIN_VALUE = 1e-9
+
+
+class _SummaryConfig(NamedTuple):
+    quantiles: Tuple[float, ...]  # sorted
+    max_age: float  # sliding window (seconds on `clock`)
+    age_buckets: int  # window rotates in max_age / age_buckets steps
+    max_bins: int  # per sketch; beyond it the lowest buckets are collapsed
+    gamma: float
+    inv_log_gamma: float
+    clock: Callable[[], float]
+
+    def epoch(self) -> int:
+        return math.floor(self.clock() * self.age_buckets / self.max_age)
+
+
+def _summary_config(
+    quantiles: Sequence[float],
+    max_age: float,
+    age_buckets: int,
+    relative_accuracy: float,
+    max_bins: int,
+    clock: Callable[[], float],
+) -> _SummaryConfig:
+    if not quantiles or any(not 0 <= q <= 1 for q in quantiles):
+        raise ValueError("summary quantiles must be in [0, 1]")
+    if not 0 < relative_accuracy < 1:
+        raise ValueError("relative_accuracy must be in (0, 1)")
+    if max_age <= 0 or age_buckets < 1 or max_bins < 1:
+        raise ValueError("max_age, age_buckets and max_bins must be positive")
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    return _SummaryConfig(
+        tuple(sorted(set(quantiles))), max_age, age_buckets, max_bins, gamma, 1 / math.log(gamma), clock
+    )
+
+
+class _SummaryState:
+    # Windowed quantiles: a ring of `age_buckets` sketches, the one for the current epoch
+    # receiving observations; a rotation drops the oldest. _sum/_count stay cumulative, as
+    # in the Prometheus client libraries.
+    __slots__ = ("config", "ring", "epoch", "sum", "count")
+
+    def __init__(self, config: _SummaryConfig) -> None:
+        self.config = config
+        self.ring = [_DDSketch() for _ in range(config.age_buckets)]
+        self.epoch = config.epoch()
+        self.sum = 0.0
+        self.count = 0
+
+    def empty_like(self) -> "_SummaryState":
+        return _SummaryState(self.config)
+
+    def _current(self) -> _DDSketch:
+        epoch = self.config.epoch()
+        if epoch > self.epoch:
+            n = len(self.ring)
+            for e in range(max(self.epoch + 1, epoch - n + 1), epoch + 1):
+                self.ring[e % n] = _DDSketch()
+            self.epoch = epoch
+        return self.ring[self.epoch % len(self.ring)]
+
+    def observe(self, value: float) -> None:
+        v = float(value)
+        sketch = self._current()
+        if v > _SKETCH_MIN_VALUE:
+            key = math.ceil(math.log(v) * self.config.inv_log_gamma)
+            bins = sketch.bins
+            bins[key] = bins.get(key, 0) + 1
+            if len(bins) > self.config.max_bins:
+                _collapse_lowest(bins, self.config.max_bins)
+        else:
+            sketch.zero_count += 1
+        self.sum += v
+        self.count += 1
+
+    def observe_many(self, values: Sequence[float]) -> None:
+        if np is None or not isinstance(values, np.ndarray):
+            for value in values:
+                self.observe(value)
+            return
+        if not values.size:
+            return
+        sketch = self._current()
+        positive = values[values > _SKETCH_MIN_VALUE]
+        sketch.zero_count += int(values.size - positive.size)
+        if positive.size:
+            keys, counts = np.unique(np.ceil(np.log(positive) * self.config.inv_log_gamma), return_counts=True)
+            bins = sketch.bins
+            for key, n in zip(keys.astype(np.int64).tolist(), counts.tolist()):
+                bins[key] = bins.get(key, 0) + n
+            if len(bins) > self.config.max_bins:
+                _collapse_lowest(bins, self.config.max_bins)
+        self.sum += float(values.sum())
+        self.count += int(values.size)
+
+    def merge(self, other: "_SummaryState") -> None:
+        # `other` may be written concurrently; sketches are aligned by epoch and the ones
+        # already outside this state's window are skipped.
+        n = len(self.ring)
+        other_epoch = other.epoch
+        ring = list(other.ring)
+        for e in range(max(other_epoch - n + 1, self.epoch - n + 1), min(other_epoch, self.epoch) + 1):
+            theirs = ring[e % n]
+            mine = self.ring[e % n]
+            mine.zero_count += theirs.zero_count
+            for key, count in theirs.bins.copy().items():
+                mine.bins[key] = mine.bins.get(key, 0) + count
+            if len(mine.bins) > self.config.max_bins:
+                _collapse_lowest(mine.bins, self.config.max_bins)
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantiles(self) -> List[float]:
+        # One estimate per configured quantile over the window; NaN when it is empty.
+        self._current()
+        merged: Dict[int, int] = {}
+        zero = 0
+        for sketch in self.ring:
+            zero += sketch.zero_count
+            for key, count in sketch.bins.items():
+                merged[key] = merged.get(key, 0) + count
+        total = zero + sum(merged.values())
+        if not total:
+            return [math.nan] * len(self.config.quantiles)
+        gamma = self.config.gamma
+        keys = sorted(merged)
+        out: List[float] = []
+        i = 0
+        cumulative = zero
+        for q in self.config.quantiles:
+            rank = q * (total - 1)
+            if rank < zero:
+                out.append(0.0)
+                continue
+            while cumulative <= rank and i < len(keys):
+                cumulative += merged[keys[i]]
+                i += 1
+            # Midpoint of (gamma^(k-1), gamma^k] in relative terms.
+            out.append(2 * gamma ** keys[i - 1] / (gamma + 1))
+        return out
+
+
+def _collapse_lowest(bins: Dict[int, int], max_bins: int) -> None:
+    keys = sorted(bins)
+    excess = len(keys) - max_bins
+    bins[keys[excess]] += sum(bins.pop(key) for key in keys[:excess])
+
+
+class _StepParams(NamedTuple):
+    error_prob: float
+    client_cancel_prob: float  # 客户端取消请求概率（499）
+    mq_error_prob: float
+    temp_store_error_prob: float
+    retry_prob: float
+    avg_ttft: float
+    avg_otps: float
+    mq_capacity_per_sec: float
+    mq_write_scale: float
+    mq_consumers: int  # queue model: concurrent MQ writers (~capacity x mean service time)
+
+
+# Mode knobs: use --mode stress to快速触发告警阈值。
+_MODE_PARAMS: Dict[str, _StepParams] = {
+    "stress": _StepParams(
+        error_prob=0.10,
+        client_cancel_prob=0.08,
+        mq_error_prob=0.05,
+        temp_store_error_prob=0.30,
+        retry_prob=0.30,
+        avg_ttft=1.2,
+        avg_otps=12.0,
+        mq_capacity_per_sec=2.0,
+        mq_write_scale=0.8,
+        mq_consumers=2,
+    ),
+    "normal": _StepParams(
+        error_prob=0.01,
+        client_cancel_prob=0.03,
+        mq_error_prob=0.002,
+        temp_store_error_prob=0.05,
+        retry_prob=0.05,
+        avg_ttft=0.15,
+        avg_otps=60.0,
+        mq_capacity_per_sec=200.0,
+        mq_write_scale=0.02,
+        mq_consumers=5,
+    ),
+}
+
+# Input token length tiers (probability, (low, high)): mostly small, sometimes large.
+_TOKEN_TIERS: Dict[str, List[Tuple[float, Tuple[int, int]]]] = {
+    # More long-context requests.
+    "stress": [
+        (0.30, (20, 400)),
+        (0.40, (400, 1500)),
+        (0.25, (1500, 4000)),
+        (0.05, (4000, 8000)),
+    ],
+    "normal": [
+        (0.55, (20, 400)),
+        (0.35, (400, 1500)),
+        (0.09, (1500, 4000)),
+        (0.01, (4000, 8000)),
+    ],
+}
+
+_TOKEN_BUCKET_BOUNDS = (512, 1024, 2048, 4096, 8192)
+_TOKEN_BUCKET_LABELS = ("0-512", "512-1k", "1k-2k", "2k-4k", "4k-8k", "8k+")
+_MQ_RETRY_CHOICES = (1, 1, 2, 3)
+
+
+class _RequestHandles:
+    # Pre-bound series for one (service, channel) pair, plus any synthetic labels. Status code
+    # and token bucket children are created on first use so unseen combinations are not exposed.
+    __slots__ = (
+        "_r",
+        "service",
+        "channel",
+        "_extra",
+        "ttft",
+        "otps",
+        "tpot",
+        "duration",
+        "input_tokens",
+        "output_tokens",
+        "total_tokens",
+        "slot",
+        "_by_status",
+        "_by_bucket",
+    )
+
+    def __init__(
+        self,
+        registry: Registry,
+        service: str,
+        channel: str,
+        slot: int,
+        extra: Optional[Mapping[str, str]] = None,
+        latency_type: str = "histogram",
+    ) -> None:
+        self._r = registry
+        self.service = service
+        self.channel = channel
+        self._extra = dict(extra or {})
+        labels = dict(self._extra, service=service, channel=channel)
+        family = registry.summary if latency_type == "summary" else registry.histogram
+        self.ttft = family("llm_ttft").labels(**labels)
+        self.otps = family("llm_otps").labels(**labels)
+        self.tpot = family("llm_tpot").labels(**labels)
+        self.duration = family("llm_request_duration").labels(**labels)
+        self.input_tokens = registry.counter("llm_input_tokens").labels(**labels)
+        self.output_tokens = registry.counter("llm_output_tokens").labels(**labels)
+        self.total_tokens = registry.counter("llm_total_tokens").labels(**labels)
+        self.slot = slot
+        self._by_status: Dict[str, Tuple[CounterChild, CounterChild]] = {}
+        self._by_bucket: Dict[str, Tuple[CounterChild, CounterChild, CounterChild]] = {}
+
+    def by_status(self, status_code: str) -> Tuple[CounterChild, CounterChild]:
+        children = self._by_status.get(status_code)
+        if children is None:
+            children = (
+                self._r.counter("llm_request_count").labels(
+                    **self._extra, service=self.service, status_code=status_code
+                ),
+                self._r.counter("channel_llm_request_count").labels(
+                    **self._extra, service=self.service, channel=self.channel, status_code=status_code
+                ),
+            )
+            self._by_status[status_code] = children
+        return children
+
+    def by_bucket(self, token_bucket: str) -> Tuple[CounterChild, CounterChild, CounterChild]:
+        children = self._by_bucket.get(token_bucket)
+        if children is None:
+            children = (
+                self._r.counter("llm_request_count_by_token_bucket").labels(
+                    **self._extra, service=self.service, token_bucket=token_bucket
+                ),
+                self._r.counter("channel_llm_request_count_by_token_bucket").labels(
+                    **self._extra, service=self.service, channel=self.channel, token_bucket=token_bucket
+                ),
+                self._r.counter("llm_total_tokens_by_token_bucket").labels(
+                    **self._extra, service=self.service, channel=self.channel, token_bucket=token_bucket
+                ),
+            )
+            self._by_bucket[token_bucket] = children
+        return children
+
+
+# Histograms per (service, channel) slot; MQ write duration is the only gateway-wide one.
+_SIM_HISTOGRAMS: Dict[str, Tuple[Sequence[float], str]] = {
+    # Buckets can be adjusted to your实际分布.
+    "llm_record_mq_write_duration_seconds": (
+        [0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2],
+        "Gateway MQ write duration (seconds).",
+    ),
+    "llm_request_duration": ([0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, 120], "End-to-end request duration (seconds)."),
+    "llm_ttft": ([0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10], "Time to first token (seconds)."),
+    "llm_otps": ([5, 10, 20, 30, 50, 80, 120, 200, 400, 800], "Output tokens per second (tokens/s)."),
+    "llm_tpot": ([0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1], "Time per output token (seconds/token)."),
+}
+_STATUS_CODES = ("200", "499", "500")
+# Synthetic dimensions: model varies fastest, then region, then tenant.
+_SYNTHETIC_MODELS = 8
+_SYNTHETIC_REGIONS = 4
+
+
+def _synthetic_label_sets(count: int) -> List[Dict[str, str]]:
+    return [
+        {
+            "model": f"model-{i % _SYNTHETIC_MODELS}",
+            "region": f"region-{i // _SYNTHETIC_MODELS % _SYNTHETIC_REGIONS}",
+            "tenant": f"tenant-{i // (_SYNTHETIC_MODELS * _SYNTHETIC_REGIONS)}",
+        }
+        for i in range(count)
+    ]
+
+
+def _synthetic_label_count(target_series: int, services: int, pairs: int, inflight_by_channel: bool) -> int:
+    # Label sets needed for `target_series` exposed samples once every status code and token
+    # bucket has been seen. Per (pair, label set): 4 histograms (buckets + +Inf/_sum/_count),
+    # 3 token counters, per-status requests and 2 per-bucket counters. Per (service, label set):
+    # per-status and per-bucket requests. The few gateway-wide series are ignored.
+    slot_histograms = ("llm_request_duration", "llm_ttft", "llm_otps", "llm_tpot")
+    histograms = sum(len(_SIM_HISTOGRAMS[name][0]) + 3 for name in slot_histograms)
+    per_pair = histograms + 3 + len(_STATUS_CODES) + 2 * len(_TOKEN_BUCKET_LABELS) + int(inflight_by_channel)
+    per_service = len(_STATUS_CODES) + len(_TOKEN_BUCKET_LABELS)
+    return max(1, round(target_series / (pairs * per_pair + services * per_service)))
+
+
+class MqQueueConfig(NamedTuple):
+    consumers: Optional[int] = None  # None: mode default (_StepParams.mq_consumers)
+    service_time: str = "lognormal"  # lognormal | exponential | constant, scaled by mq_write_scale
+    timeout: float = 5.0  # producer gives up on a write queued longer than this (seconds)
+    buffer: int = 10000  # in-memory backlog limit; arrivals beyond it are rejected
+    max_retries: int = 3
+
+
+MQ_SERVICE_TIMES = ("lognormal", "exponential", "constant")
+
+
+class _MqQueue:
+    # Discrete-event model of the gateway's MQ writer: arrivals are spread over each tick,
+    # `consumers` writers serve a FIFO backlog, and completions sit in a (time, seq) heap.
+    #
+    # - llm_record_mq_write_duration_seconds: enqueue -> successful write (queueing + service)
+    # - llm_record_mq_write_retry_count: attempts that failed transiently (p = retry_prob) and
+    #   were retried; the last failure of a write that used up max_retries is an error
+    # - llm_record_mq_write_error_count: retries exhausted, queued past `timeout`, or
+    #   rejected by a full buffer; each falls back to the temp store (p = temp_store_error_prob)
+    # - llm_record_mq_write_waiting: backlog (queued + being written) at the end of the tick
+
+    def __init__(self, config: MqQueueConfig, rng: random.Random) -> None:
+        if config.service_time not in MQ_SERVICE_TIMES:
+            raise ValueError(f"unknown MQ service time distribution '{config.service_time}'")
+        self._config = config
+        self._rng = rng
+        self._waiting: Deque[float] = collections.deque()  # enqueue times
+        self._busy = 0
+        self._completions: List[Tuple[float, int, float, int]] = []  # (done_at, seq, enqueued_at, retries)
+        self._seq = itertools.count()
+        self.enqueued = 0  # arrivals accepted by the buffer so far
+        # Per-advance parameters and outputs.
+        self._params = _MODE_PARAMS["normal"]
+        self._consumers = 1
+        self._durations: List[float] = []
+        self._retries = 0
+        self._errors = 0
+        self._temp_store_errors = 0
+
+    @property
+    def backlog(self) -> int:
+        return len(self._waiting) + self._busy
+
+    def advance(
+        self,
+        start: float,
+        dt_seconds: float,
+        arrivals: int,
+        params: _StepParams,
+    ) -> Tuple[List[float], int, int, int]:
+        # Runs [start, start + dt) and returns (write durations, retries, errors, temp-store errors).
+        config = self._config
+        self._params = params
+        self._consumers = config.consumers if config.consumers is not None else params.mq_consumers
+        self._durations = []
+        self._retries = self._errors = self._temp_store_errors = 0
+
+        for at in sorted(start + self._rng.random() * dt_seconds for _ in range(arrivals)):
+            self._run_until(at)
+            if len(self._waiting) >= config.buffer:
+                self._fail()
+                continue
+            self.enqueued += 1
+            if self._busy < self._consumers:
+                self._start(at, at, 0)
+            else:
+                self._waiting.append(at)
+        self._run_until(start + dt_seconds)
+        return self._durations, self._retries, self._errors, self._temp_store_errors
+
+    def _service_time(self) -> float:
+        kind = self._config.service_time
+        scale = self._params.mq_write_scale
+        if kind == "lognormal":
+            return max(0.0005, self._rng.lognormvariate(math.log(scale), 0.6))
+        if kind == "exponential":
+            return max(0.0005, self._rng.expovariate(1.0 / scale))
+        return scale
+
+    def _start(self, now: float, enqueued_at: float, retries: int) -> None:
+        self._busy += 1
+        heapq.heappush(self._completions, (now + self._service_time(), next(self._seq), enqueued_at, retries))
+
+    def _fail(self) -> None:
+        self._errors += 1
+        # Fallback temp-store may still fail.
+        if self._rng.random() < self._params.temp_store_error_prob:
+            self._temp_store_errors += 1
+
+    def _run_until(self, until: float) -> None:
+        completions = self._completions
+        while completions and completions[0][0] <= until:
+            now, _, enqueued_at, retries = heapq.heappop(completions)
+            self._busy -= 1
+            if self._rng.random() < self._params.retry_prob:
+                if retries < self._config.max_retries:
+                    self._retries += 1
+                    self._start(now, enqueued_at, retries + 1)
+                    continue
+                self._fail()
+            else:
+                self._durations.append(now - enqueued_at)
+            # Free writer: pull the next queued write, dropping those the producer gave up on.
+            while self._waiting and self._busy < self._consumers:
+                queued_at = self._waiting.popleft()
+                if now - queued_at > self._config.timeout:
+                    self._fail()
+                    continue
+                self._start(now, queued_at, 0)
+
+
+class _InflightTracker:
+    # Hashed time wheel of in-flight requests: end times are rounded *up* to `resolution`
+    # buckets holding per-slot counts, and a min-heap orders the live bucket ids. Adding is
+    # O(1) (O(log buckets) for a new bucket) and expiry is amortised O(1) per request, with
+    # requests leaving at most `resolution` seconds late, never early. Counts are kept per
+    # slot (service, channel pair) and per group (service) at the same cost.
+
+    def __init__(self, slot_groups: Sequence[int], n_groups: int, resolution: float = 0.01) -> None:
+        self._resolution = resolution
+        self._slot_groups = list(slot_groups)
+        self.slot_counts = [0] * len(self._slot_groups)
+        self.group_counts = [0] * n_groups
+        self._wheel: Dict[int, Dict[int, int]] = {}
+        self._heap: List[int] = []
+
+    def add(self, slot: int, end_time: float, count: int = 1) -> None:
+        bucket_id = math.ceil(end_time / self._resolution)
+        bucket = self._wheel.get(bucket_id)
+        if bucket is None:
+            bucket = self._wheel[bucket_id] = {}
+            heapq.heappush(self._heap, bucket_id)
+        bucket[slot] = bucket.get(slot, 0) + count
+        self.slot_counts[slot] += count
+        self.group_counts[self._slot_groups[slot]] += count
+
+    def add_many(self, slot: int, end_times: Sequence[float]) -> None:
+        if np is not None and isinstance(end_times, np.ndarray):
+            ids, counts = np.unique(np.ceil(end_times / self._resolution).astype(np.int64), return_counts=True)
+            for bucket_id, count in zip(ids.tolist(), counts.tolist()):
+                bucket = self._wheel.get(bucket_id)
+                if bucket is None:
+                    bucket = self._wheel[bucket_id] = {}
+                    heapq.heappush(self._heap, bucket_id)
+                bucket[slot] = bucket.get(slot, 0) + count
+            total = int(end_times.size)
+            self.slot_counts[slot] += total
+            self.group_counts[self._slot_groups[slot]] += total
+            return
+        for end_time in end_times:
+            self.add(slot, end_time)
+
+    def expire(self, now: float) -> None:
+        limit = math.floor(now / self._resolution)
+        heap = self._heap
+        while heap and heap[0] <= limit:
+            for slot, count in self._wheel.pop(heapq.heappop(heap)).items():
+                self.slot_counts[slot] -= count
+                self.group_counts[self._slot_groups[slot]] -= count
+
+
+# Scenario DSL (--scenario FILE, JSON or YAML): time-varying load and fault injection.
+#
+#   resolution: 10s      # table step; parameters are constant within a step
+#   duration: 24h        # table length (default: end of the last window / diurnal period)
+#   loop: true           # wrap around after `duration` (false: hold the last step)
+#   rates:               # per pair, the last matching rule wins (default: flat --base-qps)
+#     - match: {channel: openai}   # fnmatch patterns (str or list); omitted labels match any
+#       qps: 8                     # default: --base-qps
+#       diurnal: {amplitude: 0.6, period: 24h, peak: 14h}
+#       bursts: [{start: 2h, duration: 5m, factor: 5, ramp: 30s}]
+#   faults:              # applied in order on top of the --mode parameters
+#     - {kind: outage, match: {channel: azure}, start: 1h, duration: 10m}
+#     - {kind: latency, match: {channel: openai}, start: 3h, duration: 30m, ramp: 10m, factor: 4}
+#     - {kind: params, start: 5h, duration: 15m, set: {mq_error_prob: 0.2}, scale: {mq_capacity_per_sec: 0.1}}
+#
+# Times are offsets from the simulator's start. `set`/`scale` take _StepParams fields; the MQ
+# ones are gateway-wide, so faults touching them cannot have a `match`. Everything is compiled
+# into per-step tables up front: step() does one index lookup, nothing per request.
+
+_GATEWAY_FIELDS = frozenset(
+    ("mq_error_prob", "temp_store_error_prob", "retry_prob", "mq_capacity_per_sec", "mq_write_scale", "mq_consumers")
+)
+_FAULT_KINDS = ("outage", "latency", "params")
+
+ScenarioMatch = Dict[str, Tuple[str, ...]]
+
+
+class _Window(NamedTuple):
+    start: float
+    duration: float
+    ramp: float
+
+    def weight(self, t: float) -> float:
+        # 0 outside the window, ramping linearly up to 1 over the first `ramp` seconds.
+        if t < self.start or t >= self.start + self.duration:
+            return 0.0
+        if self.ramp <= 0:
+            return 1.0
+        return min(1.0, (t - self.start) / self.ramp)
+
+
+class _RateRule(NamedTuple):
+    match: ScenarioMatch
+    qps: Optional[float]
+    amplitude: float
+    period: float
+    peak: float
+    bursts: Tuple[Tuple[_Window, float], ...]  # (window, factor)
+
+    def qps_at(self, base_qps: float, t: float) -> float:
+        qps = self.qps if self.qps is not None else base_qps
+        if self.amplitude:
+            qps *= max(0.0, 1.0 + self.amplitude * math.cos(2 * math.pi * (t - self.peak) / self.period))
+        for window, factor in self.bursts:
+            w = window.weight(t)
+            if w:
+                qps *= 1.0 + (factor - 1.0) * w
+        return qps
+
+
+class _Fault(NamedTuple):
+    match: ScenarioMatch
+    window: _Window
+    assign: Tuple[Tuple[str, float], ...]
+    scale: Tuple[Tuple[str, float], ...]
+
+
+class _ScenarioTable(NamedTuple):
+    # Row k holds the parameters for elapsed time [k * resolution, (k + 1) * resolution).
+    resolution: float
+    loop: bool
+    qps: List[Tuple[float, ...]]  # per slot
+    params: List[Tuple[_StepParams, ...]]  # per slot
+    gateway: List[_StepParams]  # MQ side
+
+    def index(self, elapsed: float) -> int:
+        k = max(0, int(elapsed // self.resolution))
+        return k % len(self.qps) if self.loop else min(k, len(self.qps) - 1)
+
+
+def _scenario_seconds(value: object, what: str) -> float:
+    try:
+        seconds = float(value) if isinstance(value, (int, float)) else _parse_duration(str(value))
+    except ValueError:
+        raise ValueError(f"{what}: invalid duration {value!r}") from None
+    if seconds < 0 or not math.isfinite(seconds):
+        raise ValueError(f"{what}: duration must be >= 0, got {value!r}")
+    return seconds
+
+
+def _scenario_number(value: object, what: str) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{what}: expected a number, got {value!r}")
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{what}: expected a number, got {value!r}") from None
+
+
+def _scenario_list(value: object, what: str) -> List[object]:
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError(f"{what}: expected a list, got {type(value).__name__}")
+    return value
+
+
+def _scenario_keys(spec: object, allowed: Sequence[str], what: str) -> Mapping[str, object]:
+    if not isinstance(spec, Mapping):
+        raise ValueError(f"{what}: expected a mapping, got {type(spec).__name__}")
+    unknown = sorted(set(spec) - set(allowed))
+    if unknown:
+        raise ValueError(f"{what}: unknown key(s) {', '.join(unknown)}")
+    return spec
+
+
+def _scenario_match(spec: object, what: str) -> ScenarioMatch:
+    match = _scenario_keys(spec or {}, ("service", "channel"), what)
+    result: ScenarioMatch = {}
+    for label, patterns in match.items():
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+            raise ValueError(f"{what}.{label}: expected a glob or a list of globs, got {patterns!r}")
+        result[label] = tuple(patterns)
+    return result
+
+
+def _scenario_matches(match: ScenarioMatch, service: str, channel: str) -> bool:
+    labels = {"service": service, "channel": channel}
+    return all(any(fnmatch.fnmatchcase(labels[label], p) for p in patterns) for label, patterns in match.items())
+
+
+def _scenario_window(spec: Mapping[str, object], what: str) -> _Window:
+    if "start" not in spec or "duration" not in spec:
+        raise ValueError(f"{what}: 'start' and 'duration' are required")
+    return _Window(
+        _scenario_seconds(spec["start"], f"{what}.start"),
+        _scenario_seconds(spec["duration"], f"{what}.duration"),
+        _scenario_seconds(spec.get("ramp", 0), f"{what}.ramp"),
+    )
+
+
+def _scenario_fields(spec: object, what: str) -> Tuple[Tuple[str, float], ...]:
+    fields = _scenario_keys(spec or {}, _StepParams._fields, what)
+    return tuple((name, _scenario_number(value, f"{what}.{name}")) for name, value in fields.items())
+
+
+class Scenario:
+    # Parsed and validated scenario file; compile() turns it into per-step tables for one
+    # simulator's pairs (each --workers process compiles only its shard).
+
+    def __init__(
+        self,
+        *,
+        resolution: float,
+        duration: float,
+        loop: bool,
+        rates: Sequence[_RateRule],
+        faults: Sequence[_Fault],
+    ) -> None:
+        self.resolution = resolution
+        self.duration = duration
+        self.loop = loop
+        self.rates = list(rates)
+        self.faults = list(faults)
+
+    @classmethod
+    def load(cls, path: str) -> "Scenario":
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("YAML scenarios require PyYAML (pip install pyyaml); JSON works without it")
+            try:
+                doc = yaml.safe_load(text)
+            except yaml.YAMLError as exc:
+                raise ValueError(str(exc)) from None
+        else:
+            doc = json.loads(text)
+        return cls.from_dict(doc)
+
+    @classmethod
+    def from_dict(cls, doc: object) -> "Scenario":
+        spec = _scenario_keys(doc, ("resolution", "duration", "loop", "rates", "faults"), "scenario")
+        resolution = _scenario_seconds(spec.get("resolution", "10s"), "resolution")
+        if resolution <= 0:
+            raise ValueError("resolution must be > 0")
+
+        rates = []
+        for i, raw in enumerate(_scenario_list(spec.get("rates"), "rates")):
+            what = f"rates[{i}]"
+            rule = _scenario_keys(raw, ("match", "qps", "diurnal", "bursts"), what)
+            diurnal = _scenario_keys(rule.get("diurnal") or {}, ("amplitude", "period", "peak"), f"{what}.diurnal")
+            period = _scenario_seconds(diurnal.get("period", "24h"), f"{what}.diurnal.period")
+            if period <= 0:
+                raise ValueError(f"{what}.diurnal.period must be > 0")
+            bursts = []
+            for j, burst in enumerate(_scenario_list(rule.get("bursts"), f"{what}.bursts")):
+                burst_what = f"{what}.bursts[{j}]"
+                burst = _scenario_keys(burst, ("start", "duration", "ramp", "factor"), burst_what)
+                factor = _scenario_number(burst.get("factor", 2.0), f"{burst_what}.factor")
+                bursts.append((_scenario_window(burst, burst_what), factor))
+            rates.append(
+                _RateRule(
+                    match=_scenario_match(rule.get("match"), f"{what}.match"),
+                    qps=None if rule.get("qps") is None else _scenario_number(rule["qps"], f"{what}.qps"),
+                    amplitude=_scenario_number(diurnal.get("amplitude", 0.0), f"{what}.diurnal.amplitude"),
+                    period=period,
+                    peak=_scenario_seconds(diurnal.get("peak", 0), f"{what}.diurnal.peak"),
+                    bursts=tuple(bursts),
+                )
+            )
+
+        faults = []
+        for i, raw in enumerate(_scenario_list(spec.get("faults"), "faults")):
+            what = f"faults[{i}]"
+            kind = raw.get("kind", "params") if isinstance(raw, Mapping) else None
+            if kind not in _FAULT_KINDS:
+                raise ValueError(f"{what}.kind must be one of {', '.join(_FAULT_KINDS)}")
+            extra = {"outage": ("error_prob",), "latency": ("factor",), "params": ()}[kind]
+            fault = _scenario_keys(
+                raw, ("kind", "match", "start", "duration", "ramp", "set", "scale") + extra, what
+            )
+            assign = dict(_scenario_fields(fault.get("set"), f"{what}.set"))
+            scale = dict(_scenario_fields(fault.get("scale"), f"{what}.scale"))
+            if kind == "outage":
+                assign.setdefault("error_prob", _scenario_number(fault.get("error_prob", 1.0), f"{what}.error_prob"))
+                assign.setdefault("client_cancel_prob", 0.0)
+            elif kind == "latency":
+                if "factor" not in fault:
+                    raise ValueError(f"{what}: latency faults need a 'factor'")
+                factor = _scenario_number(fault["factor"], f"{what}.factor")
+                if factor <= 0:
+                    raise ValueError(f"{what}.factor must be > 0")
+                scale.setdefault("avg_ttft", factor)
+                scale.setdefault("avg_otps", 1.0 / factor)
+            match = _scenario_match(fault.get("match"), f"{what}.match")
+            if match and _GATEWAY_FIELDS.intersection(list(assign) + list(scale)):
+                raise ValueError(f"{what}: MQ parameters are gateway-wide and cannot be combined with 'match'")
+            faults.append(
+                _Fault(match, _scenario_window(fault, what), tuple(assign.items()), tuple(scale.items()))
+            )
+
+        if "duration" in spec:
+            duration = _scenario_seconds(spec["duration"], "duration")
+        else:
+            ends = [fault.window.start + fault.window.duration for fault in faults]
+            ends += [w.start + w.duration for rule in rates for w, _ in rule.bursts]
+            ends += [rule.period for rule in rates if rule.amplitude]
+            duration = max(ends, default=resolution)
+        loop = spec.get("loop", True)
+        if not isinstance(loop, bool):
+            raise ValueError("loop must be true or false")
+        return cls(resolution=resolution, duration=max(duration, resolution), loop=loop, rates=rates, faults=faults)
+
+    def compile(self, pairs: Sequence[Tuple[str, str]], base_qps: float, params: _StepParams) -> _ScenarioTable:
+        rules = [
+            next((rule for rule in reversed(self.rates) if _scenario_matches(rule.match, service, channel)), None)
+            for service, channel in pairs
+        ]
+        slot_faults = [
+            [fault for fault in self.faults if _scenario_matches(fault.match, service, channel)]
+            for service, channel in pairs
+        ]
+        gateway_faults = [fault for fault in self.faults if not fault.match]
+        # Interned so steady stretches share one params object / row.
+        interned: Dict[object, object] = {}
+        qps_rows: List[Tuple[float, ...]] = []
+        param_rows: List[Tuple[_StepParams, ...]] = []
+        gateway_rows: List[_StepParams] = []
+        for k in range(max(1, math.ceil(self.duration / self.resolution))):
+            t = k * self.resolution
+            qps_rows.append(tuple(base_qps if rule is None else rule.qps_at(base_qps, t) for rule in rules))
+            row = tuple(_apply_faults(params, faults, t, interned) for faults in slot_faults)
+            param_rows.append(interned.setdefault(row, row))  # type: ignore[arg-type]
+            gateway_rows.append(_apply_faults(params, gateway_faults, t, interned))
+        return _ScenarioTable(self.resolution, self.loop, qps_rows, param_rows, gateway_rows)
+
+
+def _apply_faults(
+    params: _StepParams,
+    faults: Sequence[_Fault],
+    t: float,
+    interned: Dict[object, object],
+) -> _StepParams:
+    changes: Dict[str, float] = {}
+    for fault in faults:
+        w = fault.window.weight(t)
+        if not w:
+            continue
+        for field, target in fault.assign:
+            base = changes.get(field, getattr(params, field))
+            changes[field] = base + (target - base) * w
+        for field, factor in fault.scale:
+            changes[field] = changes.get(field, getattr(params, field)) * (1.0 + (factor - 1.0) * w)
+    if not changes:
+        return params
+    for field, value in changes.items():
+        if field.endswith("_prob"):
+            changes[field] = min(1.0, max(0.0, value))
+    if "mq_consumers" in changes:
+        changes["mq_consumers"] = max(1, round(changes["mq_consumers"]))
+    faulted = params._replace(**changes)
+    return interned.setdefault(faulted, faulted)  # type: ignore[return-value]
+
+
+class Simulator:
+    def __init__(
+        self,
+        registry: Registry,
+        *,
+        services: Sequence[str],
+        channels: Sequence[str],
+        base_qps: float,
+        mode: str,
+        engine: str = "python",
+        pairs: Optional[Sequence[Tuple[str, str]]] = None,
+        inflight_by_channel: bool = False,
+        mq_queue: Optional[MqQueueConfig] = None,
+        clock: Callable[[], float] = _now,
+        seed: Optional[int] = None,
+        scenario: Optional[Scenario] = None,
+        synthetic_labels: Sequence[Mapping[str, str]] = (),
+        native_schema: Optional[int] = None,
+        classic_buckets: bool = True,
+        latency_type: str = "histogram",
+        summary_window: float = 600.0,
+    ) -> None:
+        self._r = registry
+        self._clock = clock
+        # Private stream: runs are reproducible per simulator, whatever else draws randomness.
+        self._rng = random.Random(seed)
+        # `pairs` restricts simulation to a subset of services x channels (one worker's shard).
+        self._pairs = list(pairs) if pairs is not None else [(s, c) for s in services for c in channels]
+        self._services = list(dict.fromkeys(service for service, _ in self._pairs))
+        self._channels = list(dict.fromkeys(channel for _, channel in self._pairs))
+        # One slot per pair and synthetic label set (--synthetic-cardinality).
+        self._slots = [
+            (service, channel, extra) for service, channel in self._pairs for extra in synthetic_labels or ({},)
+        ]
+        slot_pairs = [(service, channel) for service, channel, _ in self._slots]
+        self._base_qps = float(base_qps)
+        self._mode = mode
+        self._engine = engine
+        params = _MODE_PARAMS["stress" if mode == "stress" else "normal"]
+        # (per-slot qps, per-slot params, gateway params) when no scenario is loaded.
+        self._static_row = ((self._base_qps,) * len(self._slots), (params,) * len(self._slots), params)
+        self._scenario = scenario.compile(slot_pairs, self._base_qps, params) if scenario is not None else None
+        self._started = clock()
+
+        if engine == "numpy":
+            if np is None:
+                raise RuntimeError("engine 'numpy' requires numpy (pip install numpy)")
+            self._np_rng = np.random.default_rng(self._rng.getrandbits(64))
+        elif engine != "python":
+            raise ValueError(f"unknown engine '{engine}'")
+
+        self._lock = threading.RLock()
+        self._inflight = _InflightTracker(
+            [self._services.index(service) for service, _ in slot_pairs], len(self._services)
+        )
+        self._inflight_by_channel = inflight_by_channel
+        self._mq_waiting = 0.0
+        # Discrete-event MQ model; None keeps the independent per-request MQ samples.
+        self._mq_queue = _MqQueue(mq_queue, self._rng) if mq_queue is not None else None
+
+        if latency_type not in ("histogram", "summary"):
+            raise ValueError(f"unknown latency type '{latency_type}'")
+        for name, (buckets, help_text) in _SIM_HISTOGRAMS.items():
+            if latency_type == "summary":
+                # Window on the simulation clock, so --speed/--backfill age it in simulated time.
+                self._r.define_summary(name, help_text, max_age=summary_window, clock=clock)
+                continue
+            self._r.define_histogram(
+                name, buckets=buckets if classic_buckets else (), help_text=help_text, native_schema=native_schema
+            )
+
+        # Help/type for other metrics.
+        self._r.set_help("llm_request_count", "Total requests.")
+        self._r.set_type("llm_request_count", "counter")
+        self._r.set_help("channel_llm_request_count", "Total requests by channel.")
+        self._r.set_type("channel_llm_request_count", "counter")
+
+        self._r.set_help("llm_request_count_by_token_bucket", "Requests bucketed by token length.")
+        self._r.set_type("llm_request_count_by_token_bucket", "counter")
+        self._r.set_help(
+            "channel_llm_request_count_by_token_bucket", "Requests bucketed by token length (channel)."
+        )
+        self._r.set_type("channel_llm_request_count_by_token_bucket", "counter")
+
+        self._r.set_help("llm_total_tokens", "Total tokens consumed.")
+        self._r.set_type("llm_total_tokens", "counter")
+        self._r.set_help("llm_input_tokens", "Input tokens consumed.")
+        self._r.set_type("llm_input_tokens", "counter")
+        self._r.set_help("llm_output_tokens", "Output tokens produced.")
+        self._r.set_type("llm_output_tokens", "counter")
+        self._r.set_help("llm_total_tokens_by_token_bucket", "Total tokens bucketed by token length.")
+        self._r.set_type("llm_total_tokens_by_token_bucket", "counter")
+
+        self._r.set_help("llm_chat_handler_active_count", "In-flight request count.")
+        self._r.set_type("llm_chat_handler_active_count", "gauge")
+
+        self._r.set_help("llm_record_mq_write_waiting", "Waiting MQ write backlog.")
+        self._r.set_type("llm_record_mq_write_waiting", "gauge")
+        self._r.set_help("llm_record_mq_write_error_count", "MQ write errors (counter).")
+        self._r.set_type("llm_record_mq_write_error_count", "counter")
+        self._r.set_help("llm_record_temp_store_write_error_count", "Temp store write errors (counter).")
+        self._r.set_type("llm_record_temp_store_write_error_count", "counter")
+        self._r.set_help("llm_record_mq_write_retry_count", "MQ write retries (counter).")
+        self._r.set_type("llm_record_mq_write_retry_count", "counter")
+
+        # Pre-bound children: the per-request path does no label dict building or hashing.
+        self._handles = [
+            _RequestHandles(self._r, service, channel, slot, extra, latency_type)
+            for slot, (service, channel, extra) in enumerate(self._slots)
+        ]
+        self._active_gauges = [
+            self._r.gauge("llm_chat_handler_active_count").labels(service=service) for service in self._services
+        ]
+        self._channel_active_gauges = []
+        if inflight_by_channel:
+            self._r.set_help("channel_llm_chat_handler_active_count", "In-flight request count (channel).")
+            self._r.set_type("channel_llm_chat_handler_active_count", "gauge")
+            self._channel_active_gauges = [
+                self._r.gauge("channel_llm_chat_handler_active_count").labels(**extra, service=service, channel=channel)
+                for service, channel, extra in self._slots
+            ]
+        self._mq_waiting_gauge = self._r.gauge("llm_record_mq_write_waiting").labels()
+        self._mq_write_duration = (
+            self._r.summary if latency_type == "summary" else self._r.histogram
+        )("llm_record_mq_write_duration_seconds").labels()
+        self._mq_retry_count = self._r.counter("llm_record_mq_write_retry_count").labels()
+        self._mq_error_count = self._r.counter("llm_record_mq_write_error_count").labels()
+        self._temp_store_error_count = self._r.counter("llm_record_temp_store_write_error_count").labels()
+
+    def step(self, dt_seconds: float) -> None:
+        now = self._clock()
+        if self._scenario is not None:
+            table = self._scenario
+            k = table.index(now - self._started)
+            qps, slot_params, params = table.qps[k], table.params[k], table.gateway[k]
+        else:
+            qps, slot_params, params = self._static_row
+
+        if self._engine == "numpy":
+            produced_total = self._step_numpy(now, dt_seconds, qps, slot_params, params)
+        else:
+            produced_total = 0
+            for handles, slot_qps, handle_params in zip(self._handles, qps, slot_params):
+                req_n = _poisson(slot_qps * dt_seconds, self._rng)
+                produced_total += req_n
+                for _ in range(req_n):
+                    self._emit_one_request(now=now, handles=handles, params=handle_params)
+
+        if self._mq_queue is not None:
+            durations, retries, errors, temp_store_errors = self._mq_queue.advance(
+                now - dt_seconds, dt_seconds, produced_total, params
+            )
+            self._mq_write_duration.observe_many(durations)
+            if retries:
+                self._mq_retry_count.inc(retries)
+            if errors:
+                self._mq_error_count.inc(errors)
+            if temp_store_errors:
+                self._temp_store_error_count.inc(temp_store_errors)
+            self._mq_waiting_gauge.set(self._mq_queue.backlog)
+        else:
+            # MQ backlog gauge (simple queue model).
+            with self._lock:
+                self._mq_waiting += produced_total
+                consumed = min(self._mq_waiting, params.mq_capacity_per_sec * dt_seconds)
+                self._mq_waiting -= consumed
+                self._mq_waiting_gauge.set(self._mq_waiting)
+
+        # Active in-flight gauge by service (and optionally by channel).
+        with self._lock:
+            self._inflight.expire(now)
+            for gauge, count in zip(self._active_gauges, self._inflight.group_counts):
+                gauge.set(count)
+            for gauge, count in zip(self._channel_active_gauges, self._inflight.slot_counts):
+                gauge.set(count)
+
+    def _emit_one_request(self, *, now: float, handles: _RequestHandles, params: _StepParams) -> None:
+        # 状态码生成逻辑：先判断客户端取消，再判断服务器错误
+        r = self._rng.random()
+        if r < params.client_cancel_prob:
+            status_code = "499"  # 客户端取消请求
+        elif r < params.client_cancel_prob + params.error_prob:
+            status_code = "500"  # 服务器错误
+        else:
+            status_code = "200"  # 正常响应
+
+        input_tokens, output_tokens = self._sample_tokens()
+        total_tokens = input_tokens + output_tokens
+        token_bucket = self._token_bucket(total_tokens)
+
+        # QPS counters.
+        request_count, channel_request_count = handles.by_status(status_code)
+        request_count.inc(1)
+        channel_request_count.inc(1)
+
+        bucket_request_count, channel_bucket_request_count, bucket_total_tokens = handles.by_bucket(token_bucket)
+        bucket_request_count.inc(1)
+        channel_bucket_request_count.inc(1)
+
+        # Token counters.
+        handles.input_tokens.inc(input_tokens)
+        handles.output_tokens.inc(output_tokens)
+        handles.total_tokens.inc(total_tokens)
+        bucket_total_tokens.inc(total_tokens)
+
+        # Latency / UX histograms.
+        ttft = max(0.01, self._rng.expovariate(1.0 / params.avg_ttft))
+        otps = max(1.0, self._rng.lognormvariate(math.log(params.avg_otps), 0.35))
+        tpot = 1.0 / otps
+        gen_time = output_tokens * tpot
+        overhead = self._rng.uniform(0.01, 0.08)
+        total_duration = ttft + gen_time + overhead
+
+        handles.ttft.observe(ttft)
+        handles.otps.observe(otps)
+        handles.tpot.observe(tpot)
+        handles.duration.observe(total_duration)
+
+        # In-flight (very rough): keep an end_time record.
+        with self._lock:
+            self._inflight.add(handles.slot, now + total_duration)
+
+        if self._mq_queue is not None:
+            return  # MQ side comes from the queue model in step()
+
+        # Gateway MQ write side.
+        mq_write_duration = max(0.0005, self._rng.lognormvariate(math.log(params.mq_write_scale), 0.6))
+        self._mq_write_duration.observe(mq_write_duration)
+
+        # Retries/errors.
+        if self._rng.random() < params.retry_prob:
+            retries = self._rng.choice(_MQ_RETRY_CHOICES)
+            self._mq_retry_count.inc(retries)
+
+        if self._rng.random() < params.mq_error_prob:
+            self._mq_error_count.inc(1)
+            # Fallback temp-store may still fail.
+            if self._rng.random() < params.temp_store_error_prob:
+                self._temp_store_error_count.inc(1)
+
+    def _step_numpy(
+        self,
+        now: float,
+        dt_seconds: float,
+        qps: Sequence[float],
+        slot_params: Sequence[_StepParams],
+        params: _StepParams,
+    ) -> int:
+        # Same distributions as _emit_one_request, drawn as arrays per (service, channel)
+        # and folded into counter/histogram deltas: cost scales with pairs, not requests.
+        rng = self._np_rng
+        tiers = _TOKEN_TIERS["stress" if self._mode == "stress" else "normal"]
+        tier_cdf = np.cumsum([p for p, _ in tiers])
+        tier_low = np.array([low for _, (low, _) in tiers])
+        tier_high = np.array([high for _, (_, high) in tiers])
+        n_buckets = len(_TOKEN_BUCKET_LABELS)
+
+        counts = rng.poisson(np.multiply(qps, dt_seconds)).tolist()
+        for handles, n, handle_params in zip(self._handles, counts, slot_params):
+            if not n:
+                continue
+            r = rng.random(n)
+            cancelled = int(np.count_nonzero(r < handle_params.client_cancel_prob))
+            failed = int(np.count_nonzero(r < handle_params.client_cancel_prob + handle_params.error_prob)) - cancelled
+            for status_code, k in (("200", n - cancelled - failed), ("499", cancelled), ("500", failed)):
+                if k:
+                    request_count, channel_request_count = handles.by_status(status_code)
+                    request_count.inc(k)
+                    channel_request_count.inc(k)
+
+            tier = np.minimum(np.searchsorted(tier_cdf, rng.random(n), side="left"), len(tiers) - 1)
+            input_tokens = rng.integers(tier_low[tier], tier_high[tier], endpoint=True)
+            output_tokens = np.maximum(1, rng.lognormal(math.log(120), 0.7, n).astype(np.int64))
+            total_tokens = input_tokens + output_tokens
+
+            bucket_idx = np.searchsorted(_TOKEN_BUCKET_BOUNDS, total_tokens, side="left")
+            per_bucket = np.bincount(bucket_idx, minlength=n_buckets).tolist()
+            tokens_per_bucket = np.bincount(bucket_idx, weights=total_tokens, minlength=n_buckets).tolist()
+            for i, k in enumerate(per_bucket):
+                if k:
+                    bucket_request_count, channel_bucket_request_count, bucket_total_tokens = handles.by_bucket(
+                        _TOKEN_BUCKET_LABELS[i]
+                    )
+                    bucket_request_count.inc(k)
+                    channel_bucket_request_count.inc(k)
+                    bucket_total_tokens.inc(int(tokens_per_bucket[i]))
+
+            handles.input_tokens.inc(int(input_tokens.sum()))
+            handles.output_tokens.inc(int(output_tokens.sum()))
+            handles.total_tokens.inc(int(total_tokens.sum()))
+
+            ttft = np.maximum(0.01, rng.exponential(handle_params.avg_ttft, n))
+            otps = np.maximum(1.0, rng.lognormal(math.log(handle_params.avg_otps), 0.35, n))
+            tpot = 1.0 / otps
+            total_duration = ttft + output_tokens * tpot + rng.uniform(0.01, 0.08, n)
+
+            handles.ttft.observe_many(ttft)
+            handles.otps.observe_many(otps)
+            handles.tpot.observe_many(tpot)
+            handles.duration.observe_many(total_duration)
+
+            with self._lock:
+                self._inflight.add_many(handles.slot, total_duration + now)
+
+        produced_total = int(sum(counts))
+        if not produced_total or self._mq_queue is not None:
+            return produced_total
+
+        # Gateway MQ write side.
+        self._mq_write_duration.observe_many(
+            np.maximum(0.0005, rng.lognormal(math.log(params.mq_write_scale), 0.6, produced_total))
+        )
+        retried = int(rng.binomial(produced_total, params.retry_prob))
+        if retried:
+            self._mq_retry_count.inc(int(rng.choice(_MQ_RETRY_CHOICES, retried).sum()))
+        mq_errors = int(rng.binomial(produced_total, params.mq_error_prob))
+        if mq_errors:
+            self._mq_error_count.inc(mq_errors)
+            # Fallback temp-store may still fail.
+            temp_store_errors = int(rng.binomial(mq_errors, params.temp_store_error_prob))
+            if temp_store_errors:
+                self._temp_store_error_count.inc(temp_store_errors)
+        return produced_total
+
+    def _sample_tokens(self) -> Tuple[int, int]:
+        r = self._rng.random()
+        acc = 0.0
+        low, high = 20, 400
+        for p, (a, b) in _TOKEN_TIERS["stress" if self._mode == "stress" else "normal"]:
+            acc += p
+            if r <= acc:
+                low, high = a, b
+                break
+        input_tokens = self._rng.randint(low, high)
+        output_tokens = max(1, int(self._rng.lognormvariate(math.log(120), 0.7)))
+        return input_tokens, output_tokens
+
+    @staticmethod
+    def _token_bucket(total_tokens: int) -> str:
+        return _TOKEN_BUCKET_LABELS[bisect.bisect_left(_TOKEN_BUCKET_BOUNDS, total_tokens)]
+
+
+# --- Recording rules ------------------------------------------------------------------------
+#
+# Optional pre-aggregation: an Aggregator snapshots grouped counter sums into a ring buffer
+# every `resolution` seconds and publishes windowed rates, error ratios and top-k groups as
+# gauges in the same registry, named like Prometheus recording rules (level:metric:op<window>).
+# Rates are the plain increase over the oldest snapshot inside the window divided by the
+# elapsed time (no extrapolation); a counter that went down is treated as reset.
+
+
+class AggregationRule(NamedTuple):
+    record: str  # output gauge name, the window is appended: "...:rate" -> "...:rate5m"
+    kind: str  # "rate" | "ratio" | "topk"
+    metric: str  # source counter
+    by: Tuple[str, ...] = ()
+    match: Tuple[Tuple[str, str], ...] = ()  # (label, regex): rate/topk input, ratio numerator
+    k: int = 5  # topk only
+
+    def expr(self, window: str) -> str:
+        # Equivalent PromQL, used as the gauge's HELP.
+        by = f" by ({', '.join(self.by)}) " if self.by else ""
+        selector = ",".join(f'{label}=~"{regex}"' for label, regex in self.match)
+        rate = f"sum{by}(rate({self.metric}{{{selector}}}[{window}]))" if selector else ""
+        total = f"sum{by}(rate({self.metric}[{window}]))"
+        if self.kind == "ratio":
+            return f"{rate or total} / {total}"
+        if self.kind == "topk":
+            return f"topk({self.k}, {rate or total})"
+        return rate or total
+
+
+AGGREGATION_RULES: Tuple[AggregationRule, ...] = (
+    AggregationRule("service:llm_request_count:rate", "rate", "llm_request_count", ("service",)),
+    AggregationRule(
+        "global:llm_request_count:error_ratio", "ratio", "llm_request_count", match=(("status_code", "5.."),)
+    ),
+    AggregationRule(
+        "service:llm_request_count:error_ratio",
+        "ratio",
+        "llm_request_count",
+        ("service",),
+        match=(("status_code", "5.."),),
+    ),
+    AggregationRule(
+        "service_channel:channel_llm_request_count:error_ratio",
+        "ratio",
+        "channel_llm_request_count",
+        ("service", "channel"),
+        match=(("status_code", "5.."),),
+    ),
+    AggregationRule("channel:channel_llm_request_count:topk_rate", "topk", "channel_llm_request_count", ("channel",)),
+    AggregationRule(
+        "channel:channel_llm_request_count:topk_error_rate",
+        "topk",
+        "channel_llm_request_count",
+        ("channel",),
+        match=(("status_code", "5.."),),
+    ),
+    AggregationRule("global:llm_record_mq_write_error_count:rate", "rate", "llm_record_mq_write_error_count"),
+    AggregationRule("global:llm_record_mq_write_retry_count:rate", "rate", "llm_record_mq_write_retry_count"),
+    AggregationRule(
+        "global:llm_record_temp_store_write_error_count:rate", "rate", "llm_record_temp_store_write_error_count"
+    ),
+)
+
+
+def _format_window(seconds: float) -> str:
+    # Largest unit that divides evenly: 300 -> "5m", 90 -> "90s".
+    for suffix, unit in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= unit and seconds % unit == 0:
+            return f"{int(seconds // unit)}{suffix}"
+    return f"{seconds:g}s"
+
+
+class Aggregator:
+    def __init__(
+        self,
+        registry: Registry,
+        rules: Sequence[AggregationRule] = AGGREGATION_RULES,
+        *,
+        windows: Sequence[float] = (300.0,),
+        resolution: float = 15.0,
+        clock: Callable[[], float] = _now,
+    ) -> None:
+        if not windows or min(windows) <= 0 or resolution <= 0:
+            raise ValueError("aggregation windows and resolution must be positive")
+        for rule in rules:
+            if rule.kind not in ("rate", "ratio", "topk"):
+                raise ValueError(f"unknown aggregation kind '{rule.kind}' in rule '{rule.record}'")
+        self._r = registry
+        self._rules = list(rules)
+        self._windows = [(float(w), _format_window(float(w))) for w in sorted(set(windows))]
+        self._resolution = float(resolution)
+        self._clock = clock
+        self._metrics = {rule.metric for rule in self._rules}
+        self._match = [[(label, re.compile(regex)) for label, regex in rule.match] for rule in self._rules]
+        # (time, per-rule (matched group sums, all group sums)); enough snapshots for the
+        # longest window at `resolution` spacing.
+        self._ring: Deque[Tuple[float, List[Tuple[Dict[Labels, float], Dict[Labels, float]]]]] = collections.deque(
+            maxlen=math.ceil(self._windows[-1][0] / self._resolution) + 1
+        )
+        # Label sets currently published per output gauge, to drop the stale ones.
+        self._published: Dict[str, Set[Labels]] = {}
+
+    def evaluate(self) -> bool:
+        # Takes a snapshot and republishes every rule if `resolution` has elapsed since the
+        # last one. Returns whether it did.
+        now = self._clock()
+        if self._ring and now - self._ring[-1][0] < self._resolution:
+            return False
+        self._ring.append((now, self._group(self._r._counter_values(self._metrics))))
+        for window, label in self._windows:
+            base = next((snap for snap in self._ring if snap[0] >= now - window), None)
+            if base is None or base[0] >= now:
+                continue
+            elapsed = now - base[0]
+            for rule, (old, new) in zip(self._rules, zip(base[1], self._ring[-1][1])):
+                self._publish(rule, label, old, new, elapsed)
+        return True
+
+    def _group(
+        self, totals: Mapping[Tuple[str, Labels], float]
+    ) -> List[Tuple[Dict[Labels, float], Dict[Labels, float]]]:
+        groups = []
+        for rule, match in zip(self._rules, self._match):
+            matched: Dict[Labels, float] = {}
+            everything: Dict[Labels, float] = {}
+            for (name, labels), value in totals.items():
+                if name != rule.metric:
+                    continue
+                label_map = dict(labels)
+                group = tuple((label, label_map.get(label, "")) for label in rule.by)
+                everything[group] = everything.get(group, 0.0) + value
+                if match and all(regex.fullmatch(label_map.get(label, "")) for label, regex in match):
+                    matched[group] = matched.get(group, 0.0) + value
+            groups.append((matched, everything))
+        return groups
+
+    def _publish(
+        self,
+        rule: AggregationRule,
+        window: str,
+        old: Tuple[Dict[Labels, float], Dict[Labels, float]],
+        new: Tuple[Dict[Labels, float], Dict[Labels, float]],
+        elapsed: float,
+    ) -> None:
+        everything = _increase(old[1], new[1], elapsed)
+        matched = _increase(old[0], new[0], elapsed) if rule.match else everything
+        if rule.kind == "ratio":
+            # 0/0 is left out (no traffic in the window) rather than exposed as NaN.
+            values = {group: matched.get(group, 0.0) / total for group, total in everything.items() if total > 0}
+        elif rule.kind == "topk":
+            values = dict(heapq.nlargest(rule.k, sorted(matched.items()), key=lambda item: item[1]))
+        else:
+            values = matched
+        name = rule.record + window
+        self._published[name] = self._r._publish_gauges(
+            name, rule.expr(window), values, self._published.get(name, set())
+        )
+
+
+def _increase(old: Mapping[Labels, float], new: Mapping[Labels, float], elapsed: float) -> Dict[Labels, float]:
+    # Per-second increase; groups created after `old` started from zero.
+    rates = {}
+    for group, value in new.items():
+        before = old.get(group, 0.0)
+        rates[group] = (value - before if value >= before else value) / elapsed
+    return rates
+
+
+# --- Remote write -------------------------------------------------------------------------
+#
+# --remote-write URL pushes a snapshot of the registry every tick as Prometheus remote-write
+# 1.0 requests: hand-encoded prometheus.WriteRequest protobuf, snappy block-compressed. Series
+# are hashed to `shards` bounded queues (per-series order is kept); one sender thread per
+# shard batches up to `batch_size` samples per request and retries recoverable failures
+# (network errors, 5xx, 429) with exponential backoff, blocking its shard meanwhile. A full
+# queue blocks the snapshot, so a slow receiver applies backpressure to the simulation.
+
+_SNAPPY_BLOCK = 1 << 16
+_SNAPPY_MIN_MATCH = 4
+
+
+def _snappy_literal(out: bytearray, data: bytes) -> None:
+    n = len(data) - 1
+    if n < 60:
+        out.append(n << 2)
+    else:
+        size = (n.bit_length() + 7) // 8
+        out.append((59 + size) << 2)
+        out += n.to_bytes(size, "little")
+    out += data
+
+
+def _snappy_copy(out: bytearray, offset: int, length: int) -> None:
+    # Offsets stay below 64KiB (one block), so 1- and 2-byte offset forms suffice.
+    while length >= 68:
+        out += bytes((2 | (63 << 2), offset & 0xFF, offset >> 8))
+        length -= 64
+    if length > 64:
+        out += bytes((2 | (59 << 2), offset & 0xFF, offset >> 8))
+        length -= 60
+    if length < 12 and offset < 2048:
+        out += bytes((1 | ((length - 4) << 2) | ((offset >> 8) << 5), offset & 0xFF))
+    else:
+        out += bytes((2 | ((length - 1) << 2), offset & 0xFF, offset >> 8))
+
+
+def _common_prefix(data: bytes, a: int, b: int, limit: int) -> int:
+    # len of the common prefix of data[a:] and data[b:limit]. Compares growing chunks as
+    # integers: the lowest set bit of their XOR is the first differing byte.
+    n = 0
+    chunk = 32
+    while b + n < limit:
+        k = min(chunk, limit - b - n)
+        diff = int.from_bytes(data[a + n : a + n + k], "little") ^ int.from_bytes(data[b + n : b + n + k], "little")
+        if diff:
+            return n + ((diff & -diff).bit_length() - 1) // 8
+        n += k
+        chunk *= 2
+    return n
+
+
+def _snappy_compress(data: bytes) -> bytes:
+    # Snappy block format (what remote write's Content-Encoding: snappy means): greedy
+    # 4-byte matching per 64KiB block, skipping faster through incompressible input.
+    out = bytearray(_pb_varint(len(data)))
+    for start in range(0, len(data), _SNAPPY_BLOCK):
+        end = min(start + _SNAPPY_BLOCK, len(data))
+        table: Dict[bytes, int] = {}
+        i = literal = start
+        misses = 32
+        while i <= end - _SNAPPY_MIN_MATCH:
+            key = data[i : i + _SNAPPY_MIN_MATCH]
+            candidate = table.get(key)
+            table[key] = i
+            if candidate is None:
+                i += misses >> 5
+                misses += 1
+                continue
+            if literal < i:
+                _snappy_literal(out, data[literal:i])
+            length = _SNAPPY_MIN_MATCH + _common_prefix(data, candidate + 4, i + 4, end)
+            _snappy_copy(out, i - candidate, length)
+            i += length
+            literal = i
+            misses = 32
+        if literal < end:
+            _snappy_literal(out, data[literal:end])
+    return bytes(out)
+
+
+def _snappy_decompress(data: bytes) -> bytes:
+    # Inverse of _snappy_compress, for receiver stand-ins (bench_mock_llm_metrics.py).
+    size = shift = i = 0
+    while True:
+        b = data[i]
+        i += 1
+        size |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            break
+    out = bytearray()
+    while i < len(data):
+        tag = data[i]
+        i += 1
+        kind = tag & 3
+        if kind == 0:
+            n = tag >> 2
+            if n >= 60:
+                width = n - 59
+                n = int.from_bytes(data[i : i + width], "little")
+                i += width
+            out += data[i : i + n + 1]
+            i += n + 1
+            continue
+        if kind == 1:
+            length = 4 + ((tag >> 2) & 7)
+            offset = ((tag >> 5) << 8) | data[i]
+            i += 1
+        else:
+            width = 2 if kind == 2 else 4
+            length = (tag >> 2) + 1
+            offset = int.from_bytes(data[i : i + width], "little")
+            i += width
+        if not 0 < offset <= len(out):
+            raise ValueError("snappy: invalid copy offset")
+        start = len(out) - offset
+        while length > 0:  # the source may overlap what is being written
+            chunk = out[start : start + min(length, offset)]
+            out += chunk
+            start += len(chunk)
+            length -= len(chunk)
+    if len(out) != size:
+        raise ValueError(f"snappy: expected {size} bytes, got {len(out)}")
+    return bytes(out)
+
+
+def _rw_label_sets(series: _Series) -> Tuple[bytes, ...]:
+    # Encoded prometheus.Label fields (__name__ included, sorted by name) of each sample
+    # of the series, in _sample_values order.
+    name, labels = series.key
+    value = series.value
+    if isinstance(value, _HistogramState):
+        bounds = [f"{le}" for le in value.buckets] + ["+Inf"]
+        sets = [(f"{name}_bucket", labels + (("le", le),)) for le in bounds]
+        sets += [(f"{name}_sum", labels), (f"{name}_count", labels)]
+    elif isinstance(value, _SummaryState):
+        sets = [(name, labels + (("quantile", f"{q}"),)) for q in value.config.quantiles]
+        sets += [(f"{name}_sum", labels), (f"{name}_count", labels)]
+    else:
+        sets = [(name, labels)]
+    return tuple(
+        b"".join(
+            _pb_message(1, _pb_string(1, k) + _pb_string(2, v)) for k, v in sorted(pairs + (("__name__", sample),))
+        )
+        for sample, pairs in sets
+    )
+
+
+def _sample_values(value: object) -> List[float]:
+    if isinstance(value, _HistogramState):
+        return [float(n) for n in itertools.accumulate(value.raw_bucket_counts)] + [value.sum, float(value.count)]
+    if isinstance(value, _SummaryState):
+        return value.quantiles() + [value.sum, float(value.count)]
+    return [value]  # type: ignore[list-item]
+
+
+class RemoteWriteConfig(NamedTuple):
+    shards: int = 4  # sender threads / queues
+    batch_size: int = 2000  # max samples per request
+    capacity: int = 10000  # max samples per shard queued or being sent; the snapshot blocks beyond
+    connections: int = 0  # connection pool size; 0: one per shard
+    max_retries: int = 10  # recoverable failures of one batch before it is dropped
+    min_backoff: float = 0.03
+    max_backoff: float = 5.0
+    timeout: float = 30.0
+
+
+class _ConnectionPool:
+    # Keep-alive HTTP(S) connections shared by the shard senders: at most `size` open, idle
+    # ones reused most-recent first; a connection that errored is closed, not returned.
+
+    def __init__(self, url: str, size: int, timeout: float) -> None:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"remote write URL must be http(s)://host[:port]/path, got '{url}'")
+        self._factory = functools.partial(
+            http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection,
+            parts.hostname,
+            parts.port,
+            timeout=timeout,
+        )
+        self._path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self._idle: List[http.client.HTTPConnection] = []
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def post(self, body: bytes, headers: Mapping[str, str]) -> int:
+        with self._slots:
+            with self._idle_lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._factory()
+            try:
+                conn.request("POST", self._path, body, dict(headers))
+                response = conn.getresponse()
+                response.read()
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                with self._idle_lock:
+                    self._idle.append(conn)
+            return response.status
+
+
+_RW_HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "User-Agent": "mock-llm-metrics",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+_RW_SEND_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RemoteWriter:
+    def __init__(
+        self,
+        registry: Registry,
+        url: str,
+        config: RemoteWriteConfig = RemoteWriteConfig(),
+        *,
+        clock: Callable[[], float] = _now,
+    ) -> None:
+        if config.shards < 1 or config.batch_size < 1 or config.capacity < config.batch_size:
+            raise ValueError("remote write needs shards >= 1 and capacity >= batch_size >= 1")
+        self._r = registry
+        self._config = config
+        self._clock = clock
+        self._pool = _ConnectionPool(url, config.connections or config.shards, config.timeout)
+        # Items are (encoded TimeSeries, sample count) chunks of at most batch_size samples. The
+        # queues are unbounded: _put bounds each shard's pending samples (queued or in flight).
+        self._queues: List["queue.Queue[Tuple[List[bytes], int]]"] = [queue.Queue() for _ in range(config.shards)]
+        self._pending = [0] * config.shards
+        self._pending_cond = threading.Condition()
+
+        registry.set_help("mock_exporter_remote_write_pending_samples", "Samples queued for remote write, by shard.")
+        registry.set_type("mock_exporter_remote_write_pending_samples", "gauge")
+        registry.define_histogram(
+            "mock_exporter_remote_write_send_duration_seconds",
+            _RW_SEND_BUCKETS,
+            "Duration of remote write requests, retries counted separately.",
+        )
+        registry.set_help("mock_exporter_remote_write_samples_total", "Samples sent or dropped after retries.")
+        registry.set_type("mock_exporter_remote_write_samples_total", "counter")
+        registry.set_help("mock_exporter_remote_write_retries_total", "Remote write requests retried.")
+        registry.set_type("mock_exporter_remote_write_retries_total", "counter")
+        registry.set_help("mock_exporter_remote_write_sent_bytes_total", "Compressed request bytes sent.")
+        registry.set_type("mock_exporter_remote_write_sent_bytes_total", "counter")
+        registry.set_help(
+            "mock_exporter_remote_write_blocked_seconds_total",
+            "Time snapshots waited for a shard to drop under capacity.",
+        )
+        registry.set_type("mock_exporter_remote_write_blocked_seconds_total", "counter")
+        self._pending_gauges = [
+            registry.gauge("mock_exporter_remote_write_pending_samples").labels(shard=str(i))
+            for i in range(config.shards)
+        ]
+        self._send_duration = registry.histogram("mock_exporter_remote_write_send_duration_seconds").labels()
+        self._sent = registry.counter("mock_exporter_remote_write_samples_total").labels(result="sent")
+        self._failed = registry.counter("mock_exporter_remote_write_samples_total").labels(result="failed")
+        self._retries = registry.counter("mock_exporter_remote_write_retries_total").labels()
+        self._sent_bytes = registry.counter("mock_exporter_remote_write_sent_bytes_total").labels()
+        self._blocked = registry.counter("mock_exporter_remote_write_blocked_seconds_total").labels()
+
+        for shard in range(config.shards):
+            threading.Thread(target=self._run, args=(shard,), name=f"remote-write-{shard}", daemon=True).start()
+
+    def snapshot(self) -> int:
+        # Enqueues every current sample stamped with `clock`; returns the sample count.
+        ts = int(self._clock() * 1000)
+        sample = _pb_uint(2, ts)
+        shards = self._config.shards
+        by_shard: List[List[bytes]] = [[] for _ in range(shards)]
+        for label_sets, values in self._r._samples():
+            out = by_shard[hash(label_sets[0]) % shards]
+            for labels, value in zip(label_sets, values):
+                out.append(_pb_message(1, labels + _pb_message(2, _pb_double(1, value) + sample)))
+        batch = self._config.batch_size
+        for shard, timeseries in enumerate(by_shard):
+            for start in range(0, len(timeseries), batch):
+                self._put(shard, timeseries[start : start + batch])
+        return sum(len(timeseries) for timeseries in by_shard)
+
+    def pending(self) -> int:
+        with self._pending_cond:
+            return sum(self._pending)
+
+    def _put(self, shard: int, timeseries: List[bytes]) -> None:
+        n = len(timeseries)
+        blocked = 0.0
+        with self._pending_cond:
+            if self._pending[shard] + n > self._config.capacity:
+                t0 = time.perf_counter()
+                while self._pending[shard] + n > self._config.capacity:
+                    self._pending_cond.wait()
+                blocked = time.perf_counter() - t0
+            self._pending[shard] += n
+            pending = self._pending[shard]
+        if blocked:
+            self._blocked.inc(blocked)
+        self._pending_gauges[shard].set(pending)
+        self._queues[shard].put_nowait((timeseries, n))
+
+    def _done(self, shard: int, n: int) -> None:
+        with self._pending_cond:
+            self._pending[shard] -= n
+            pending = self._pending[shard]
+            self._pending_cond.notify_all()
+        self._pending_gauges[shard].set(pending)
+
+    def _run(self, shard: int) -> None:
+        q = self._queues[shard]
+        carry: Optional[Tuple[List[bytes], int]] = None
+        while True:
+            timeseries, n = carry or q.get()
+            carry = None
+            timeseries = list(timeseries)
+            # Coalesce whatever else is queued, up to one batch.
+            while n < self._config.batch_size:
+                try:
+                    more = q.get_nowait()
+                except queue.Empty:
+                    break
+                if n + more[1] > self._config.batch_size:
+                    carry = more
+                    break
+                timeseries += more[0]
+                n += more[1]
+            self._send(b"".join(timeseries), n)
+            self._done(shard, n)
+
+    def _send(self, write_request: bytes, samples: int) -> None:
+        config = self._config
+        body = _snappy_compress(write_request)
+        backoff = config.min_backoff
+        for attempt in range(config.max_retries + 1):
+            t0 = time.perf_counter()
+            try:
+                status: Optional[int] = self._pool.post(body, _RW_HEADERS)
+            except (OSError, http.client.HTTPException):
+                status = None
+            self._send_duration.observe(time.perf_counter() - t0)
+            if status is not None and 200 <= status < 300:
+                self._sent.inc(samples)
+                self._sent_bytes.inc(len(body))
+                return
+            if status is not None and status < 500 and status != 429:
+                break  # rejected: retrying would not help
+            if attempt < config.max_retries:
+                self._retries.inc()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, config.max_backoff)
+        self._failed.inc(samples)
+
+
+# --- Self-instrumentation -------------------------------------------------------------------
+#
+# mock_exporter_* metrics about the exporter itself: per-stage tick time, scrape render time
+# and payload size per format, waits on the registry lock and series counts. Plus the opt-in
+# /debug/profile sampling profiler (--debug-profile).
+
+_SELF_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SELF_LOCK_BUCKETS = (1e-6, 1e-5, 1e-4, 0.001, 0.01, 0.1, 1.0)
+_SELF_BYTES_BUCKETS = tuple(1024.0 * 4**i for i in range(11))  # 1KiB .. 1GiB
+
+
+class _TimedLock:
+    # Stands in for Registry._lock: uncontended acquisitions cost one non-blocking try,
+    # contended ones are timed into `series` (a histogram written while the lock is held).
+    __slots__ = ("_lock", "_series", "_dirty")
+
+    def __init__(self, lock: threading.RLock, series: _Series, dirty: Set[_Series]) -> None:
+        self._lock = lock
+        self._series = series
+        self._dirty = dirty
+
+    def __enter__(self) -> bool:
+        lock = self._lock
+        if lock.acquire(False):
+            return True
+        t0 = time.perf_counter()
+        lock.acquire()
+        self._series.value.observe(time.perf_counter() - t0)
+        self._dirty.add(self._series)
+        return True
+
+    def __exit__(self, *exc: object) -> None:
+        self._lock.release()
+
+
+class SelfMetrics:
+    # Create before the Simulator (or anything else taking children): children bind the
+    # registry lock when created, and this swaps it for a _TimedLock. Writes go to the base
+    # tables under the lock, like _publish_gauges: HTTP handler threads must not each get a
+    # ShardedRegistry shard.
+
+    def __init__(self, registry: Registry) -> None:
+        self._r = registry
+        registry.define_histogram(
+            "mock_exporter_tick_duration_seconds",
+            _SELF_DURATION_BUCKETS,
+            "Time spent per tick stage (step, aggregate, remote_write).",
+        )
+        registry.define_histogram(
+            "mock_exporter_render_duration_seconds",
+            _SELF_DURATION_BUCKETS,
+            "Time spent producing one /metrics payload (uncompressed, excluding socket writes).",
+        )
+        registry.define_histogram(
+            "mock_exporter_payload_bytes", _SELF_BYTES_BUCKETS, "Uncompressed /metrics payload size."
+        )
+        registry.define_histogram(
+            "mock_exporter_lock_wait_seconds",
+            _SELF_LOCK_BUCKETS,
+            "Wait for the registry lock, contended acquisitions only.",
+        )
+        registry.set_help("mock_exporter_series", "Exposed series by metric type, as of the last scrape.")
+        registry.set_type("mock_exporter_series", "gauge")
+        with registry._lock:
+            lock_series = registry._get_series(("mock_exporter_lock_wait_seconds", ()), "histogram")
+            registry._lock = _TimedLock(registry._lock, lock_series, registry._dirty_histograms)
+
+    def observe_tick(self, stage: str, seconds: float) -> None:
+        with self._r._lock:
+            self._observe(("mock_exporter_tick_duration_seconds", (("stage", stage),)), seconds)
+
+    def _observe(self, key: Tuple[str, Labels], value: float) -> None:
+        # Must hold the registry lock.
+        registry = self._r
+        series = registry._histograms.get(key) or registry._new_histogram(key)
+        series.value.observe(value)
+        registry._dirty_histograms.add(series)
+
+    def timed_render(self, fmt: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        # Passes `chunks` through, timing only the time spent producing them.
+        elapsed = 0.0
+        size = 0
+        while True:
+            t0 = time.perf_counter()
+            chunk = next(chunks, None)
+            elapsed += time.perf_counter() - t0
+            if chunk is None:
+                break
+            size += len(chunk)
+            yield chunk
+        registry = self._r
+        labels = (("format", fmt),)
+        with registry._lock:
+            self._observe(("mock_exporter_render_duration_seconds", labels), elapsed)
+            self._observe(("mock_exporter_payload_bytes", labels), size)
+            for kind, table in (
+                ("counter", registry._counters),
+                ("gauge", registry._gauges),
+                ("histogram", registry._histograms),
+                ("summary", registry._summaries),
+            ):
+                key = ("mock_exporter_series", (("type", kind),))
+                series = registry._gauges.get(key) or registry._new_scalar(registry._gauges, key, "gauge")
+                series.value = float(len(table))
+                registry._dirty_scalars.add(series)
+
+
+_PROFILE_MAX_SECONDS = 300.0
+
+
+def _profile_seconds(query: str) -> float:
+    values = urllib.parse.parse_qs(query).get("seconds", ["10"])
+    seconds = float(values[-1])
+    if not 0 < seconds <= _PROFILE_MAX_SECONDS:
+        raise ValueError(f"seconds must be in (0, {_PROFILE_MAX_SECONDS:g}]")
+    return seconds
+
+
+def _sample_profile(seconds: float, interval: float = 0.01) -> Tuple[bytes, int]:
+    # Samples every other thread's stack via sys._current_frames() for `seconds`; returns
+    # collapsed stacks ("thread;outer;...;inner count" lines, flamegraph.pl/speedscope input)
+    # and the number of sampling rounds. Runs alongside normal service.
+    me = threading.get_ident()
+    counts: Dict[str, int] = {}
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        rounds += 1
+        time.sleep(interval)
+    lines = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return "".join(f"{stack} {n}\n" for stack, n in lines).encode("utf-8"), rounds
+
+
+class SimClock:
+    # Simulated time for Simulator(clock=...): only moves when the driver advances it.
+    __slots__ = ("now",)
+
+    def __init__(self, start: float) -> None:
+        self.now = float(start)
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class _Ticker:
+    # Drives Simulator.step from a serving loop that sleeps `interval` between ticks.
+    # Without a SimClock each tick simulates the measured wall time since the last one.
+    # With one, each tick advances simulated time by exactly interval * speed: --speed 100
+    # replays 100 simulated seconds per wall second, and the step sequence (hence the
+    # metrics, given --seed) does not depend on scheduling jitter. An Aggregator and a
+    # RemoteWriter, if any, run after each step; with --workers there is no local simulator.
+
+    def __init__(
+        self,
+        sim: Optional[Simulator],
+        interval: float,
+        clock: Optional[SimClock] = None,
+        speed: float = 1.0,
+        aggregator: Optional[Aggregator] = None,
+        remote_write: Optional[RemoteWriter] = None,
+        self_metrics: Optional[SelfMetrics] = None,
+    ) -> None:
+        self.sim = sim
+        self.interval = interval
+        self.aggregator = aggregator
+        self.remote_write = remote_write
+        self.self_metrics = self_metrics
+        self._clock = clock
+        self._dt = interval * speed
+        self._last = _now()
+
+    def warmup(self, ticks: int = 3) -> None:
+        # A few ticks up front so Grafana/Prometheus immediately has non-zero data.
+        if self.sim is None:
+            return
+        for _ in range(ticks):
+            if self._clock is not None:
+                self._clock.advance(self._dt)
+                self.sim.step(self._dt)
+            else:
+                self.sim.step(self.interval)
+                time.sleep(0.05)
+            if self.aggregator is not None:
+                self.aggregator.evaluate()
+        self._last = _now()
+
+    def tick(self) -> None:
+        self.advance()
+        self.push()
+
+    def advance(self) -> None:
+        # Simulation and recording rules: CPU only, never blocks.
+        if self.sim is not None:
+            if self._clock is not None:
+                self._clock.advance(self._dt)
+                self._timed("step", self.sim.step, self._dt)
+            else:
+                now = _now()
+                self._timed("step", self.sim.step, max(0.05, now - self._last))
+                self._last = now
+        if self.aggregator is not None:
+            self._timed("aggregate", self.aggregator.evaluate)
+
+    def push(self) -> None:
+        # Remote-write snapshot: blocks while a shard is at capacity (backpressure).
+        if self.remote_write is not None:
+            self._timed("remote_write", self.remote_write.snapshot)
+
+    def _timed(self, stage: str, fn: Callable[..., object], *args: object) -> None:
+        if self.self_metrics is None:
+            fn(*args)
+            return
+        t0 = time.perf_counter()
+        fn(*args)
+        self.self_metrics.observe_tick(stage, time.perf_counter() - t0)
+
+
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROTOBUF_CONTENT_TYPE = "application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited"
+
+
+def _media_ranges(header: Optional[str]) -> Iterator[Tuple[str, float, Dict[str, str]]]:
+    # Yields (token, q, other parameters) from an Accept / Accept-Encoding header.
+    for part in (header or "").split(","):
+        token, _, raw_params = part.partition(";")
+        q = 1.0
+        params: Dict[str, str] = {}
+        for param in raw_params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+            elif name:
+                params[name.lower()] = value.strip('"')
+        yield token.strip().lower(), q, params
+
+
+def _exposition_format(accept: Optional[str]) -> str:
+    # "protobuf", "openmetrics" or "text": highest q wins, ties go to the richer format.
+    # Protobuf is only served when asked for explicitly (never via */*).
+    pb_q = om_q = text_q = 0.0
+    for media, q, params in _media_ranges(accept):
+        if media == "application/vnd.google.protobuf":
+            if params.get("proto") == "io.prometheus.client.MetricFamily" and params.get("encoding") == "delimited":
+                pb_q = max(pb_q, q)
+        elif media == "application/openmetrics-text":
+            om_q = max(om_q, q)
+        elif media in ("text/plain", "text/*", "*/*"):
+            text_q = max(text_q, q)
+    if pb_q > 0 and pb_q >= max(om_q, text_q):
+        return "protobuf"
+    if om_q > 0 and om_q >= text_q:
+        return "openmetrics"
+    return "text"
+
+
+def _accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    return any(coding == "gzip" and q > 0 for coding, q, _ in _media_ranges(accept_encoding))
+
+
+def _gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def _metrics_response(
+    registry: Registry,
+    accept: Optional[str],
+    accept_encoding: Optional[str],
+    self_metrics: Optional[SelfMetrics] = None,
+) -> Tuple[List[Tuple[str, str]], Iterator[bytes]]:
+    # Negotiated entity headers plus the (possibly gzip'd) body chunks; transfer framing
+    # is left to the server.
+    fmt = _exposition_format(accept)
+    if fmt == "protobuf":
+        content_type = PROTOBUF_CONTENT_TYPE
+        chunks = registry.iter_protobuf()
+    else:
+        content_type = OPENMETRICS_CONTENT_TYPE if fmt == "openmetrics" else TEXT_CONTENT_TYPE
+        chunks = registry.iter_exposition(openmetrics=fmt == "openmetrics")
+    if self_metrics is not None:
+        chunks = self_metrics.timed_render(fmt, chunks)
+    headers = [("Content-Type", content_type), ("Vary", "Accept, Accept-Encoding")]
+    if _accepts_gzip(accept_encoding):
+        headers.append(("Content-Encoding", "gzip"))
+        chunks = _gzip_chunks(chunks)
+    return headers, chunks
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry
+    self_metrics: Optional[SelfMetrics] = None
+    profiling = False  # serve /debug/profile
+    # HTTP/1.1 for chunked transfer encoding and keep-alive.
+    protocol_version = "HTTP/1.1"
+    # Headers and chunks are separate small writes; don't let Nagle + delayed ACK stall them.
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:  # noqa: N802
+        url = urllib.parse.urlsplit(self.path)
+        if self.profiling and url.path == "/debug/profile":
+            try:
+                status, body = 200, _sample_profile(_profile_seconds(url.query))[0]
+            except ValueError as exc:
+                status, body = 400, f"{exc}\n".encode("utf-8")
+            self._send_plain(status, body)
+            return
+        if self.path not in ("/metrics", "/metrics/"):
+            self._send_plain(404, b"not found\n")
+            return
+
+        headers, chunks = _metrics_response(
+            self.registry, self.headers.get("Accept"), self.headers.get("Accept-Encoding"), self.self_metrics
+        )
+        chunked = self.request_version != "HTTP/1.0"
+
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            # HTTP/1.0 peers get a close-delimited body.
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if chunked:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send_plain(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt: str, *args: object) -> None:
+        # Reduce noise.
+        return
+
+
+_KEEPALIVE_IDLE_SECONDS = 30.0
+
+
+async def _handle_asyncio_connection(
+    registry: Registry,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    *,
+    self_metrics: Optional[SelfMetrics] = None,
+    profiling: bool = False,
+) -> None:
+    # Minimal HTTP/1.1 server for /metrics: keep-alive, chunked bodies, one request at a time.
+    try:
+        while True:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), _KEEPALIVE_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                return
+            if not request_line:
+                return
+            parts = request_line.decode("latin-1").split()
+            headers: Dict[str, str] = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            version = parts[2] if len(parts) == 3 else "HTTP/1.0"
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+            plain: Optional[Tuple[str, bytes]] = None  # (status, body) of a non-/metrics reply
+            url = urllib.parse.urlsplit(parts[1]) if len(parts) == 3 else None
+            if url is not None and profiling and parts[0] == "GET" and url.path == "/debug/profile":
+                plain = await _asyncio_profile(url.query)
+            elif len(parts) != 3 or parts[0] != "GET" or parts[1] not in ("/metrics", "/metrics/"):
+                status = "400 Bad Request" if len(parts) != 3 else "404 Not Found"
+                plain = (status, status.split(" ", 1)[1].lower().encode("ascii") + b"\n")
+            if plain is not None:
+                status, body = plain
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+                continue
+
+            entity_headers, chunks = _metrics_response(
+                registry, headers.get("accept"), headers.get("accept-encoding"), self_metrics
+            )
+            head = "HTTP/1.1 200 OK\r\n" + "".join(f"{name}: {value}\r\n" for name, value in entity_headers)
+            head += "Transfer-Encoding: chunked\r\n" if version == "HTTP/1.1" else ""
+            head += f"Connection: {'keep-alive' if keep_alive and version == 'HTTP/1.1' else 'close'}\r\n\r\n"
+            writer.write(head.encode("latin-1"))
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if version == "HTTP/1.1" else chunk)
+                await writer.drain()
+            if version != "HTTP/1.1":
+                return
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        return
+    finally:
+        writer.close()
+
+
+async def _asyncio_profile(query: str) -> Tuple[str, bytes]:
+    # Sampled from a worker thread, so ticks and scrapes on this loop keep running.
+    try:
+        seconds = _profile_seconds(query)
+    except ValueError as exc:
+        return "400 Bad Request", f"{exc}\n".encode("utf-8")
+    body, _ = await asyncio.get_running_loop().run_in_executor(None, _sample_profile, seconds)
+    return "200 OK", body
+
+
+async def _tick_forever(ticker: "_Ticker") -> None:
+    # The push runs on a worker thread: remote-write backpressure holds back the next tick,
+    # not the scrapes served by this loop.
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(ticker.interval)
+        ticker.advance()
+        if ticker.remote_write is not None:
+            await loop.run_in_executor(None, ticker.push)
+
+
+async def _serve_asyncio(
+    registry: Registry,
+    ticker: Optional["_Ticker"],
+    listen: str,
+    port: int,
+    *,
+    self_metrics: Optional[SelfMetrics] = None,
+    profiling: bool = False,
+) -> None:
+    # HTTP endpoint and simulation tick share one event loop: no per-connection threads.
+    handler = functools.partial(_handle_asyncio_connection, registry, self_metrics=self_metrics, profiling=profiling)
+    server = await asyncio.start_server(handler, listen, port, reuse_address=True)
+    tick_task = asyncio.create_task(_tick_forever(ticker)) if ticker is not None else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if tick_task is not None:
+            tick_task.cancel()
+
+
+def _parse_duration(value: str) -> float:
+    # "15s", "500ms", "1m", "2h", "7d" or plain seconds.
+    units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0, "w": 604800.0}
+    for suffix in sorted(units, key=len, reverse=True):
+        if value.endswith(suffix) and value[: -len(suffix)]:
+            return float(value[: -len(suffix)]) * units[suffix]
+    return float(value)
+
+
+def _parse_speed(value: str) -> float:
+    # "100x" or "100": simulated seconds per wall second.
+    text = value.strip().lower()
+    speed = float(text[:-1] if text.endswith("x") else text)
+    if not (speed > 0 and math.isfinite(speed)):
+        raise ValueError(f"speed must be a positive number, got '{value}'")
+    return speed
+
+
+def _parse_time(value: str, now: float) -> float:
+    # Unix seconds, ISO 8601 (naive = UTC), "now" or "now-<duration>".
+    value = value.strip()
+    if value == "now":
+        return now
+    if value.startswith("now-"):
+        return now - _parse_duration(value[len("now-") :])
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+_BACKFILL_BUFFER_BYTES = 64 * 1024 * 1024
+
+
+def _backfill(
+    registry: Registry,
+    sim: "Simulator",
+    clock: SimClock,
+    start: float,
+    end: float,
+    step: float,
+    out_path: str,
+    aggregator: Optional[Aggregator] = None,
+) -> Tuple[int, int]:
+    # Steps the simulator on simulated time (no sleeps) and writes timestamped OpenMetrics
+    # for `promtool tsdb create-blocks-from openmetrics`. OpenMetrics wants every family's
+    # samples contiguous and, within it, every series' points contiguous. Points are buffered
+    # per series and flushed as runs to one temp file per family whenever the buffers reach
+    # _BACKFILL_BUFFER_BYTES; the output then copies each series' runs in order. Memory stays
+    # bounded by the buffer plus one (offset, length) per series per flush.
+    spool_dir = tempfile.mkdtemp(prefix=".backfill-", dir=os.path.dirname(os.path.abspath(out_path)))
+    spools: Dict[str, BinaryIO] = {}
+    runs: Dict[str, Dict[Tuple[str, Labels], List[Tuple[int, int]]]] = {}
+    pending: Dict[str, Dict[Tuple[str, Labels], List[bytes]]] = {}
+    pending_bytes = 0
+    steps = samples = 0
+
+    def flush() -> None:
+        for name, by_series in pending.items():
+            spool = spools.get(name)
+            if spool is None:
+                spool = spools[name] = open(os.path.join(spool_dir, f"{len(spools)}.om"), "w+b")
+            family_runs = runs.setdefault(name, {})
+            for key, parts in by_series.items():
+                data = b"".join(parts)
+                family_runs.setdefault(key, []).append((spool.tell(), len(data)))
+                spool.write(data)
+        pending.clear()
+
+    try:
+        t = start
+        while t <= end:
+            clock.now = t
+            sim.step(step)
+            if aggregator is not None:
+                aggregator.evaluate()
+            suffix = b" %.3f\n" % t
+            with registry._lock:
+                layout = registry._refresh()
+            for family in layout:
+                if not family.series:
+                    continue
+                by_series = pending.setdefault(family.name, {})
+                for series in family.series:
+                    line = series.line
+                    point = line.replace(b"\n", suffix)
+                    by_series.setdefault(series.key, []).append(point)
+                    samples += line.count(b"\n")
+                    pending_bytes += len(point)
+            if pending_bytes >= _BACKFILL_BUFFER_BYTES:
+                flush()
+                pending_bytes = 0
+            steps += 1
+            t = start + steps * step
+        flush()
+
+        with registry._lock:
+            layout = registry._refresh()
+        with open(out_path, "wb") as out:
+            for family in layout:
+                spool = spools.get(family.name)
+                if spool is None:
+                    continue
+                out.write(family.om_header)
+                # Sorted like the layout; also covers series evicted before the end.
+                for key in sorted(runs[family.name]):
+                    for offset, length in runs[family.name][key]:
+                        spool.seek(offset)
+                        out.write(spool.read(length))
+            out.write(b"# EOF\n")
+    finally:
+        for spool in spools.values():
+            spool.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    return steps, samples
+
+
+def _parse_csv(value: str) -> List[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Expose mock LLM business metrics in Prometheus /metrics format.",
+    )
+    parser.add_argument("--listen", default="0.0.0.0", help="Listen address (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=18080, help="Listen port (default: 18080)")
     parser.add_argument("--interval", type=float, default=1.0, help="Simulation tick interval seconds (default: 1)")
     parser.add_argument("--base-qps", type=float, default=2.0, help="Base QPS per (service,channel) (default: 2)")
     parser.add_argument(
@@ -497,42 +4019,475 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         default="normal",
         help='normal=低错误/低延迟；stress=更容易触发告警阈值 (default: normal)',
     )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "numpy"],
+        default="python",
+        help="python=per-request scalar draws; numpy=vectorized per-tick batches (requires numpy) (default: python)",
+    )
+    parser.add_argument(
+        "--mq-model",
+        choices=["simple", "queue"],
+        default="simple",
+        help="simple=independent MQ samples; queue=discrete-event writer queue drives MQ metrics (default: simple)",
+    )
+    parser.add_argument(
+        "--mq-consumers",
+        type=int,
+        default=None,
+        help="Queue model: concurrent MQ writers (default: 5 normal / 2 stress)",
+    )
+    parser.add_argument(
+        "--mq-service-time",
+        choices=MQ_SERVICE_TIMES,
+        default="lognormal",
+        help="Queue model: per-write service time distribution (default: lognormal)",
+    )
+    parser.add_argument(
+        "--mq-timeout",
+        type=float,
+        default=5.0,
+        help="Queue model: seconds a write may wait before the producer gives up (default: 5)",
+    )
+    parser.add_argument(
+        "--mq-buffer",
+        type=int,
+        default=10000,
+        help="Queue model: backlog limit before writes are rejected (default: 10000)",
+    )
+    parser.add_argument(
+        "--inflight-by-channel",
+        action="store_true",
+        help="Also expose channel_llm_chat_handler_active_count{service,channel}",
+    )
+    parser.add_argument(
+        "--registry",
+        choices=["locked", "sharded"],
+        default="locked",
+        help="locked=single global lock; sharded=per-thread shards merged at scrape time (default: locked)",
+    )
+    parser.add_argument(
+        "--server",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="threaded=ThreadingHTTPServer + sim thread; asyncio=one event loop for HTTP and ticks (default: threaded)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Shard services x channels across N simulator processes sharing mmap files (default: 0 = in-process)",
+    )
+    parser.add_argument(
+        "--gauge-aggregation",
+        choices=GAUGE_AGGREGATIONS,
+        default="sum",
+        help="How --workers gauges combine across processes (default: sum)",
+    )
+    parser.add_argument(
+        "--shm-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Capacity of each worker's mmap file; sparse, only touched pages count (default: 64MiB)",
+    )
+    parser.add_argument(
+        "--synthetic-cardinality",
+        type=int,
+        default=None,
+        metavar="SERIES",
+        help="Add generated model/region/tenant labels until roughly SERIES series are exposed",
+    )
+    parser.add_argument(
+        "--native-histograms",
+        type=int,
+        default=None,
+        metavar="SCHEMA",
+        help="Also keep native (exponential) histogram buckets at SCHEMA (-4..8); served over protobuf only",
+    )
+    parser.add_argument(
+        "--native-only",
+        action="store_true",
+        help="With --native-histograms: drop the classic buckets (text formats then expose only +Inf/_sum/_count)",
+    )
+    parser.add_argument(
+        "--latency-type",
+        choices=("histogram", "summary"),
+        default="histogram",
+        help="Expose latency/token-rate metrics as histograms or as sketch-backed summaries (default: histogram)",
+    )
+    parser.add_argument(
+        "--summary-window",
+        default="10m",
+        help="With --latency-type summary: sliding quantile window, e.g. 1m, 10m (default: 10m)",
+    )
+    parser.add_argument(
+        "--scenario",
+        metavar="FILE",
+        default=None,
+        help="Scenario file (JSON, or YAML with PyYAML): rate curves, bursts, outages, latency faults",
+    )
+    parser.add_argument(
+        "--aggregate",
+        action="store_true",
+        help="Also expose pre-aggregated rates, 5xx ratios and top-k channels as recording-rule style gauges",
+    )
+    parser.add_argument(
+        "--aggregate-windows",
+        default="5m",
+        help="With --aggregate: comma-separated rate windows, e.g. 1m,5m (default: 5m)",
+    )
+    parser.add_argument(
+        "--aggregate-interval",
+        default="15s",
+        help="With --aggregate: snapshot/evaluation interval in simulated time (default: 15s)",
+    )
+    parser.add_argument(
+        "--remote-write",
+        metavar="URL",
+        default=None,
+        help="Also push every tick to a Prometheus remote-write endpoint, e.g. http://localhost:9009/api/v1/push",
+    )
+    rw_defaults = RemoteWriteConfig()
+    parser.add_argument(
+        "--remote-write-shards", type=int, default=rw_defaults.shards, help="Remote write sender queues/threads"
+    )
+    parser.add_argument(
+        "--remote-write-batch", type=int, default=rw_defaults.batch_size, help="Max samples per remote write request"
+    )
+    parser.add_argument(
+        "--remote-write-capacity",
+        type=int,
+        default=rw_defaults.capacity,
+        help="Pending samples per shard before ticks block (backpressure)",
+    )
+    parser.add_argument(
+        "--remote-write-retries",
+        type=int,
+        default=rw_defaults.max_retries,
+        help="Retries (exponential backoff) of a failed batch before it is dropped",
+    )
+    parser.add_argument(
+        "--remote-write-connections",
+        type=int,
+        default=rw_defaults.connections,
+        help="Keep-alive connection pool size (default: one per shard)",
+    )
+    parser.add_argument(
+        "--series-limit",
+        metavar="PATTERN:OPTS",
+        action="append",
+        default=[],
+        help="Bound families matching PATTERN (fnmatch), e.g. 'llm_*:ttl=10m,max=5000,on_limit=reject'; "
+        "ttl in simulated time, on_limit evict (LRU, default) or reject. Repeatable, first match wins",
+    )
+    parser.add_argument(
+        "--no-self-metrics",
+        dest="self_metrics",
+        action="store_false",
+        help="Do not expose mock_exporter_* tick/render/payload/lock-wait metrics about the exporter itself",
+    )
+    parser.add_argument(
+        "--debug-profile",
+        action="store_true",
+        help="Serve /debug/profile?seconds=N: sampled stacks of all threads, collapsed (flamegraph) format",
+    )
     parser.add_argument("--seed", type=int, default=None, help="Random seed (optional)")
+    parser.add_argument(
+        "--speed",
+        metavar="Nx",
+        default=None,
+        help="Simulated-time replay: each --interval of wall time simulates N times as much, e.g. 100x",
+    )
     parser.add_argument("--dump", action="store_true", help="Print one /metrics snapshot and exit")
+    parser.add_argument(
+        "--backfill",
+        metavar="START..END",
+        default=None,
+        help="Simulate START..END offline (unix secs, ISO 8601, now, now-7d) and write OpenMetrics to --out",
+    )
+    parser.add_argument("--step", default="15s", help="Backfill sample spacing, e.g. 15s, 1m (default: 15s)")
+    parser.add_argument("--out", default=None, help="Backfill output file (OpenMetrics, for promtool)")
     args = parser.parse_args(argv)
 
-    if args.seed is not None:
-        random.seed(args.seed)
-
     services = _parse_csv(args.services) or ["llm-api"]
     channels = _parse_csv(args.channels) or ["default"]
 
-    registry = Registry()
-    sim = Simulator(registry, services=services, channels=channels, base_qps=args.base_qps, mode=args.mode)
+    if args.engine == "numpy" and np is None:
+        parser.error("--engine numpy requires numpy (pip install numpy)")
+    if args.workers < 0:
+        parser.error("--workers must be >= 0")
+    if args.native_histograms is not None:
+        if args.native_histograms not in NATIVE_SCHEMAS:
+            parser.error(f"--native-histograms must be in [{NATIVE_SCHEMAS[0]}, {NATIVE_SCHEMAS[-1]}]")
+        if args.workers:
+            parser.error("--native-histograms is not supported with --workers")
+    elif args.native_only:
+        parser.error("--native-only requires --native-histograms")
+    if args.latency_type == "summary":
+        if args.native_histograms is not None:
+            parser.error("--native-histograms does not apply to --latency-type summary")
+        if args.workers:
+            parser.error("--latency-type summary is not supported with --workers")
+    try:
+        args.summary_window = _parse_duration(args.summary_window)
+    except ValueError:
+        parser.error(f"invalid --summary-window '{args.summary_window}'")
+    if args.summary_window <= 0:
+        parser.error("--summary-window must be > 0")
+    args.synthetic_labels = []
+    if args.synthetic_cardinality is not None:
+        if args.synthetic_cardinality <= 0:
+            parser.error("--synthetic-cardinality must be > 0")
+        count = _synthetic_label_count(
+            args.synthetic_cardinality, len(services), len(services) * len(channels), args.inflight_by_channel
+        )
+        args.synthetic_labels = _synthetic_label_sets(count)
+    if args.scenario is not None:
+        try:
+            args.scenario = Scenario.load(args.scenario)
+        except (OSError, ValueError) as exc:
+            parser.error(f"invalid --scenario: {exc}")
+    if args.speed is not None:
+        try:
+            args.speed = _parse_speed(args.speed)
+        except ValueError as exc:
+            parser.error(f"invalid --speed: {exc}")
+    try:
+        args.aggregate_windows = [_parse_duration(w) for w in _parse_csv(args.aggregate_windows)]
+        args.aggregate_interval = _parse_duration(args.aggregate_interval)
+    except ValueError as exc:
+        parser.error(f"invalid --aggregate-windows/--aggregate-interval: {exc}")
+    if not args.aggregate_windows or min(args.aggregate_windows) <= 0 or args.aggregate_interval <= 0:
+        parser.error("--aggregate-windows and --aggregate-interval must be positive")
+    try:
+        args.series_limit = [_parse_series_limit(value) for value in args.series_limit]
+    except ValueError as exc:
+        parser.error(f"invalid --series-limit: {exc}")
+    if args.remote_write is not None:
+        if args.backfill is not None:
+            parser.error("--remote-write pushes live ticks; it cannot be combined with --backfill")
+        if min(args.remote_write_shards, args.remote_write_batch) < 1:
+            parser.error("--remote-write-shards and --remote-write-batch must be >= 1")
+        if args.remote_write_retries < 0 or args.remote_write_connections < 0:
+            parser.error("--remote-write-retries and --remote-write-connections must be >= 0")
+        if args.remote_write_capacity < args.remote_write_batch:
+            parser.error("--remote-write-capacity must be >= --remote-write-batch")
+        try:
+            _ConnectionPool(args.remote_write, 1, rw_defaults.timeout)  # URL check only, connects lazily
+        except ValueError as exc:
+            parser.error(f"invalid --remote-write: {exc}")
+        args.remote_write_config = RemoteWriteConfig(
+            shards=args.remote_write_shards,
+            batch_size=args.remote_write_batch,
+            capacity=args.remote_write_capacity,
+            connections=args.remote_write_connections,
+            max_retries=args.remote_write_retries,
+        )
+
+    if args.backfill is not None:
+        if not args.out:
+            parser.error("--backfill requires --out")
+        start_text, sep, end_text = args.backfill.partition("..")
+        try:
+            wall = _now()
+            start, end, step = _parse_time(start_text, wall), _parse_time(end_text, wall), _parse_duration(args.step)
+        except ValueError as exc:
+            parser.error(f"invalid --backfill/--step: {exc}")
+        if not sep or end < start or step <= 0:
+            parser.error("--backfill expects START..END with END >= START and a positive --step")
+
+        registry = Registry()
+        clock = SimClock(start)
+        _limit_series(registry, args, clock)
+        sim = Simulator(registry, services=services, channels=channels, clock=clock, **_simulator_options(args))
+        t0 = time.perf_counter()
+        steps, samples = _backfill(registry, sim, clock, start, end, step, args.out, _aggregator(registry, args, clock))
+        print(
+            f"[mock-metrics] backfilled {steps} steps, {samples} samples to {args.out} "
+            f"in {time.perf_counter() - t0:.1f}s",
+            file=sys.stderr,
+        )
+        return 0
+
+    if args.workers:
+        return _main_workers(args, services, channels)
 
-    # Warm up a bit so Grafana/Prometheus immediately has non-zero data.
-    for _ in range(3):
-        sim.step(args.interval)
-        time.sleep(0.05)
+    registry = ShardedRegistry() if args.registry == "sharded" else Registry()
+    # Offline output (--dump) stays free of timing-dependent series.
+    self_metrics = SelfMetrics(registry) if args.self_metrics and not args.dump else None
+    clock = SimClock(_now()) if args.speed is not None else None
+    _limit_series(registry, args, clock or _now)
+    sim = Simulator(registry, services=services, channels=channels, clock=clock or _now, **_simulator_options(args))
+    ticker = _Ticker(sim, args.interval, clock, args.speed or 1.0, _aggregator(registry, args, clock or _now))
+    ticker.warmup()
 
     if args.dump:
         print(registry.render(), end="")
         return 0
+    ticker.remote_write = _remote_writer(registry, args, clock or _now)
+    ticker.self_metrics = self_metrics
+
+    _serve(registry, ticker, args, self_metrics)
+    return 0
+
+
+def _simulator_options(args: argparse.Namespace) -> Dict[str, object]:
+    # Simulator keyword arguments shared by the in-process and --workers paths.
+    mq_queue = None
+    if args.mq_model == "queue":
+        mq_queue = MqQueueConfig(
+            consumers=args.mq_consumers,
+            service_time=args.mq_service_time,
+            timeout=args.mq_timeout,
+            buffer=args.mq_buffer,
+        )
+    return {
+        "base_qps": args.base_qps,
+        "mode": args.mode,
+        "engine": args.engine,
+        "inflight_by_channel": args.inflight_by_channel,
+        "mq_queue": mq_queue,
+        "seed": args.seed,
+        "scenario": args.scenario,
+        "synthetic_labels": args.synthetic_labels,
+        "native_schema": args.native_histograms,
+        "classic_buckets": not args.native_only,
+        "latency_type": args.latency_type,
+        "summary_window": args.summary_window,
+    }
+
+
+def _parse_series_limit(value: str) -> Tuple[str, Dict[str, object]]:
+    # "PATTERN:ttl=10m,max=5000,on_limit=reject" -> (pattern, Registry.limit_series kwargs).
+    pattern, sep, opts = value.rpartition(":")
+    if not sep or not pattern:
+        raise ValueError(f"expected PATTERN:OPTS, got '{value}'")
+    kwargs: Dict[str, object] = {}
+    for item in _parse_csv(opts):
+        key, sep, text = item.partition("=")
+        if not sep:
+            raise ValueError(f"expected key=value, got '{item}'")
+        if key == "ttl":
+            kwargs["ttl"] = _parse_duration(text)
+        elif key == "max":
+            kwargs["max_series"] = int(text)
+        elif key == "on_limit":
+            kwargs["on_limit"] = text
+        else:
+            raise ValueError(f"unknown option '{key}' (ttl, max, on_limit)")
+    Registry().limit_series(pattern, **kwargs)  # validation only
+    return pattern, kwargs
+
+
+def _limit_series(registry: Registry, args: argparse.Namespace, clock: Callable[[], float]) -> None:
+    for pattern, kwargs in args.series_limit:
+        registry.limit_series(pattern, clock=clock, **kwargs)
+
+
+def _aggregator(registry: Registry, args: argparse.Namespace, clock: Callable[[], float]) -> Optional[Aggregator]:
+    if not args.aggregate:
+        return None
+    return Aggregator(registry, windows=args.aggregate_windows, resolution=args.aggregate_interval, clock=clock)
+
+
+def _remote_writer(registry: Registry, args: argparse.Namespace, clock: Callable[[], float]) -> Optional[RemoteWriter]:
+    if args.remote_write is None:
+        return None
+    return RemoteWriter(registry, args.remote_write, args.remote_write_config, clock=clock)
+
+
+def _main_workers(args: argparse.Namespace, services: List[str], channels: List[str]) -> int:
+    # --workers N: shard services x channels across N processes writing mmap files;
+    # this process only aggregates and serves.
+    shm_dir = tempfile.mkdtemp(prefix="mock-llm-metrics-")
+    registry = MultiProcessRegistry(shm_dir, gauge_aggregation=args.gauge_aggregation)
+    pairs = [(service, channel) for service in services for channel in channels]
+    ctx = multiprocessing.get_context("spawn")
+    workers = []
+    # Turn SIGTERM into SystemExit so workers and the mmap directory are cleaned up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for i in range(min(args.workers, len(pairs))):
+            proc = ctx.Process(
+                target=_worker_main,
+                args=(
+                    os.path.join(shm_dir, f"worker-{i}.db"),
+                    args.shm_bytes,
+                    pairs[i :: args.workers],
+                    dict(_simulator_options(args), seed=None if args.seed is None else args.seed + i),
+                    args.interval,
+                    args.speed,
+                    args.dump,
+                ),
+                name=f"sim-worker-{i}",
+                daemon=True,
+            )
+            proc.start()
+            workers.append(proc)
+
+        if args.dump:
+            for proc in workers:
+                proc.join()
+            print(registry.render(), end="")
+            return 0
+
+        # Workers keep their own simulated clocks; here --speed is approximated on wall time.
+        started = _now()
+        speed = args.speed or 1.0
+
+        def clock() -> float:
+            return started + (_now() - started) * speed
+
+        self_metrics = SelfMetrics(registry) if args.self_metrics else None
+        _limit_series(registry, args, clock)
+        aggregator = _aggregator(registry, args, clock)
+        remote_write = _remote_writer(registry, args, clock)
+        ticker = None
+        if aggregator or remote_write:
+            ticker = _Ticker(None, args.interval, aggregator=aggregator, remote_write=remote_write)
+            ticker.self_metrics = self_metrics
+        _serve(registry, ticker, args, self_metrics)
+        return 0
+    finally:
+        for proc in workers:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        shutil.rmtree(shm_dir, ignore_errors=True)
+
+
+def _serve(
+    registry: Registry,
+    ticker: Optional[_Ticker],
+    args: argparse.Namespace,
+    self_metrics: Optional[SelfMetrics] = None,
+) -> None:
+    if args.server == "asyncio":
+        print(f"[mock-metrics] serving http://{args.listen}:{args.port}/metrics (mode={args.mode}, server=asyncio)")
+        try:
+            asyncio.run(
+                _serve_asyncio(
+                    registry, ticker, args.listen, args.port, self_metrics=self_metrics, profiling=args.debug_profile
+                )
+            )
+        except KeyboardInterrupt:
+            pass
+        return
 
     MetricsHandler.registry = registry
+    MetricsHandler.self_metrics = self_metrics
+    MetricsHandler.profiling = args.debug_profile
     server = ThreadingHTTPServer((args.listen, args.port), MetricsHandler)
 
     def loop() -> None:
-        last = _now()
+        assert ticker is not None
         while True:
             time.sleep(args.interval)
-            now = _now()
-            dt = max(0.05, now - last)
-            sim.step(dt)
-            last = now
+            ticker.tick()
 
-    t = threading.Thread(target=loop, name="sim-loop", daemon=True)
-    t.start()
+    if ticker is not None:
+        t = threading.Thread(target=loop, name="sim-loop", daemon=True)
+        t.start()
 
     print(f"[mock-metrics] serving http://{args.listen}:{args.port}/metrics (mode={args.mode})")
     try:
@@ -541,7 +4496,6 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         pass
     finally:
         server.server_close()
-    return 0
 
 
 if __name__ == "__main__":